@@ -1,7 +1,10 @@
 from fastapi import FastAPI, Request, Form, HTTPException, Depends, File, UploadFile, Query, Body
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, Response, FileResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
+from starlette.staticfiles import NotModifiedResponse
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware, GZipResponder, IdentityResponder
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.base import BaseHTTPMiddleware
 import socketio
@@ -17,20 +20,98 @@ import re
 import secrets
 import hashlib
 import hmac
+import mimetypes
+import json
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, WatchedFileHandler
+import heapq
+import sys
+import threading
+import traceback
+from functools import lru_cache
+from email.utils import formatdate, parsedate_to_datetime
 from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, User
 from typing import List
+from collections import defaultdict
+from bus import create_client_manager, create_job_queue
+import db
+import tracing
+import schedule
+import archive
+import backup
+import maintenance
+import orphans
+from metrics import (REGISTRY, CONTENT_TYPE, HTTP_SECONDS, MESSAGE_QUEUE_DEPTH, SOCKETIO_CLIENTS, SOCKETIO_EMITS,
+                     TELEGRAM_REQUEST_SECONDS, TELEGRAM_ERRORS, TELEGRAM_RETRIES,
+                     LOOP_LAG_SECONDS, LOOP_LAG_LAST, LOOP_BLOCKED, DASHBOARD_EVENTS, DASHBOARD_EVENTS_MERGED,
+                     DASHBOARD_EVENTS_COLLAPSED, DASHBOARD_FRAMES)
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[logging.FileHandler('bot.log'), logging.StreamHandler()]
-)
+load_dotenv()
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+LOG_JSON = os.getenv("LOG_JSON", "0") == "1"
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+def log_file_handler():
+    # Ротацию RotatingFileHandler безопасно делать только из одного процесса. Поэтому бот
+    # (RUN_MODE=all или bot) пишет в LOG_FILE и ротирует его сам, а веб-воркеры RUN_MODE=web
+    # дописывают общий <LOG_FILE>.web без ротации изнутри — её делает logrotate,
+    # WatchedFileHandler после переименования открывает файл заново
+    if os.getenv("RUN_MODE", "all") == "web":
+        base, ext = os.path.splitext(LOG_FILE)
+        return WatchedFileHandler(f"{base}.web{ext}", encoding="utf-8")
+    return RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+
+def setup_logging():
+    """Логи пишутся в отдельном потоке: цикл событий только кладёт запись в очередь."""
+    formatter = JsonFormatter() if LOG_JSON else logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    file_handler = log_file_handler()
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
 
 astana_tz = pytz.timezone('Asia/Almaty')
 
-load_dotenv()
 BASE_URL = os.getenv("BASE_URL", "http://localhost:8080")
+RUN_MODE = os.getenv("RUN_MODE", "all")  # all — бот и веб в одном процессе, bot — только бот, web — только веб
+BUS_URL = os.getenv("BUS_URL", "")  # общая шина для нескольких процессов, см. bus.py
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")  # свой Bot API сервер или локальная заглушка (fake_telegram.py)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook/telegram")
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # Bearer-токен для /metrics; без него — только с localhost
+SESSION_TTL = timedelta(days=30)
+SESSION_RENEW_INTERVAL = timedelta(days=1)
+TICKET_PAGE_SIZE = int(os.getenv("TICKET_PAGE_SIZE", "50"))  # сообщений на странице тикета, старые догружаются при прокрутке
 
 app = FastAPI()
 
@@ -46,29 +127,186 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*')
+class MeteredAsyncServer(socketio.AsyncServer):
+    async def emit(self, event, *args, **kwargs):
+        SOCKETIO_EMITS.inc(event=event)
+        with tracing.span(f"sio.emit {event}"):
+            return await super().emit(event, *args, **kwargs)
+
+sio = MeteredAsyncServer(
+    async_mode='asgi',
+    cors_allowed_origins='*',
+    client_manager=create_client_manager(BUS_URL, write_only=RUN_MODE == "bot")
+)
 app.mount("/socket.io", socketio.ASGIApp(sio))
 
 templates = Jinja2Templates(directory="templates")
-app.mount("/static", StaticFiles(directory="static"), name="static")
-app.mount("/Uploads", StaticFiles(directory="Uploads"), name="uploads")
+# Часть ETag страниц: после обновления шаблонов старые закэшированные ответы не подойдут
+# Страницы ссылаются на static/ с отпечатками, поэтому смена статики тоже меняет ETag страниц
+TEMPLATES_VERSION = hashlib.sha1("".join(
+    f"{directory}/{name}:{os.stat(os.path.join(directory, name)).st_mtime_ns}"
+    for directory in ("templates", "static") for name in sorted(os.listdir(directory))
+).encode()).hexdigest()[:12]
+
+IMMUTABLE_CACHE_SECONDS = 365 * 24 * 3600
+
+@lru_cache(maxsize=256)
+def _static_fingerprint(path: str, mtime_ns: int) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()[:10]
+
+def static_url(name: str) -> str:
+    """URL файла из static/ с отпечатком содержимого: такой ответ кэшируется навсегда."""
+    path = os.path.join("static", name)
+    try:
+        return f"/static/{name}?v={_static_fingerprint(path, os.stat(path).st_mtime_ns)}"
+    except OSError:
+        return f"/static/{name}"
+
+templates.env.globals["static_url"] = static_url
+
+# Имена новых вложений содержат случайный токен (см. get_unique_filename), поэтому по одному
+# URL никогда не окажется другой файл — даже после удаления старого с тем же именем
+UPLOAD_TOKEN_PATTERN = re.compile(r"_[0-9a-f]{8}(\.[^/]*)?$")
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles с Cache-Control: immutable для неизменяемых URL, иначе перепроверка по ETag."""
+
+    def __init__(self, *args, cache_control: str = "no-cache", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_control = cache_control
+
+    def is_immutable(self, full_path: str, scope) -> bool:
+        return False
+
+    def make_response(self, full_path, stat_result, status_code: int) -> FileResponse:
+        return FileResponse(full_path, status_code=status_code, stat_result=stat_result)
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200):
+        response = self.make_response(full_path, stat_result, status_code)
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            response = NotModifiedResponse(response.headers)
+        if self.is_immutable(str(full_path), scope):
+            response.headers["Cache-Control"] = f"{self.cache_control}, max-age={IMMUTABLE_CACHE_SECONDS}, immutable"
+        else:
+            response.headers["Cache-Control"] = "no-cache"
+        return response
+
+class FingerprintedStaticFiles(CachedStaticFiles):
+    def is_immutable(self, full_path: str, scope) -> bool:
+        # Только если ?v= совпадает с текущим содержимым: устаревшая ссылка из старой страницы не закрепит новый файл
+        query = scope.get("query_string", b"").decode()
+        for pair in query.split("&"):
+            if pair.startswith("v="):
+                name = os.path.relpath(full_path, "static")
+                return static_url(name).endswith("?" + pair)
+        return False
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+class UploadFileResponse(FileResponse):
+    # Архивы логов — сотни мегабайт: крупные чанки вместо 64 КБ сокращают число чтений и send()
+    chunk_size = UPLOAD_CHUNK_SIZE
+
+@lru_cache(maxsize=4096)
+def attachment_download_info(file_path: str):
+    """(имя для Content-Disposition, тип вложения) по пути в Uploads; имена файлов не переиспользуются,
+    поэтому ответ можно кэшировать. Миниатюры и файлы без записи — (None, None)."""
+    conn = db.connect(readonly=True)
+    try:
+        row = conn.execute(
+            "SELECT COALESCE(original_name, file_name), file_type FROM attachments WHERE file_path = ? LIMIT 1",
+            (file_path,)
+        ).fetchone()
+    finally:
+        conn.close()
+    return tuple(row) if row else (None, None)
+
+class UploadFiles(CachedStaticFiles):
+    """Вложения: Range/If-Range (докачка) обрабатывает FileResponse, здесь — имя файла и крупные чанки."""
+
+    def make_response(self, full_path, stat_result, status_code: int) -> FileResponse:
+        relative = os.path.relpath(full_path, self.directory).replace(os.sep, "/")
+        download_name, file_type = attachment_download_info(f"Uploads/{relative}")
+        # Картинки открываются во вкладке, остальное скачивается под исходным именем
+        inline = file_type == "image" or (download_name is None and (mimetypes.guess_type(relative)[0] or "").startswith("image/"))
+        return UploadFileResponse(
+            full_path, status_code=status_code, stat_result=stat_result,
+            filename=download_name or os.path.basename(relative),
+            content_disposition_type="inline" if inline else "attachment",
+        )
+
+    def is_immutable(self, full_path: str, scope) -> bool:
+        return UPLOAD_TOKEN_PATTERN.search(os.path.basename(full_path)) is not None
+
+app.mount("/static", FingerprintedStaticFiles(directory="static", cache_control="public"), name="static")
+app.mount("/Uploads", UploadFiles(directory="Uploads", cache_control="private"), name="uploads")
+# Вложения заархивированных тикетов; в отличие от /Uploads — только после входа
+app.mount("/Archive/Uploads", UploadFiles(directory=archive.ARCHIVE_UPLOADS_DIR, cache_control="private", check_dir=False),
+          name="archive_uploads")
 
-message_queue = asyncio.Queue()
+message_queue = create_job_queue(BUS_URL)
+MESSAGE_QUEUE_DEPTH.function = lambda: message_queue.qsize()
 loop = None
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 NOTIFICATION_CHAT_ID = os.getenv("NOTIFICATION_CHAT_ID")
 NOTIFICATION_TOPIC_ID = os.getenv("NOTIFICATION_TOPIC_ID")
 
-bot = Bot(token=BOT_TOKEN)
+TELEGRAM_MAX_RETRIES = 2
+TELEGRAM_MAX_RETRY_AFTER = 30  # дольше ждать флуд-контроль не имеет смысла, ошибка уходит вызывающему
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Время и ошибки каждого вызова Bot API; при RetryAfter — ожидание и повтор."""
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                with tracing.span(f"telegram {name}"):
+                    return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                TELEGRAM_ERRORS.inc(method=name, error=type(e).__name__)
+                if attempt >= TELEGRAM_MAX_RETRIES or e.retry_after > TELEGRAM_MAX_RETRY_AFTER:
+                    raise
+                attempt += 1
+                TELEGRAM_RETRIES.inc(method=name)
+                logging.warning("Bot API %s: флуд-контроль, повтор через %s с", name, e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                TELEGRAM_ERRORS.inc(method=name, error=type(e).__name__)
+                raise
+            finally:
+                TELEGRAM_REQUEST_SECONDS.observe(time.perf_counter() - started, method=name)
+
+def create_bot(token: str) -> Bot:
+    if TELEGRAM_API_URL:
+        new_bot = Bot(token=token, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+    else:
+        new_bot = Bot(token=token)
+    new_bot.session.middleware(TelegramMetricsMiddleware())
+    return new_bot
+
+bot = create_bot(BOT_TOKEN)
 
 def set_event_loop(event_loop):
     global loop
     loop = event_loop
-    logging.debug(f"Установлен цикл событий: {loop}")
+    logging.debug("Установлен цикл событий: %s", loop)
 
 db_lock = asyncio.Lock()
 
+@app.on_event("startup")
+async def on_app_startup():
+    # В режиме web бот живёт в другом процессе, поэтому цикл событий и фоновые задачи веба поднимаем здесь
+    set_event_loop(asyncio.get_running_loop())
+    asyncio.create_task(typing_presence.run())
+    loop_monitor.start()
+    schedule.holiday_scheduler.start()
+    tracing.start_exporter()
+
 def generate_session_token():
     return secrets.token_urlsafe(32)
 
@@ -98,7 +336,7 @@ def verify_telegram_auth(data: dict, bot_token: str) -> bool:
     data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(data.items()) if v)
     secret_key = hashlib.sha256(bot_token.encode()).digest()
     computed_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
-    logging.debug(f"Проверка подписи: data={data}, data_check_string={data_check_string}, computed_hash={computed_hash}, received_hash={received_hash}")
+    logging.debug("Проверка подписи для id=%s", data.get("id"))
     return computed_hash == received_hash
 
 async def get_current_user(request: Request):
@@ -139,15 +377,17 @@ async def get_current_user(request: Request):
         logging.error(f"Сотрудник с telegram_id={telegram_id} не является администратором")
         raise HTTPException(status_code=403, detail="Not authorized")
     
-    new_expires_at = (datetime.utcnow() + timedelta(days=30)).isoformat()
-    cursor.execute(
-        "UPDATE sessions SET expires_at = ? WHERE session_token = ?",
-        (new_expires_at, session_token)
-    )
-    conn.commit()
+    # Продлеваем сессию не чаще раза в сутки, чтобы обычный просмотр страниц не был записью в базу
+    new_expires_at = datetime.utcnow() + SESSION_TTL
+    if new_expires_at - expires_at > SESSION_RENEW_INTERVAL:
+        cursor.execute(
+            "UPDATE sessions SET expires_at = ? WHERE session_token = ?",
+            (new_expires_at.isoformat(), session_token)
+        )
+        conn.commit()
     conn.close()
     
-    logging.debug(f"Авторизован пользователь: telegram_id={telegram_id}, login={employee['login']}, is_admin={employee['is_admin']}")
+    logging.debug("Авторизован пользователь: telegram_id=%s, login=%s, is_admin=%s", telegram_id, employee['login'], employee['is_admin'])
     return {"telegram_id": telegram_id, "login": employee['login'], "is_admin": employee['is_admin']}
 
 @app.get("/settings", response_class=HTMLResponse)
@@ -161,12 +401,16 @@ async def settings_page(request: Request, employee: dict = Depends(get_current_u
         "working_hours_start": get_setting("working_hours_start"),
         "working_hours_end": get_setting("working_hours_end"),
         "weekend_days": [int(day) for day in get_setting("weekend_days", "0,6").split(",")],
+        "weekday_hours": schedule.parse_weekday_hours(get_setting("weekday_hours", "")),
         "is_holiday": get_setting("is_holiday", "0")
     }
+    current_schedule = schedule.current()
     return templates.TemplateResponse("settings.html", {
         "request": request,
         "employee": employee,
         "settings": settings,
+        "holidays": current_schedule.holiday_list,
+        "next_opening": current_schedule.next_opening(),
         "BASE_URL": BASE_URL
     })
 
@@ -194,7 +438,7 @@ async def telegram_auth(
         "auth_date": auth_date,
         "hash": hash
     }
-    logging.debug(f"Получены Telegram данные: {data}")
+    logging.debug("Вход через Telegram: id=%s, username=%s", id, username)
     
     if not verify_telegram_auth(data, bot_token):
         logging.error("Неверная подпись Telegram")
@@ -215,7 +459,7 @@ async def telegram_auth(
         raise HTTPException(status_code=403, detail="Вы не авторизованы. Попросите администратора добавить ваш Telegram ID.")
     
     session_token = generate_session_token()
-    expires_at = (datetime.utcnow() + timedelta(days=30)).isoformat()
+    expires_at = (datetime.utcnow() + SESSION_TTL).isoformat()
     cursor.execute(
         "INSERT INTO sessions (session_token, telegram_id, expires_at) VALUES (?, ?, ?)",
         (session_token, telegram_id, expires_at)
@@ -237,7 +481,7 @@ async def telegram_auth(
         samesite="lax",
         max_age=30 * 24 * 60 * 60
     )
-    logging.debug(f"Установлен session_token в куки, редирект на /")
+    logging.debug("Установлен session_token в куки, редирект на /")
     return response
 
 def get_setting(key: str, default: str = None) -> str:
@@ -254,10 +498,10 @@ def update_setting(key: str, value: str):
     cursor.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
     conn.commit()
     conn.close()
-    logging.debug(f"Настройка {key} обновлена: {value}")
+    logging.debug("Настройка %s обновлена: %s", key, value)
 
-def get_db_connection():
-    conn = sqlite3.connect("support.db", timeout=10)
+def get_db_connection(readonly: bool = False):
+    conn = db.connect(readonly=readonly)
     conn.row_factory = sqlite3.Row
     return conn
 
@@ -265,24 +509,23 @@ def get_unique_filename(filename: str, directory: str = "Uploads"):
     cleaned_filename = re.sub(r'[^\w\-\.]', '_', filename)
     cleaned_filename = re.sub(r'_+', '_', cleaned_filename).strip('_')
     base, ext = os.path.splitext(cleaned_filename)
-    counter = 0
-    new_filename = cleaned_filename
+    # Случайный токен: URL вложения никогда не переиспользуется, поэтому /Uploads кэшируется как immutable
+    new_filename = f"{base}_{secrets.token_hex(4)}{ext}"
     while os.path.exists(os.path.join(directory, new_filename)):
-        counter += 1
-        new_filename = f"{base}_{counter}{ext}"
-    logging.debug(f"Сгенерировано уникальное имя файла: {filename} -> {new_filename}")
+        new_filename = f"{base}_{secrets.token_hex(4)}{ext}"
+    logging.debug("Сгенерировано уникальное имя файла: %s -> %s", filename, new_filename)
     return new_filename
 
 class AuthMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
-        logging.debug(f"Проверка авторизации для пути: {request.url.path}")
-        if request.url.path in ["/login", "/telegram-auth", "/static", "/Uploads"] or request.url.path.startswith(("/static/", "/Uploads/", "/socket.io")):
-            logging.debug(f"Путь {request.url.path} не требует авторизации")
+        logging.debug("Проверка авторизации для пути: %s", request.url.path)
+        if request.url.path in ["/login", "/telegram-auth", "/static", "/Uploads", "/metrics", WEBHOOK_PATH] or request.url.path.startswith(("/static/", "/Uploads/", "/socket.io")):
+            logging.debug("Путь %s не требует авторизации", request.url.path)
             return await call_next(request)
         try:
             employee = await get_current_user(request)
             request.state.employee = employee
-            logging.debug(f"Авторизация успешна для telegram_id={employee['telegram_id']}")
+            logging.debug("Авторизация успешна для telegram_id=%s", employee['telegram_id'])
             return await call_next(request)
         except HTTPException as e:
             logging.error(f"Ошибка авторизации: {e.detail}")
@@ -290,6 +533,95 @@ class AuthMiddleware(BaseHTTPMiddleware):
 
 app.add_middleware(AuthMiddleware)
 
+def metrics_route(request: Request) -> str:
+    # Шаблон маршрута (/ticket/{ticket_id}), а не сам путь — чтобы не плодить серии
+    route = request.scope.get("route")
+    if route is not None:
+        return route.path
+    for prefix in ("/static", "/Uploads", "/socket.io"):
+        if request.url.path.startswith(prefix + "/"):
+            return prefix
+    return "unmatched"
+
+TRACE_SKIP_PREFIXES = ("/static/", "/Uploads/", "/socket.io", "/metrics")
+
+class MetricsMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next):
+        if request.url.path.startswith(TRACE_SKIP_PREFIXES):
+            return await self.observe(request, call_next, None)
+        with tracing.trace(f"{request.method} {request.url.path}") as span:
+            return await self.observe(request, call_next, span)
+
+    async def observe(self, request: Request, call_next, span):
+        started = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            route = metrics_route(request)
+            HTTP_SECONDS.observe(time.perf_counter() - started, method=request.method, route=route, status=status)
+            if span is not None:
+                span.name = f"{request.method} {route}"
+                span.attributes.update(path=request.url.path, status=status)
+
+app.add_middleware(MetricsMiddleware)
+
+# Сжимаем только текст: картинки, видео и архивы уже сжаты, а повторное сжатие лишь тратит CPU.
+# Ответы на Range (206) не трогаем — Content-Range относится к несжатому телу
+GZIP_MINIMUM_SIZE = 1024
+GZIP_CONTENT_TYPES = ("text/html", "text/css", "text/plain", "text/javascript", "application/javascript",
+                      "application/json", "image/svg+xml")
+
+class TextOnlyGZipResponder(GZipResponder):
+    async def send_with_compression(self, message):
+        if message["type"] == "http.response.start":
+            await super().send_with_compression(message)
+            headers = Headers(raw=message["headers"])
+            if (message["status"] == 206 or "content-range" in headers
+                    or not headers.get("content-type", "").startswith(GZIP_CONTENT_TYPES)):
+                self.content_type_is_excluded = True
+            return
+        await super().send_with_compression(message)
+
+class TextGZipMiddleware(GZipMiddleware):
+    async def __call__(self, scope, receive, send):
+        # Uploads не сжимаем: докачке нужны стабильные Content-Length и смещения несжатого файла
+        if scope["type"] != "http" or scope["path"].startswith(("/socket.io", "/Uploads/")):
+            await self.app(scope, receive, send)
+            return
+        if "gzip" in Headers(scope=scope).get("Accept-Encoding", ""):
+            responder = TextOnlyGZipResponder(self.app, self.minimum_size, compresslevel=self.compresslevel)
+        else:
+            responder = IdentityResponder(self.app, self.minimum_size)
+        await responder(scope, receive, send)
+
+# Уровень 6 вместо 9: почти тот же размер при заметно меньших затратах CPU на каждый ответ
+app.add_middleware(TextGZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE, compresslevel=6)
+
+PROXY_HEADERS = ("x-forwarded-for", "x-forwarded-host", "x-real-ip", "forwarded")
+
+def is_direct_local_request(request: Request) -> bool:
+    """Запрос с localhost, пришедший не через обратный прокси.
+
+    За прокси на том же хосте любой внешний запрос приходит с 127.0.0.1. Поэтому запрос с
+    заголовками прокси считаем внешним, даже если uvicorn оставил адрес 127.0.0.1: X-Forwarded-For
+    он применяет только от доверенных адресов (--forwarded-allow-ips).
+    """
+    if not request.client or request.client.host not in ("127.0.0.1", "::1"):
+        return False
+    return not any(header in request.headers for header in PROXY_HEADERS)
+
+@app.get("/metrics")
+async def metrics_endpoint(request: Request):
+    if METRICS_TOKEN:
+        if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+            raise HTTPException(status_code=403, detail="Forbidden")
+    elif not is_direct_local_request(request):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
 async def send_notification_to_topic(ticket_id: int, login: str, message: str, is_reopened: bool = False):
     if not NOTIFICATION_CHAT_ID or not NOTIFICATION_TOPIC_ID:
         logging.warning("NOTIFICATION_CHAT_ID или NOTIFICATION_TOPIC_ID не заданы, уведомление не отправлено")
@@ -318,7 +650,7 @@ async def quickview(
     ticket_id: int,
     employee: dict = Depends(get_current_user)
 ):
-    logging.debug(f"Запрос к QuickView тикета #{ticket_id}")
+    logging.debug("Запрос к QuickView тикета #%s", ticket_id)
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT telegram_id FROM tickets WHERE ticket_id = ?", (ticket_id,))
@@ -346,16 +678,13 @@ async def quickview(
     for row in messages:
         cursor.execute(
             """
-            SELECT file_path, file_name, file_type
+            SELECT file_path, file_name, file_type, thumb_path, width, height
             FROM attachments
             WHERE message_id = ?
             """,
             (row["message_id"],)
         )
-        attachments = [
-            {"file_path": a["file_path"], "file_name": a["file_name"], "file_type": a["file_type"]}
-            for a in cursor.fetchall()
-        ]
+        attachments = [dict(a) for a in cursor.fetchall()]
         messages_list.append({
             "message_id": row["message_id"],
             "ticket_id": row["ticket_id"],
@@ -395,7 +724,7 @@ async def logout(request: Request):
         cursor.execute("DELETE FROM sessions WHERE session_token = ?", (session_token,))
         conn.commit()
         conn.close()
-        logging.debug(f"Сессия с session_token={session_token} удалена")
+        logging.debug("Сессия с session_token=%s удалена", session_token)
     response = RedirectResponse(url="/login", status_code=303)
     response.delete_cookie("session_token")
     logging.debug("Запрос на выход, cookie удалены")
@@ -410,64 +739,150 @@ async def cleanup_sessions():
     deleted_count = cursor.rowcount
     conn.commit()
     conn.close()
-    logging.debug(f"Очищено {deleted_count} устаревших сессий")
+    logging.debug("Очищено %s устаревших сессий", deleted_count)
     return {"status": "ok", "deleted_count": deleted_count}
 
+def tickets_version(cursor) -> int:
+    """Глобальный счётчик изменений тикетов (таблица sequences, ведётся триггерами из init_db)."""
+    cursor.execute("SELECT value FROM sequences WHERE name = 'tickets'")
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+def fetch_sequences(cursor) -> dict:
+    """Счётчики изменений: имя -> (значение, время последнего изменения, unix)."""
+    cursor.execute("SELECT name, value, updated_at FROM sequences")
+    return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+
+def make_etag(*parts) -> str:
+    return 'W/"%s"' % hashlib.sha1("|".join(map(str, parts)).encode()).hexdigest()[:20]
+
+def cache_headers(etag: str, last_modified: int) -> dict:
+    # no-cache: браузер хранит страницу, но каждый раз перепроверяет её по ETag
+    return {"ETag": etag, "Last-Modified": formatdate(last_modified, usegmt=True), "Cache-Control": "private, no-cache"}
+
+def not_modified(request: Request, etag: str, last_modified: int):
+    """Ответ 304, если у клиента актуальная версия страницы, иначе None."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        if "*" in tags or etag in tags or etag[2:] in tags:
+            return Response(status_code=304, headers=cache_headers(etag, last_modified))
+        return None
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return None
+        # Секунда last_modified должна закончиться: изменение в ту же секунду иначе потерялось бы
+        if last_modified <= since and last_modified < int(time.time()):
+            return Response(status_code=304, headers=cache_headers(etag, last_modified))
+    return None
+
+def page_validators(request: Request, employee: dict, page: str, *parts, sequences=("tickets", "global")):
+    """ETag и Last-Modified страницы по счётчикам изменений из sequences — один дешёвый запрос
+    вместо выборки и рендеринга. Страница зависит и от сотрудника (шапка), и от строки запроса."""
+    conn = get_db_connection(readonly=True)
+    try:
+        values = fetch_sequences(conn.cursor())
+    finally:
+        conn.close()
+    used = [values.get(name, (0, 0)) for name in sequences]
+    etag = make_etag(page, TEMPLATES_VERSION, employee["telegram_id"], employee["is_admin"],
+                     request.url.query, *(value for value, _ in used), *parts)
+    # Last-Modified по всем счётчикам: у тикета нет своего времени изменения, поэтому берём с запасом
+    return etag, max((updated_at for _, updated_at in values.values()), default=0)
+
+def fetch_dashboard_tickets(cursor, since: int = None) -> list:
+    """Карточки тикетов для дашборда: все открытые или (при since) все изменённые после версии since,
+    включая закрытые — клиенту нужно их убрать."""
+    if since is None:
+        where, params = "t.status = 'open'", ()
+    else:
+        where, params = "t.version > ?", (since,)
+    cursor.execute(f"""
+        SELECT t.ticket_id, t.telegram_id, t.status, t.version, e.login,
+            m.text AS last_message, m.timestamp AS last_message_timestamp,
+            m.message_id,
+            t.issue_type, t.assigned_to, e2.login AS assigned_login,
+            t.auto_close_enabled, t.notification_enabled
+        FROM tickets t
+        JOIN employees e ON t.telegram_id = e.telegram_id
+        LEFT JOIN messages m ON m.message_id = (
+            SELECT message_id FROM messages
+            WHERE ticket_id = t.ticket_id
+            ORDER BY timestamp DESC, message_id DESC
+            LIMIT 1
+        )
+        LEFT JOIN employees e2 ON t.assigned_to = e2.telegram_id
+        WHERE {where}
+    """, params)
+    rows = cursor.fetchall()
+
+    # Вложения последних сообщений одним запросом вместо запроса на каждый тикет
+    attachments = defaultdict(list)
+    message_ids = [row["message_id"] for row in rows if row["message_id"]]
+    for offset in range(0, len(message_ids), 500):
+        chunk = message_ids[offset:offset + 500]
+        cursor.execute(
+            f"SELECT message_id, file_path, file_name, file_type, thumb_path, width, height FROM attachments WHERE message_id IN ({','.join('?' * len(chunk))})",
+            chunk
+        )
+        for a in cursor.fetchall():
+            attachments[a["message_id"]].append({
+                "file_path": a["file_path"], "file_name": a["file_name"], "file_type": a["file_type"],
+                "thumb_path": a["thumb_path"], "width": a["width"], "height": a["height"],
+            })
+
+    return [
+        {
+            "ticket_id": row["ticket_id"],
+            "telegram_id": row["telegram_id"],
+            "status": row["status"],
+            "version": row["version"],
+            "login": row["login"],
+            "last_message": row["last_message"],
+            "last_message_timestamp": datetime.fromisoformat(row["last_message_timestamp"]).astimezone(astana_tz).strftime('%Y-%m-%d %H:%M:%S') if row["last_message_timestamp"] else None,
+            "issue_type": row["issue_type"],
+            "assigned_to": row["assigned_to"],
+            "assigned_login": row["assigned_login"],
+            "attachments": attachments.get(row["message_id"], []),
+            "auto_close_enabled": row["auto_close_enabled"],
+            "notification_enabled": row["notification_enabled"]
+        }
+        for row in rows
+    ]
+
+@app.get("/api/tickets/open")
+async def api_open_tickets(since: int = Query(None, ge=0), employee: dict = Depends(get_current_user)):
+    """Открытые тикеты в JSON. С since — только изменённые после этой версии: открытые в tickets,
+    закрытые/удалённые из выборки — в removed. Клиент запоминает version и передаёт её в следующий раз."""
+    conn = get_db_connection(readonly=True)
+    cursor = conn.cursor()
+    try:
+        # Версию читаем до выборки: изменения между запросами попадут в следующую синхронизацию
+        version = tickets_version(cursor)
+        changed = fetch_dashboard_tickets(cursor, since)
+    finally:
+        conn.close()
+    tickets = [ticket for ticket in changed if ticket["status"] == "open"]
+    removed = [ticket["ticket_id"] for ticket in changed if ticket["status"] != "open"]
+    return {"version": version, "full": since is None, "tickets": tickets, "removed": removed}
+
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request, employee: dict = Depends(get_current_user)):
     logging.debug("Запрос к главной странице /")
+    etag, last_modified = page_validators(request, employee, "index")
+    cached = not_modified(request, etag, last_modified)
+    if cached:
+        return cached
     async with db_lock:
         try:
             with get_db_connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT t.ticket_id, t.telegram_id, e.login, 
-                        m.text AS last_message, m.timestamp AS last_message_timestamp,
-                        m.message_id,
-                        t.issue_type, t.assigned_to, e2.login AS assigned_login,
-                        t.auto_close_enabled, t.notification_enabled
-                    FROM tickets t 
-                    JOIN employees e ON t.telegram_id = e.telegram_id 
-                    LEFT JOIN (
-                        SELECT ticket_id, text, timestamp, message_id, is_from_bot, employee_telegram_id
-                        FROM messages
-                        WHERE (ticket_id, timestamp) IN (
-                            SELECT ticket_id, MAX(timestamp)
-                            FROM messages
-                            GROUP BY ticket_id
-                        )
-                    ) m ON t.ticket_id = m.ticket_id
-                    LEFT JOIN employees e3 ON m.employee_telegram_id = e3.telegram_id
-                    LEFT JOIN employees e2 ON t.assigned_to = e2.telegram_id
-                    WHERE t.status = 'open'
-                """)
-                astana_tz = pytz.timezone('Asia/Almaty')
-                tickets = []
-                for row in cursor.fetchall():
-                    attachments = []
-                    if row["message_id"]:
-                        try:
-                            cursor.execute(
-                                "SELECT file_path, file_name, file_type FROM attachments WHERE message_id = ?",
-                                (row["message_id"],)
-                            )
-                            attachments = [{"file_path": a["file_path"], "file_name": a["file_name"], "file_type": a["file_type"]} for a in cursor.fetchall()]
-                        except Exception as e:
-                            logging.error(f"Ошибка при получении attachments для message_id={row['message_id']}: {e}")
-                    tickets.append({
-                        "id": row["ticket_id"],
-                        "telegram_id": row["telegram_id"],
-                        "login": row["login"],
-                        "last_message": row["last_message"],
-                        "last_message_timestamp": datetime.fromisoformat(row["last_message_timestamp"]).astimezone(astana_tz).strftime('%Y-%m-%d %H:%M:%S') if row["last_message_timestamp"] else None,
-                        "issue_type": row["issue_type"],
-                        "assigned_to": row["assigned_to"],
-                        "assigned_login": row["assigned_login"],
-                        "attachments": attachments,
-                        "auto_close_enabled": row["auto_close_enabled"],
-                        "notification_enabled": row["notification_enabled"]
-                    })
-                logging.debug(f"Получено тикетов: {len(tickets)}, пример: {tickets[:1]}")
+                version = tickets_version(cursor)
+                tickets = fetch_dashboard_tickets(cursor)
+                logging.debug("Получено тикетов: %s, пример: %s", len(tickets), tickets[:1])
         except Exception as e:
             logging.error(f"Ошибка в обработке SQL для /: {e}", exc_info=True)
             raise HTTPException(status_code=500, detail=f"Internal Server Error: SQL Error {str(e)}")
@@ -486,10 +901,12 @@ async def index(request: Request, employee: dict = Depends(get_current_user)):
         response = templates.TemplateResponse("index.html", {
             "request": request,
             "tickets": tickets,
+            "tickets_version": version,
             "employee": employee,
             "settings": settings,
             "BASE_URL": BASE_URL
         })
+        response.headers.update(cache_headers(etag, last_modified))
         logging.debug("Шаблон index.html успешно отрендерен")
         return response
     except Exception as e:
@@ -511,6 +928,19 @@ async def save_settings(
     if not employee["is_admin"]:
         raise HTTPException(status_code=403, detail="Not authorized")
     
+    # Часы отдельных дней недели: пара полей day_start_N/day_end_N, пустые — общие часы
+    form = await request.form()
+    weekday_hours = {}
+    try:
+        schedule.parse_minutes(working_hours_start)
+        schedule.parse_minutes(working_hours_end)
+        for day in range(7):
+            start, end = form.get(f"day_start_{day}"), form.get(f"day_end_{day}")
+            if start and end:
+                weekday_hours[day] = (schedule.parse_minutes(start), schedule.parse_minutes(end))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
     try:
         update_setting("registration_greeting", registration_greeting)
         update_setting("new_ticket_response", new_ticket_response)
@@ -519,6 +949,8 @@ async def save_settings(
         update_setting("working_hours_start", working_hours_start)
         update_setting("working_hours_end", working_hours_end)
         update_setting("weekend_days", ",".join(weekend_days or ["0", "6"]))
+        update_setting("weekday_hours", schedule.format_weekday_hours(weekday_hours))
+        schedule.reload()
         logging.debug("Настройки сохранены")
         return RedirectResponse(url="/", status_code=303)
     except Exception as e:
@@ -527,7 +959,7 @@ async def save_settings(
 
 @app.post("/reset_settings")
 async def reset_settings(request: Request, employee: dict = Depends(get_current_user)):
-    logging.debug(f"Получен запрос на /reset_settings от telegram_id={employee['telegram_id']}")
+    logging.debug("Получен запрос на /reset_settings от telegram_id=%s", employee['telegram_id'])
     if not employee["is_admin"]:
         logging.error(f"Пользователь telegram_id={employee['telegram_id']} не является администратором")
         raise HTTPException(status_code=403, detail="Not authorized")
@@ -540,6 +972,7 @@ async def reset_settings(request: Request, employee: dict = Depends(get_current_
             ('working_hours_start', '12:00'),
             ('working_hours_end', '23:59'),
             ('weekend_days', '5,6'),
+            ('weekday_hours', ''),
             ('is_holiday', '0')
         ]
         conn = get_db_connection()
@@ -547,12 +980,13 @@ async def reset_settings(request: Request, employee: dict = Depends(get_current_
         for key, value in default_settings:
             try:
                 cursor.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
-                logging.debug(f"Сброшена настройка {key}: {value}")
+                logging.debug("Сброшена настройка %s: %s", key, value)
             except Exception as e:
                 logging.error(f"Ошибка при сбросе настройки {key}: {e}")
                 raise
         conn.commit()
         conn.close()
+        schedule.reload()
         logging.debug("Настройки сброшены до значений по умолчанию")
         return RedirectResponse(url="/settings", status_code=303)
     except Exception as e:
@@ -573,57 +1007,96 @@ async def update_holiday(
         if is_holiday not in ["0", "1"]:
             raise HTTPException(status_code=400, detail="Invalid is_holiday value")
         update_setting("is_holiday", is_holiday)
-        logging.debug(f"Статус праздника обновлен: {is_holiday}")
+        schedule.reload()
+        logging.debug("Статус праздника обновлен: %s", is_holiday)
         return {"status": "ok"}
     except Exception as e:
         logging.error(f"Ошибка при обновлении статуса праздника: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/ticket/{ticket_id}", response_class=HTMLResponse)
-async def ticket(request: Request, ticket_id: int, employee: dict = Depends(get_current_user)):
-    logging.debug(f"Запрос к тикету #{ticket_id}")
+@app.post("/holidays")
+async def add_holiday(
+    request: Request,
+    start_date: str = Form(...),
+    end_date: str = Form(None),
+    name: str = Form(None),
+    message: str = Form(None),
+    employee: dict = Depends(get_current_user)
+):
+    if not employee["is_admin"]:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    try:
+        start = datetime.strptime(start_date, "%Y-%m-%d").date()
+        end = datetime.strptime(end_date, "%Y-%m-%d").date() if end_date else start
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date")
+    if end < start:
+        raise HTTPException(status_code=400, detail="end_date is before start_date")
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT telegram_id, issue_type, assigned_to, auto_close_enabled, auto_close_time, notification_enabled FROM tickets WHERE ticket_id = ?",
-        (ticket_id,)
+    conn.execute(
+        "INSERT INTO holidays (start_date, end_date, name, message) VALUES (?, ?, ?, ?)",
+        (start.isoformat(), end.isoformat(), name or None, message or None)
     )
-    ticket_data = cursor.fetchone()
-    if not ticket_data:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Ticket not found")
-    telegram_id = ticket_data["telegram_id"]
-    issue_type = ticket_data["issue_type"]
-    assigned_to = ticket_data["assigned_to"]
-    auto_close_enabled = ticket_data["auto_close_enabled"] 
-    auto_close_time = ticket_data["auto_close_time"]       
-    notification_enabled = ticket_data["notification_enabled"]
+    conn.commit()
+    conn.close()
+    # Диапазон мог начаться сегодня: границу применяем сразу, не дожидаясь полуночи
+    if start <= datetime.now(schedule.TIMEZONE).date() <= end:
+        update_setting("is_holiday", "1")
+    schedule.reload()
+    logging.debug("Добавлен праздник %s — %s: %s", start, end, name)
+    return RedirectResponse(url="/settings", status_code=303)
+
+@app.post("/holidays/{holiday_id}/delete")
+async def delete_holiday(request: Request, holiday_id: int, employee: dict = Depends(get_current_user)):
+    if not employee["is_admin"]:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    today = datetime.now(schedule.TIMEZONE).date().isoformat()
+    conn = get_db_connection()
+    covered_today = conn.execute(
+        "SELECT 1 FROM holidays WHERE id = ? AND start_date <= ? AND end_date >= ?", (holiday_id, today, today)
+    ).fetchone()
+    conn.execute("DELETE FROM holidays WHERE id = ?", (holiday_id,))
+    # Зеркально add_holiday: HolidayScheduler сам флаг не снимет — вчера и сегодня для него уже не праздники
+    if covered_today and not conn.execute(
+        "SELECT 1 FROM holidays WHERE start_date <= ? AND end_date >= ?", (today, today)
+    ).fetchone():
+        conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('is_holiday', '0')")
+    conn.commit()
+    conn.close()
+    schedule.reload()
+    logging.debug("Удалён праздник id=%s", holiday_id)
+    return RedirectResponse(url="/settings", status_code=303)
 
+def fetch_ticket_messages(cursor, ticket_id: int, before_id: int = None, limit: int = TICKET_PAGE_SIZE):
+    """Последние limit сообщений тикета (старше before_id, если задан) по возрастанию времени.
 
-    if not assigned_to:
-        cursor.execute("UPDATE tickets SET assigned_to = ? WHERE ticket_id = ?", (employee["telegram_id"], ticket_id))
-        conn.commit()
-        assigned_to = employee["telegram_id"]
-        await sio.emit("ticket_assigned", {
-            "ticket_id": ticket_id,
-            "assigned_to": employee["telegram_id"],
-            "assigned_login": employee["login"]
-        })
-
-    cursor.execute("""
+    Пагинация по ключу (timestamp, message_id): страница берётся из индекса
+    idx_messages_ticket_timestamp без OFFSET, вложения подтягиваются только для неё.
+    Возвращает (сообщения, есть ли ещё более старые).
+    """
+    keyset = ""
+    params = [ticket_id]
+    if before_id is not None:
+        keyset = "AND (timestamp, message_id) < (SELECT timestamp, message_id FROM messages WHERE message_id = ?)"
+        params.append(before_id)
+    params.append(limit + 1)
+    cursor.execute(f"""
         SELECT m.message_id, m.ticket_id, m.telegram_id, m.text, m.is_from_bot, m.timestamp,
-            CASE WHEN m.is_from_bot THEN COALESCE(e2.login, 'Техподдержка') ELSE e.login END AS login,
-            a.file_path, a.file_name, a.file_type
-        FROM messages m
-        JOIN employees e ON m.telegram_id = e.telegram_id
+            CASE WHEN m.is_from_bot THEN COALESCE(e2.login, 'Техподдержка') ELSE COALESCE(e.login, 'Unknown') END AS login,
+            a.file_path, a.file_name, a.file_type, a.thumb_path, a.width, a.height
+        FROM (
+            SELECT * FROM messages
+            WHERE ticket_id = ? {keyset}
+            ORDER BY timestamp DESC, message_id DESC
+            LIMIT ?
+        ) m
+        -- LEFT: сообщение без строки отправителя не должно выпадать из страницы и из подсчёта has_more
+        LEFT JOIN employees e ON m.telegram_id = e.telegram_id
         LEFT JOIN employees e2 ON m.employee_telegram_id = e2.telegram_id
         LEFT JOIN attachments a ON m.message_id = a.message_id
-        WHERE m.ticket_id = ?
-        ORDER BY m.timestamp
-    """, (ticket_id,))
-
+        ORDER BY m.timestamp, m.message_id
+    """, params)
     rows = cursor.fetchall()
-    astana_tz = pytz.timezone('Asia/Almaty')
 
     messages_dict = {}
     for row in rows:
@@ -643,10 +1116,79 @@ async def ticket(request: Request, ticket_id: int, employee: dict = Depends(get_
             messages_dict[msg_id]["attachments"].append({
                 "file_path": row[7],
                 "file_name": row[8],
-                "file_type": row[9]
+                "file_type": row[9],
+                "thumb_path": row[10],
+                "width": row[11],
+                "height": row[12]
             })
 
     messages = list(messages_dict.values())
+    # Лишняя (limit + 1)-я строка — самая старая, она только сигнализирует о следующей странице
+    has_more = len(messages) > limit
+    return messages[-limit:], has_more
+
+@app.get("/ticket/{ticket_id}/messages")
+async def ticket_messages(
+    ticket_id: int,
+    before: int = Query(None),
+    limit: int = Query(TICKET_PAGE_SIZE, ge=1, le=200),
+    employee: dict = Depends(get_current_user)
+):
+    conn = get_db_connection(readonly=True)
+    cursor = conn.cursor()
+    try:
+        messages, has_more = fetch_ticket_messages(cursor, ticket_id, before, limit)
+    finally:
+        conn.close()
+    return {"messages": messages, "has_more": has_more}
+
+@app.get("/ticket/{ticket_id}", response_class=HTMLResponse)
+async def ticket(request: Request, ticket_id: int, employee: dict = Depends(get_current_user)):
+    logging.debug("Запрос к тикету #%s", ticket_id)
+    # Страница только читает: назначение на себя — отдельный POST /ticket/{id}/claim
+    conn = get_db_connection(readonly=True)
+    cursor = conn.cursor()
+    # Проверка кэша: версия тикета и состояние мута/бана автора (истечение срока не пишет в базу)
+    cursor.execute("""
+        SELECT t.version,
+            (SELECT end_time FROM mutes WHERE user_id = t.telegram_id) AS mute_end,
+            (SELECT end_time FROM bans WHERE user_id = t.telegram_id) AS ban_end,
+            EXISTS (SELECT 1 FROM bans WHERE user_id = t.telegram_id) AS has_ban
+        FROM tickets t WHERE t.ticket_id = ?
+    """, (ticket_id,))
+    state = cursor.fetchone()
+    if state:
+        now = datetime.now()
+        muted = bool(state["mute_end"]) and datetime.fromisoformat(state["mute_end"]) > now
+        banned = bool(state["has_ban"]) and (state["ban_end"] is None or datetime.fromisoformat(state["ban_end"]) > now)
+        # От остальных тикетов страница не зависит — только своя версия и счётчик global
+        etag, last_modified = page_validators(request, employee, "ticket", ticket_id, state["version"], muted, banned,
+                                              sequences=("global",))
+        # Истёкший мут/бан меняет страницу в момент окончания
+        for end in (state["mute_end"], state["ban_end"]):
+            if end and datetime.fromisoformat(end) <= now:
+                last_modified = max(last_modified, int(datetime.fromisoformat(end).timestamp()))
+        cached = not_modified(request, etag, last_modified)
+        if cached:
+            conn.close()
+            return cached
+    cursor.execute(
+        "SELECT telegram_id, issue_type, assigned_to, auto_close_enabled, auto_close_time, notification_enabled FROM tickets WHERE ticket_id = ?",
+        (ticket_id,)
+    )
+    ticket_data = cursor.fetchone()
+    if not ticket_data:
+        conn.close()
+        raise HTTPException(status_code=404, detail="Ticket not found")
+    telegram_id = ticket_data["telegram_id"]
+    issue_type = ticket_data["issue_type"]
+    assigned_to = ticket_data["assigned_to"]
+    auto_close_enabled = ticket_data["auto_close_enabled"] 
+    auto_close_time = ticket_data["auto_close_time"]       
+    notification_enabled = ticket_data["notification_enabled"]
+
+    messages, has_more_messages = fetch_ticket_messages(cursor, ticket_id)
+    astana_tz = pytz.timezone('Asia/Almaty')
     
     # Обработка переносов строк: заменяем \n на <br> для корректного отображения в HTML
     from html import escape as html_escape
@@ -721,6 +1263,7 @@ async def ticket(request: Request, ticket_id: int, employee: dict = Depends(get_
             "request": request,
             "ticket_id": ticket_id,
             "messages": messages,
+            "has_more_messages": has_more_messages,
             "admin_messages": admin_messages,
             "telegram_id": telegram_id,
             "login": login,
@@ -739,7 +1282,8 @@ async def ticket(request: Request, ticket_id: int, employee: dict = Depends(get_
             "notification_enabled": notification_enabled,     
             "from_history": request.query_params.get("from_history", "false") == "true",
             "shorten_filename": shorten_filename  # Добавляем функцию в контекст
-        }
+        },
+        headers=cache_headers(etag, last_modified)
     )
 
 @app.post("/add_quick_reply")
@@ -777,7 +1321,7 @@ async def add_quick_reply(
             "color": color
         }
         await sio.emit("quick_reply_added", quick_reply)
-        logging.debug(f"Добавлен быстрый ответ: {quick_reply}")
+        logging.debug("Добавлен быстрый ответ: %s", quick_reply)
         return {"status": "ok", "quick_reply": quick_reply}
     except Exception as e:
         logging.error(f"Ошибка при добавлении быстрого ответа: {e}")
@@ -803,7 +1347,7 @@ async def delete_quick_reply(
         conn.close()
         
         await sio.emit("quick_reply_deleted", {"id": quick_reply_id})
-        logging.debug(f"Удалён быстрый ответ: id={quick_reply_id}")
+        logging.debug("Удалён быстрый ответ: id=%s", quick_reply_id)
         return {"status": "ok"}
     except Exception as e:
         logging.error(f"Ошибка при удалении быстрого ответа: {e}")
@@ -821,7 +1365,7 @@ async def send_employee_message(
     
     try:
         await bot.send_message(chat_id=telegram_id, text=text)
-        logging.debug(f"Сообщение отправлено в ЛС сотруднику {telegram_id}: {text}")
+        logging.debug("Сообщение отправлено в ЛС сотруднику %s: %s", telegram_id, text)
         return {"status": "ok"}
     except Exception as e:
         logging.error(f"Ошибка отправки сообщения в ЛС {telegram_id}: {e}")
@@ -854,7 +1398,7 @@ async def toggle_admin_status(
             "telegram_id": telegram_id,
             "is_admin": new_status
         })
-        logging.debug(f"Статус техподдержки для {telegram_id} изменён на {new_status}")
+        logging.debug("Статус техподдержки для %s изменён на %s", telegram_id, new_status)
         return {"status": "ok", "is_admin": new_status}
     except Exception as e:
         logging.error(f"Ошибка при изменении статуса техподдержки для {telegram_id}: {e}")
@@ -877,10 +1421,8 @@ async def send_message(
         if files is None:
             files = []                                     # <-- фикс
         logging.debug(
-            f"Отправка сообщения: ticket_id={ticket_id}, "
-            f"telegram_id={telegram_id}, text={text}, "
-            f"files={[f.filename for f in files] if files else None}, "
-            f"issue_type={issue_type}"
+            "Отправка сообщения: ticket_id=%s, telegram_id=%s, text=%s, files=%s, issue_type=%s",
+            ticket_id, telegram_id, text, [f.filename for f in files] if files else None, issue_type
         )
 
         # ------------------------------------------------------------------
@@ -920,7 +1462,7 @@ async def send_message(
             if not file or not file.filename:
                 continue
 
-            logging.debug(f"Получен файл: {file.filename}, тип: {file.content_type}")
+            logging.debug("Получен файл: %s, тип: %s", file.filename, file.content_type)
 
             # ----- определение типа ------------------------------------
             extensions_image = {'.png', '.jpg', '.jpeg', '.gif', '.webp', '.bmp', '.svg'}
@@ -949,15 +1491,19 @@ async def send_message(
 
                 cursor.execute(
                     """INSERT INTO attachments
-                       (message_id, file_path, file_name, file_type)
-                       VALUES (?, ?, ?, ?)""",
-                    (message_id, file_path, file_name, file_type)
+                       (message_id, file_path, file_name, file_type, original_name)
+                       VALUES (?, ?, ?, ?, ?)""",
+                    (message_id, file_path, file_name, file_type, file.filename)
                 )
 
+                # Миниатюру для изображения допишет очередь отправки, см. thumbnails.store_sent
                 attachments.append({
                     "file_path": file_path,
                     "file_name": file_name,
-                    "file_type": file_type
+                    "file_type": file_type,
+                    "thumb_path": None,
+                    "width": None,
+                    "height": None
                 })
                 file_paths.append({"path": file_path, "type": file_type})
 
@@ -989,7 +1535,7 @@ async def send_message(
         # ------------------------------------------------------------------
         conn.commit()
         conn.close()
-        logging.debug(f"Сообщение сохранено: ticket_id={ticket_id}")
+        logging.debug("Сообщение сохранено: ticket_id=%s", ticket_id)
 
         # ------------------------------------------------------------------
         # 7. Проверка event-loop
@@ -1008,8 +1554,8 @@ async def send_message(
         if file_paths:
             queue_data["files"] = file_paths
 
-        logging.debug(f"В очередь: {queue_data}")
-        await message_queue.put(queue_data)
+        logging.debug("В очередь: %s", queue_data)
+        await message_queue.put(tracing.inject(queue_data))
 
         # ------------------------------------------------------------------
         # 9. SocketIO-уведомление в веб-клиент
@@ -1044,7 +1590,7 @@ async def delete_message(
         raise HTTPException(status_code=403, detail="Not authorized")
 
     try:
-        logging.debug(f"Удаление сообщения: message_id={message_id}, ticket_id={ticket_id}")
+        logging.debug("Удаление сообщения: message_id=%s, ticket_id=%s", message_id, ticket_id)
         conn = get_db_connection()
         cursor = conn.cursor()
         
@@ -1069,18 +1615,20 @@ async def delete_message(
                     chat_id=message["telegram_id"],
                     message_id=message["telegram_message_id"]
                 )
-                logging.debug(f"Сообщение telegram_message_id={message['telegram_message_id']} удалено в Telegram")
+                logging.debug("Сообщение telegram_message_id=%s удалено в Telegram", message['telegram_message_id'])
             except Exception as e:
                 logging.warning(f"Не удалось удалить сообщение в Telegram: {e}")
 
-        cursor.execute("SELECT file_path FROM attachments WHERE message_id = ?", (message_id,))
-        attachment = cursor.fetchone()
-        if attachment and os.path.exists(attachment["file_path"]):
-            try:
-                os.remove(attachment["file_path"])
-                logging.debug(f"Файл {attachment['file_path']} удалён")
-            except Exception as e:
-                logging.error(f"Ошибка удаления файла {attachment['file_path']}: {e}")
+        cursor.execute("SELECT file_path, thumb_path FROM attachments WHERE message_id = ?", (message_id,))
+        for attachment in cursor.fetchall():
+            for path in (attachment["file_path"], attachment["thumb_path"]):
+                if not path or not os.path.exists(path):
+                    continue
+                try:
+                    os.remove(path)
+                    logging.debug("Файл %s удалён", path)
+                except Exception as e:
+                    logging.error(f"Ошибка удаления файла {path}: {e}")
 
         cursor.execute("DELETE FROM attachments WHERE message_id = ?", (message_id,))
         cursor.execute("DELETE FROM messages WHERE message_id = ?", (message_id,))
@@ -1091,13 +1639,13 @@ async def delete_message(
         
         conn.commit()
         conn.close()
-        logging.debug(f"Сообщение message_id={message_id} удалено из базы")
+        logging.debug("Сообщение message_id=%s удалено из базы", message_id)
 
         await sio.emit("message_deleted", {
             "ticket_id": ticket_id,
             "message_id": message_id
         })
-        logging.debug(f"Событие message_deleted отправлено для message_id={message_id}")
+        logging.debug("Событие message_deleted отправлено для message_id=%s", message_id)
 
         return {"status": "ok"}
     except Exception as e:
@@ -1117,7 +1665,7 @@ async def edit_message(
         raise HTTPException(status_code=403, detail="Not authorized")
 
     try:
-        logging.debug(f"Редактирование сообщения: message_id={message_id}, ticket_id={ticket_id}, new_text={text}")
+        logging.debug("Редактирование сообщения: message_id=%s, ticket_id=%s, new_text=%s", message_id, ticket_id, text)
         conn = get_db_connection()
         cursor = conn.cursor()
         
@@ -1138,7 +1686,7 @@ async def edit_message(
         
         # Загружаем вложения для сообщения
         cursor.execute(
-            "SELECT file_path, file_name, file_type FROM attachments WHERE message_id = ?",
+            "SELECT file_path, file_name, file_type, thumb_path, width, height FROM attachments WHERE message_id = ?",
             (message_id,)
         )
         attachments = cursor.fetchall()
@@ -1155,7 +1703,7 @@ async def edit_message(
         
         conn.commit()
         conn.close()
-        logging.debug(f"Сообщение message_id={message_id} отредактировано в базе")
+        logging.debug("Сообщение message_id=%s отредактировано в базе", message_id)
 
         if loop is None:
             logging.error("Цикл событий не инициализирован")
@@ -1167,9 +1715,9 @@ async def edit_message(
             "message_id": message_id,
             "telegram_message_id": message["telegram_message_id"]
         }
-        logging.debug(f"Добавляем отредактированное сообщение в очередь: {queue_data}")
-        await message_queue.put(queue_data)
-        logging.debug(f"Отредактированное сообщение добавлено в очередь")
+        logging.debug("Добавляем отредактированное сообщение в очередь: %s", queue_data)
+        await message_queue.put(tracing.inject(queue_data))
+        logging.debug("Отредактированное сообщение добавлено в очередь")
 
         await sio.emit("message_edited", {
             "ticket_id": ticket_id,
@@ -1181,7 +1729,7 @@ async def edit_message(
             "is_from_bot": True,
             "attachments": attachments_list
         })
-        logging.debug(f"Событие message_edited отправлено для message_id={message_id}")
+        logging.debug("Событие message_edited отправлено для message_id=%s", message_id)
 
         return {"status": "ok"}
     except Exception as e:
@@ -1196,7 +1744,7 @@ async def send_admin_message(
     employee: dict = Depends(get_current_user)
 ):
     try:
-        logging.debug(f"Отправка сообщения в админ-чат: ticket_id={ticket_id}, text={text}")
+        logging.debug("Отправка сообщения в админ-чат: ticket_id=%s, text=%s", ticket_id, text)
         conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT telegram_id FROM tickets WHERE ticket_id = ?", (ticket_id,))
@@ -1215,7 +1763,7 @@ async def send_admin_message(
         )
         conn.commit()
         conn.close()
-        logging.debug(f"Сообщение в админ-чат сохранено: ticket_id={ticket_id}")
+        logging.debug("Сообщение в админ-чат сохранено: ticket_id=%s", ticket_id)
 
         await sio.emit("new_admin_message", {
             "ticket_id": ticket_id,
@@ -1234,7 +1782,7 @@ async def send_admin_message(
 @app.post("/close_ticket")
 async def close_ticket(request: Request, ticket_id: int = Form(...), employee: dict = Depends(get_current_user)):
     try:
-        logging.debug(f"Закрытие тикета #{ticket_id}")
+        logging.debug("Закрытие тикета #%s", ticket_id)
         conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT telegram_id FROM tickets WHERE ticket_id = ?", (ticket_id,))
@@ -1253,7 +1801,7 @@ async def close_ticket(request: Request, ticket_id: int = Form(...), employee: d
         cursor.execute("DELETE FROM employee_ratings WHERE ticket_id = ?", (ticket_id,))
         conn.commit()
         conn.close()
-        logging.debug(f"Тикет #{ticket_id} закрыт")
+        logging.debug("Тикет #%s закрыт", ticket_id)
 
         queue_data = {
             "telegram_id": telegram_id,
@@ -1261,18 +1809,49 @@ async def close_ticket(request: Request, ticket_id: int = Form(...), employee: d
             "message_id": None,
             "ticket_id": ticket_id
         }
-        logging.debug(f"Добавляем уведомление о закрытии в очередь: {queue_data}")
-        await message_queue.put(queue_data)
-        logging.debug(f"Уведомление о закрытии добавлено в очередь")
+        logging.debug("Добавляем уведомление о закрытии в очередь: %s", queue_data)
+        await message_queue.put(tracing.inject(queue_data))
+        logging.debug("Уведомление о закрытии добавлено в очередь")
 
         await sio.emit("ticket_closed", {"ticket_id": ticket_id})
-        logging.debug(f"Событие ticket_closed отправлено для ticket_id={ticket_id}")
+        logging.debug("Событие ticket_closed отправлено для ticket_id=%s", ticket_id)
 
         return {"status": "ok"}
     except Exception as e:
         logging.error(f"Ошибка при закрытии тикета: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/ticket/{ticket_id}/claim")
+async def claim_ticket(ticket_id: int, employee: dict = Depends(get_current_user)):
+    """Взять тикет себе, если он ещё никому не назначен (compare-and-set, без гонки двух операторов)."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "UPDATE tickets SET assigned_to = ? WHERE ticket_id = ? AND assigned_to IS NULL",
+        (employee["telegram_id"], ticket_id)
+    )
+    claimed = cursor.rowcount == 1
+    conn.commit()
+    if claimed:
+        conn.close()
+        logging.debug("Тикет #%s взят сотрудником %s", ticket_id, employee["login"])
+        await sio.emit("ticket_assigned", {
+            "ticket_id": ticket_id,
+            "assigned_to": employee["telegram_id"],
+            "assigned_login": employee["login"]
+        })
+        return {"status": "ok", "claimed": True, "assigned_to": employee["telegram_id"], "assigned_login": employee["login"]}
+
+    cursor.execute(
+        "SELECT t.assigned_to, e.login FROM tickets t LEFT JOIN employees e ON t.assigned_to = e.telegram_id WHERE t.ticket_id = ?",
+        (ticket_id,)
+    )
+    row = cursor.fetchone()
+    conn.close()
+    if not row:
+        raise HTTPException(status_code=404, detail="Ticket not found")
+    return {"status": "ok", "claimed": False, "assigned_to": row["assigned_to"], "assigned_login": row["login"]}
+
 @app.post("/assign_ticket")
 async def assign_ticket_endpoint(
     request: Request, 
@@ -1359,7 +1938,7 @@ async def assign_ticket_endpoint(
                     text=history_text,
                     reply_markup=keyboard
                 )
-                logging.debug(f"Персональное уведомление отправлено сотруднику {assigned_to_id} о назначении тикета #{ticket_id}")
+                logging.debug("Персональное уведомление отправлено сотруднику %s о назначении тикета #%s", assigned_to_id, ticket_id)
             except Exception as e:
                 logging.error(f"Ошибка отправки персонального уведомления сотруднику {assigned_to_id}: {e}")
 
@@ -1394,15 +1973,21 @@ async def update_issue_type(
 
 @app.post("/cleanup")
 async def cleanup(request: Request, employee: dict = Depends(get_current_user)):
-    from dateutil.relativedelta import relativedelta
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    astana_tz = pytz.timezone('Asia/Almaty')
-    threshold = (datetime.now(astana_tz) - relativedelta(months=6)).isoformat()
-    cursor.execute("DELETE FROM tickets WHERE status = 'closed' AND created_at < ?", (threshold,))
-    conn.commit()
-    conn.close()
-    return {"status": "ok"}
+    # Старые закрытые тикеты не удаляются, а переносятся пачками в архив, см. archive.py
+    result = await archive.archive_old_tickets()
+    return {"status": "ok", **result}
+
+@app.get("/api/archive/search")
+async def archive_search(query: str = Query(..., min_length=2), limit: int = Query(50, ge=1, le=200),
+                         employee: dict = Depends(get_current_user)):
+    return {"tickets": await asyncio.to_thread(archive.search, query, limit)}
+
+@app.get("/api/archive/ticket/{ticket_id}")
+async def archive_ticket(ticket_id: int, employee: dict = Depends(get_current_user)):
+    ticket = await asyncio.to_thread(archive.ticket, ticket_id)
+    if ticket is None:
+        raise HTTPException(status_code=404, detail="Ticket not found in archive")
+    return ticket
 
 @app.post("/fetch_telegram_history")
 async def fetch_telegram_history(
@@ -1413,7 +1998,7 @@ async def fetch_telegram_history(
     employee: dict = Depends(get_current_user)
 ):
     try:
-        logging.debug(f"Fetching history for ticket_id={ticket_id}, telegram_id={telegram_id}, displayed_ticket_ids={displayed_ticket_ids}")
+        logging.debug("Fetching history for ticket_id=%s, telegram_id=%s, displayed_ticket_ids=%s", ticket_id, telegram_id, displayed_ticket_ids)
         
         conn = get_db_connection()
         cursor = conn.cursor()
@@ -1454,7 +2039,7 @@ async def fetch_telegram_history(
             """
             SELECT m.message_id, m.ticket_id, m.telegram_id, m.text, m.is_from_bot, m.timestamp,
                 CASE WHEN m.is_from_bot THEN COALESCE(e2.login, 'Техподдержка') ELSE e.login END AS login,
-                a.file_path, a.file_name, a.file_type
+                a.file_path, a.file_name, a.file_type, a.thumb_path, a.width, a.height
             FROM messages m
             JOIN employees e ON m.telegram_id = e.telegram_id
             LEFT JOIN employees e2 ON m.employee_telegram_id = e2.telegram_id
@@ -1487,7 +2072,10 @@ async def fetch_telegram_history(
                 messages_dict[msg_id]["attachments"].append({
                     "file_path": row[7],
                     "file_name": row[8],
-                    "file_type": row[9]
+                    "file_type": row[9],
+                    "thumb_path": row[10],
+                    "width": row[11],
+                    "height": row[12]
                 })
 
         messages = list(messages_dict.values())
@@ -1496,9 +2084,9 @@ async def fetch_telegram_history(
 
         for msg in messages:
             await sio.emit("new_message", msg)
-            logging.debug(f"Sent message from ticket #{msg['ticket_id']}: {msg}")
+            logging.debug("Sent message from ticket #%s: %s", msg['ticket_id'], msg)
 
-        logging.debug(f"Fetched history from ticket #{fetched_ticket_id}, sent {len(messages)} messages")
+        logging.debug("Fetched history from ticket #%s, sent %s messages", fetched_ticket_id, len(messages))
         return {"status": "ok", "fetched_ticket_ids": [fetched_ticket_id], "messages_count": len(messages)}
     except Exception as e:
         logging.error(f"Error fetching history: {e}")
@@ -1510,20 +2098,13 @@ async def get_employee_ratings(telegram_id: int, employee: dict = Depends(get_cu
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute(
-            """
-            SELECT 
-                (SELECT COUNT(*) FROM employee_ratings WHERE employee_id = ? AND rating = 'up') AS thumbs_up,
-                (SELECT COUNT(*) FROM employee_ratings WHERE employee_id = ? AND rating = 'down') AS thumbs_down
-            """,
-            (telegram_id, telegram_id)
-        )
+        cursor.execute("SELECT thumbs_up, thumbs_down FROM employee_stats WHERE employee_id = ?", (telegram_id,))
         ratings = cursor.fetchone()
         conn.close()
         return {
             "status": "ok",
-            "thumbs_up": ratings["thumbs_up"],
-            "thumbs_down": ratings["thumbs_down"]
+            "thumbs_up": ratings["thumbs_up"] if ratings else 0,
+            "thumbs_down": ratings["thumbs_down"] if ratings else 0
         }
     except Exception as e:
         logging.error(f"Error fetching ratings for employee {telegram_id}: {e}")
@@ -1565,6 +2146,68 @@ async def admin_employees(request: Request, employee: dict = Depends(get_current
     await asyncio.gather(*[update_full_name(emp) for emp in employees])
     return templates.TemplateResponse("admin_employees.html", {"request": request, "employees": employees, "employee": employee})
 
+@app.get("/admin/queries", response_class=HTMLResponse)
+async def admin_queries(request: Request, employee: dict = Depends(get_current_user)):
+    if not employee["is_admin"]:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    return templates.TemplateResponse("admin_queries.html", {
+        "request": request,
+        "employee": employee,
+        "queries": db.PROFILER.top(100),
+        "enabled": db.PROFILER.enabled,
+        "slow_ms": db.PROFILER.slow_ms,
+        "since": datetime.fromtimestamp(db.PROFILER.started_at, astana_tz).strftime("%d.%m.%Y %H:%M:%S"),
+    })
+
+@app.post("/admin/queries/toggle")
+async def toggle_query_profiler(request: Request, employee: dict = Depends(get_current_user)):
+    if not employee["is_admin"]:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    db.PROFILER.enabled = not db.PROFILER.enabled
+    logging.info("Профилировщик запросов %s (%s)", "включён" if db.PROFILER.enabled else "выключен", employee["login"])
+    return RedirectResponse(url="/admin/queries", status_code=303)
+
+@app.post("/admin/queries/reset")
+async def reset_query_profiler(request: Request, employee: dict = Depends(get_current_user)):
+    if not employee["is_admin"]:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    db.PROFILER.reset()
+    return RedirectResponse(url="/admin/queries", status_code=303)
+
+@app.post("/admin/gc")
+async def collect_orphans(request: Request, employee: dict = Depends(get_current_user)):
+    if not employee["is_admin"]:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    return await orphans.collect()
+
+@app.post("/admin/maintenance")
+async def run_maintenance(request: Request, employee: dict = Depends(get_current_user)):
+    if not employee["is_admin"]:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    return await maintenance.maintenance_scheduler.run_once()
+
+@app.post("/admin/backup")
+async def create_backup(request: Request, employee: dict = Depends(get_current_user)):
+    if not employee["is_admin"]:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    return await backup.run_backup()
+
+@app.get("/admin/traces", response_class=HTMLResponse)
+async def admin_traces(request: Request, min_ms: float = Query(0), employee: dict = Depends(get_current_user)):
+    if not employee["is_admin"]:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    traces = tracing.recent_traces(100, min_ms)
+    for item in traces:
+        item["started"] = datetime.fromtimestamp(item["start"], astana_tz).strftime("%d.%m.%Y %H:%M:%S")
+    return templates.TemplateResponse("admin_traces.html", {
+        "request": request,
+        "employee": employee,
+        "traces": traces,
+        "min_ms": min_ms,
+        "enabled": tracing.TRACE_ENABLED,
+        "otlp_endpoint": tracing.OTLP_ENDPOINT,
+    })
+
 @app.post("/admin/employees/add")
 async def add_employee(
     request: Request,
@@ -1626,7 +2269,7 @@ async def mute_user(
     cursor.execute("INSERT OR REPLACE INTO mutes (user_id, end_time) VALUES (?, ?)", (telegram_id, end_time))
     conn.commit()
     conn.close()
-    logging.debug(f"Пользователь {telegram_id} замучен на {mute_duration} минут")
+    logging.debug("Пользователь %s замучен на %s минут", telegram_id, mute_duration)
     return {"status": "ok"}
 
 @app.post("/ban_user")
@@ -1646,7 +2289,7 @@ async def ban_user(
     cursor.execute("INSERT OR REPLACE INTO bans (user_id, end_time) VALUES (?, ?)", (telegram_id, end_time))
     conn.commit()
     conn.close()
-    logging.debug(f"Пользователь {telegram_id} забанен на {ban_duration if ban_duration else 'навсегда'} минут")
+    logging.debug("Пользователь %s забанен на %s минут", telegram_id, ban_duration if ban_duration else 'навсегда')
     return {"status": "ok"}
 
 @app.post("/unmute_user")
@@ -1664,7 +2307,7 @@ async def unmute_user(
     cursor.execute("DELETE FROM mutes WHERE user_id = ?", (telegram_id,))
     conn.commit()
     conn.close()
-    logging.debug(f"Мут снят с пользователя {telegram_id}")
+    logging.debug("Мут снят с пользователя %s", telegram_id)
     return {"status": "ok"}
 
 @app.get("/search", response_class=HTMLResponse)
@@ -1676,7 +2319,11 @@ async def search_tickets(
     sort: str = Query("timestamp_desc", description="Sort order: timestamp_desc, timestamp_asc, ticket_id_desc, ticket_id_asc"),
     employee: dict = Depends(get_current_user)
 ):
-    logging.debug(f"Поиск тикетов: query={query}, status={status}, issue_type={issue_type}, sort={sort}")
+    logging.debug("Поиск тикетов: query=%s, status=%s, issue_type=%s, sort=%s", query, status, issue_type, sort)
+    etag, last_modified = page_validators(request, employee, "search")
+    cached = not_modified(request, etag, last_modified)
+    if cached:
+        return cached
     async with db_lock:
         with get_db_connection() as conn:
             cursor = conn.cursor()
@@ -1685,7 +2332,7 @@ async def search_tickets(
             base_query = """
                 SELECT DISTINCT t.ticket_id, t.telegram_id, t.status, e.login,
                        m.text AS last_message, m.timestamp AS last_message_timestamp,
-                       a.file_path, a.file_name, a.file_type,
+                       a.file_path, a.file_name, a.file_type, a.thumb_path,
                        t.issue_type, t.assigned_to, e2.login AS assigned_login
                 FROM tickets t
                 JOIN employees e ON t.telegram_id = e.telegram_id
@@ -1744,6 +2391,7 @@ async def search_tickets(
                     "file_path": row["file_path"],
                     "file_name": row["file_name"],
                     "file_type": row["file_type"],
+                    "thumb_path": row["thumb_path"],
                     "issue_type": row["issue_type"],
                     "assigned_to": row["assigned_to"],
                     "assigned_login": row["assigned_login"]
@@ -1762,7 +2410,8 @@ async def search_tickets(
             "issue_type": issue_type,
             "sort": sort,
             "BASE_URL": BASE_URL
-        }
+        },
+        headers=cache_headers(etag, last_modified)
     )
 
 @app.get("/ticket/{ticket_id}/ratings")
@@ -1771,31 +2420,21 @@ async def get_ticket_ratings(ticket_id: int, employee: dict = Depends(get_curren
     Retrieve the count of thumbs up and thumbs down ratings for a specific ticket.
     """
     try:
-        logging.debug(f"Запрос рейтингов для тикета #{ticket_id}")
+        logging.debug("Запрос рейтингов для тикета #%s", ticket_id)
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        cursor.execute(
-            """
-            SELECT 
-                (SELECT COUNT(*) FROM ticket_ratings WHERE ticket_id = ? AND rating = 'up') AS thumbs_up,
-                (SELECT COUNT(*) FROM ticket_ratings WHERE ticket_id = ? AND rating = 'down') AS thumbs_down
-            """,
-            (ticket_id, ticket_id)
-        )
+        cursor.execute("SELECT thumbs_up, thumbs_down FROM ticket_stats WHERE ticket_id = ?", (ticket_id,))
         ratings = cursor.fetchone()
         
         conn.close()
         
-        if not ratings:
-            logging.error(f"Рейтинги для тикета #{ticket_id} не найдены")
-            raise HTTPException(status_code=404, detail="Ratings not found")
-        
+        # Нет строки — по тикету ещё не было оценок
         return {
             "status": "ok",
             "ticket_id": ticket_id,
-            "thumbs_up": ratings["thumbs_up"],
-            "thumbs_down": ratings["thumbs_down"]
+            "thumbs_up": ratings["thumbs_up"] if ratings else 0,
+            "thumbs_down": ratings["thumbs_down"] if ratings else 0
         }
     except Exception as e:
         logging.error(f"Ошибка при получении рейтингов тикета #{ticket_id}: {e}")
@@ -1816,58 +2455,145 @@ async def unban_user(
     cursor.execute("DELETE FROM bans WHERE user_id = ?", (telegram_id,))
     conn.commit()
     conn.close()
-    logging.debug(f"Бан снят с пользователя {telegram_id}")
+    logging.debug("Бан снят с пользователя %s", telegram_id)
     return {"status": "ok"}
 
 @sio.event
 async def new_ticket(sid, data):
-    logging.debug(f"Получено событие new_ticket: {data}")
+    logging.debug("Получено событие new_ticket: %s", data)
     await sio.emit("update_tickets", data)
     logging.debug("Событие update_tickets отправлено")
 
 @sio.event
 async def connect(sid, environ):
-    logging.debug(f"Клиент подключился: {sid}")
+    logging.debug("Клиент подключился: %s", sid)
+    SOCKETIO_CLIENTS.inc()
 
 @sio.event
 async def disconnect(sid):
-    logging.debug(f"Клиент отключился: {sid}")
+    logging.debug("Клиент отключился: %s", sid)
+    SOCKETIO_CLIENTS.dec()
+    typing_presence.drop_sid(sid)
 
 @sio.event
 async def ticket_reopened(sid, data):
-    logging.debug(f"Получено событие ticket_reopened: {data}")
+    logging.debug("Получено событие ticket_reopened: %s", data)
     await sio.emit("update_tickets", data)
     logging.debug("Событие update_tickets отправлено для переоткрытого тикета")
 
-auto_close_tasks = {}  # Dict для хранения задач по ticket_id
+AUTO_CLOSE_DELAY = timedelta(hours=1)
+AUTO_CLOSE_RESYNC_SECONDS = 60  # подхватываем изменения, сделанные другими процессами
 
-async def close_ticket_after_delay(ticket_id, telegram_id, delay_hours=1):
-    delay_seconds = delay_hours * 3600
-    logging.debug(f"Started timer for ticket #{ticket_id}: sleep for {delay_seconds} seconds")
-    try:
-        await asyncio.sleep(delay_seconds)
-        logging.debug(f"Timer expired for ticket #{ticket_id}: checking for close")
+class AutoCloseScheduler:
+    """Один таймер на все тикеты с автозакрытием: min-heap по tickets.auto_close_time.
+
+    Отмена ленивая: запись убирается из entries, а устаревший элемент кучи
+    отбрасывается, когда доходит до вершины.
+    """
+
+    def __init__(self, resync_interval: float = AUTO_CLOSE_RESYNC_SECONDS):
+        self.resync_interval = resync_interval
+        self.heap = []  # (deadline, ticket_id)
+        self.entries = {}  # ticket_id -> deadline
+        self.wakeup = asyncio.Event()
+
+    def schedule(self, ticket_id: int, auto_close_time: str):
+        deadline = datetime.fromisoformat(auto_close_time).timestamp()
+        if self.entries.get(ticket_id) == deadline:
+            return
+        self.entries[ticket_id] = deadline
+        heapq.heappush(self.heap, (deadline, ticket_id))
+        if self.heap[0] == (deadline, ticket_id):
+            self.wakeup.set()
+
+    def cancel(self, ticket_id: int):
+        if self.entries.pop(ticket_id, None) is not None:
+            logging.debug("Cancelled auto-close timer for ticket #%s", ticket_id)
+
+    def _drop_stale(self):
+        while self.heap and self.entries.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+
+    def _pop_due(self, now: float) -> list:
+        due = []
+        self._drop_stale()
+        while self.heap and self.heap[0][0] <= now:
+            _, ticket_id = heapq.heappop(self.heap)
+            del self.entries[ticket_id]
+            due.append(ticket_id)
+            self._drop_stale()
+        return due
+
+    def resync(self):
         conn = get_db_connection()
         cursor = conn.cursor()
-        
-        # Проверяем, все еще включено ли
-        cursor.execute("SELECT auto_close_enabled, auto_close_time FROM tickets WHERE ticket_id = ?", (ticket_id,))
-        ticket = cursor.fetchone()
-        if not ticket or not ticket["auto_close_enabled"]:
-            logging.debug(f"Auto-close disabled for ticket #{ticket_id} - skipping")
-            conn.close()
-            return
-        
-        auto_close_time = ticket["auto_close_time"]
-        start_check_time = (datetime.fromisoformat(auto_close_time) - timedelta(hours=delay_hours)).isoformat()
+        cursor.execute("""
+            SELECT ticket_id, auto_close_time FROM tickets
+            WHERE status = 'open' AND auto_close_enabled = 1 AND auto_close_time IS NOT NULL
+        """)
+        rows = cursor.fetchall()
+        conn.close()
+        active = set()
+        for row in rows:
+            active.add(row["ticket_id"])
+            self.schedule(row["ticket_id"], row["auto_close_time"])
+        for ticket_id in list(self.entries):
+            if ticket_id not in active:
+                self.cancel(ticket_id)
+        return len(rows)
+
+    async def run(self):
+        logging.debug("Auto-close scheduler: restored %s timers from DB", self.resync())
+        next_resync = time.monotonic() + self.resync_interval
+        while True:
+            self._drop_stale()
+            timeout = self.resync_interval
+            if self.heap:
+                timeout = min(timeout, max(0, self.heap[0][0] - time.time()))
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                if time.monotonic() >= next_resync:
+                    self.resync()
+                    next_resync = time.monotonic() + self.resync_interval
+                due = self._pop_due(time.time())
+                if due:
+                    await self.close_due(due)
+            except Exception as e:
+                logging.error(f"Ошибка планировщика автозакрытия: {e}")
+
+    async def close_due(self, ticket_ids: list):
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        placeholders = ",".join("?" * len(ticket_ids))
         cursor.execute(
-            "SELECT COUNT(*) FROM messages WHERE ticket_id = ? AND is_from_bot = 0 AND timestamp > ?",
-            (ticket_id, start_check_time)
+            f"SELECT ticket_id, telegram_id, auto_close_time FROM tickets WHERE ticket_id IN ({placeholders}) "
+            "AND status = 'open' AND auto_close_enabled = 1 AND auto_close_time IS NOT NULL",
+            ticket_ids
         )
-        user_replies = cursor.fetchone()[0]
-        
-        if user_replies == 0:
-            cursor.execute("UPDATE tickets SET status = 'closed', auto_close_enabled = 0, auto_close_time = NULL WHERE ticket_id = ?", (ticket_id,))
+        closed = []
+        for ticket in cursor.fetchall():
+            start_check_time = (datetime.fromisoformat(ticket["auto_close_time"]) - AUTO_CLOSE_DELAY).isoformat()
+            user_replies = cursor.execute(
+                "SELECT COUNT(*) FROM messages WHERE ticket_id = ? AND is_from_bot = 0 AND timestamp > ?",
+                (ticket["ticket_id"], start_check_time)
+            ).fetchone()[0]
+            if user_replies == 0:
+                closed.append((ticket["ticket_id"], ticket["telegram_id"]))
+            else:
+                logging.debug("Ticket #%s not closed - has %s user replies", ticket['ticket_id'], user_replies)
+        if closed:
+            cursor.executemany(
+                "UPDATE tickets SET status = 'closed', auto_close_enabled = 0, auto_close_time = NULL WHERE ticket_id = ?",
+                [(ticket_id,) for ticket_id, _ in closed]
+            )
+        conn.commit()
+        conn.close()
+
+        for ticket_id, telegram_id in closed:
             logging.info(f"Auto-closed ticket #{ticket_id} due to no user replies")
             await message_queue.put({
                 "telegram_id": telegram_id,
@@ -1875,27 +2601,19 @@ async def close_ticket_after_delay(ticket_id, telegram_id, delay_hours=1):
                 "ticket_id": ticket_id
             })
             await sio.emit('ticket_closed', {"ticket_id": ticket_id})
-        else:
-            logging.debug(f"Ticket #{ticket_id} not closed - has {user_replies} user replies")
-        
-        conn.commit()
-        conn.close()
-    except asyncio.CancelledError:
-        logging.debug(f"Timer for ticket #{ticket_id} cancelled")
-    finally:
-        if ticket_id in auto_close_tasks:
-            del auto_close_tasks[ticket_id]
+
+auto_close_scheduler = AutoCloseScheduler()
 
 @sio.event
 async def toggle_auto_close(sid, data):
     ticket_id = data['ticket_id']
     enabled = data['enabled']
-    logging.debug(f"Toggle auto-close for ticket #{ticket_id}: {enabled}")
+    logging.debug("Toggle auto-close for ticket #%s: %s", ticket_id, enabled)
     
     conn = get_db_connection()
     cursor = conn.cursor()
     if enabled:
-        auto_close_time = (datetime.now(astana_tz) + timedelta(hours=1)).isoformat()
+        auto_close_time = (datetime.now(astana_tz) + AUTO_CLOSE_DELAY).isoformat()
         cursor.execute(
             "UPDATE tickets SET auto_close_enabled = 1, auto_close_time = ? WHERE ticket_id = ?",
             (auto_close_time, ticket_id)
@@ -1907,19 +2625,13 @@ async def toggle_auto_close(sid, data):
             "text": message,
             "ticket_id": ticket_id
         })
-        # Запускаем индивидуальный таймер
-        if ticket_id in auto_close_tasks:
-            auto_close_tasks[ticket_id].cancel()  # Отменяем старый, если был
-        auto_close_tasks[ticket_id] = asyncio.create_task(close_ticket_after_delay(ticket_id, telegram_id))
+        auto_close_scheduler.schedule(ticket_id, auto_close_time)
     else:
         cursor.execute(
             "UPDATE tickets SET auto_close_enabled = 0, auto_close_time = NULL WHERE ticket_id = ?",
             (ticket_id,)
         )
-        if ticket_id in auto_close_tasks:
-            auto_close_tasks[ticket_id].cancel()
-            del auto_close_tasks[ticket_id]
-            logging.debug(f"Cancelled auto-close timer for ticket #{ticket_id}")
+        auto_close_scheduler.cancel(ticket_id)
 
     cursor.execute("""
         SELECT t.telegram_id, e.login, 
@@ -1945,7 +2657,7 @@ async def toggle_auto_close(sid, data):
 async def toggle_notification(sid, data):
     ticket_id = data['ticket_id']
     enabled = data['enabled']
-    logging.debug(f"Toggle notification for ticket #{ticket_id}: {enabled}")
+    logging.debug("Toggle notification for ticket #%s: %s", ticket_id, enabled)
     
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -1973,30 +2685,213 @@ async def toggle_notification(sid, data):
         "enabled": enabled
     })
 
+TYPING_TTL_SECONDS = 5  # сколько держим статус «печатает» без обновлений
+TYPING_BROADCAST_INTERVAL = 0.5  # не чаще одного снапшота в комнату за интервал
+TYPING_WORKER_ID = f"{os.getpid()}-{secrets.token_hex(3)}"  # процесс-источник снапшота
+
+def ticket_room(ticket_id) -> str:
+    return f"ticket_{ticket_id}"
+
+class TypingPresence:
+    """Кто печатает в каком тикете. Снапшоты рассылаются в комнату тикета пачками.
+
+    При WEB_WORKERS > 1 каждый воркер знает только о своих соединениях, поэтому снапшот
+    помечен worker и браузер объединяет снапшоты всех воркеров. Непустые снапшоты
+    повторяются каждые ttl / 2: снапшот воркера, от которого нет повторов дольше ttl
+    (процесс перезапущен), браузер отбрасывает.
+    """
+
+    def __init__(self, ttl: float = TYPING_TTL_SECONDS, interval: float = TYPING_BROADCAST_INTERVAL):
+        self.ttl = ttl
+        self.interval = interval
+        self.typing = defaultdict(dict)  # ticket_id -> {login: (sid, expires_at)}
+        self.dirty = set()
+        self.refresh_at = 0.0
+
+    def touch(self, ticket_id: int, login: str, sid: str):
+        users = self.typing[ticket_id]
+        if login not in users:
+            self.dirty.add(ticket_id)
+        users[login] = (sid, time.monotonic() + self.ttl)
+
+    def stop(self, ticket_id: int, login: str):
+        users = self.typing.get(ticket_id)
+        if users and users.pop(login, None):
+            self.dirty.add(ticket_id)
+            if not users:
+                del self.typing[ticket_id]
+
+    def drop_sid(self, sid: str):
+        for ticket_id, users in list(self.typing.items()):
+            for login, (user_sid, _) in list(users.items()):
+                if user_sid == sid:
+                    self.stop(ticket_id, login)
+
+    def snapshot(self, ticket_id: int) -> dict:
+        return {
+            "ticket_id": ticket_id,
+            "worker": TYPING_WORKER_ID,
+            "users": sorted(self.typing.get(ticket_id, {})),
+            "ttl": self.ttl,
+        }
+
+    def expire(self):
+        now = time.monotonic()
+        for ticket_id, users in list(self.typing.items()):
+            for login, (_, expires_at) in list(users.items()):
+                if expires_at <= now:
+                    self.stop(ticket_id, login)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.expire()
+                now = time.monotonic()
+                if now >= self.refresh_at:
+                    self.refresh_at = now + self.ttl / 2
+                    self.dirty.update(self.typing)
+                dirty, self.dirty = self.dirty, set()
+                for ticket_id in dirty:
+                    await sio.emit('typing_state', self.snapshot(ticket_id), room=ticket_room(ticket_id))
+            except Exception as e:
+                logging.error(f"Ошибка рассылки статуса печати: {e}")
+
+typing_presence = TypingPresence()
+
+DASHBOARD_BATCH_WINDOW = 0.1  # окно склейки событий одного тикета, сек
+MERGEABLE_EVENTS = {"update_tickets", "auto_close_updated"}  # достаточно последнего состояния
+
+class DashboardBatcher:
+    """Склеивает события одного тикета за короткое окно в один кадр ticket_delta."""
+
+    def __init__(self, window: float = DASHBOARD_BATCH_WINDOW):
+        self.window = window
+        self.pending = {}  # (room, ticket_id) -> [[event, data], ...]
+        self.tasks = set()  # ссылки на отложенные отправки, чтобы их не собрал GC
+
+    async def emit(self, event: str, data: dict, room: str = None):
+        DASHBOARD_EVENTS.inc()
+        key = (room, data.get("ticket_id"))
+        events = self.pending.get(key)
+        if events is None:
+            self.pending[key] = [[event, data]]
+            task = asyncio.create_task(self._flush_later(key))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            return
+        DASHBOARD_EVENTS_MERGED.inc()
+        if event in MERGEABLE_EVENTS:
+            for index, item in enumerate(events):
+                if item[0] == event:
+                    # Склеенное событие встаёт на место последнего: иначе оно обгонит закрытие или
+                    # переназначение, пришедшие между двумя исходными событиями
+                    del events[index]
+                    data = {**item[1], **data}
+                    DASHBOARD_EVENTS_COLLAPSED.inc()
+                    break
+        events.append([event, data])
+
+    async def _flush_later(self, key):
+        await asyncio.sleep(self.window)
+        events = self.pending.pop(key, None)
+        if not events:
+            return
+        room, ticket_id = key
+        DASHBOARD_FRAMES.inc()
+        try:
+            if len(events) == 1:
+                await sio.emit(events[0][0], events[0][1], room=room)
+            else:
+                await sio.emit("ticket_delta", {"ticket_id": ticket_id, "events": events}, room=room)
+        except Exception as e:
+            logging.error(f"Ошибка отправки пачки событий тикета #{ticket_id}: {e}")
+
+dashboard_batcher = DashboardBatcher()
+
+LOOP_LAG_INTERVAL = 0.5
+LOOP_BLOCK_MS = float(os.getenv("LOOP_BLOCK_MS", "200"))
+LOOP_DEBUG = os.getenv("LOOP_DEBUG", "0") == "1"
+
+class LoopLagMonitor:
+    """Задержка цикла событий: насколько позже положенного просыпается asyncio.sleep.
+
+    При LOOP_DEBUG=1 сторожевой поток пингует цикл через call_soon_threadsafe и, если ответа
+    нет дольше LOOP_BLOCK_MS, пишет в лог стек потока цикла — то есть код, который его держит.
+    """
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, block_ms: float = LOOP_BLOCK_MS, debug: bool = LOOP_DEBUG):
+        self.interval = interval
+        self.block_seconds = block_ms / 1000
+        self.debug = debug
+        self.thread_id = None
+        self.loop = None
+        self.task = None
+
+    def start(self):
+        # В RUN_MODE=all вызывается и при старте веба, и при старте бота — запускаем один раз
+        if self.task is not None:
+            return
+        self.thread_id = threading.get_ident()
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.create_task(self.run())
+        if self.debug:
+            threading.Thread(target=self.watch, name="loop-watchdog", daemon=True).start()
+        logging.debug("Монитор цикла событий запущен (debug=%s, порог %s мс)", self.debug, self.block_seconds * 1000)
+
+    async def run(self):
+        while True:
+            expected_wakeup = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - expected_wakeup)
+            LOOP_LAG_SECONDS.observe(lag)
+            LOOP_LAG_LAST.set(lag)
+            if lag >= self.block_seconds:
+                LOOP_BLOCKED.inc()
+                if not self.debug:
+                    logging.warning("Цикл событий был занят %.0f мс", lag * 1000)
+
+    def watch(self):
+        while not self.loop.is_closed():
+            pong = threading.Event()
+            sent = time.monotonic()
+            try:
+                self.loop.call_soon_threadsafe(pong.set)
+            except RuntimeError:
+                return  # цикл закрыт
+            if not pong.wait(self.block_seconds):
+                frame = sys._current_frames().get(self.thread_id)
+                stack = "".join(traceback.format_stack(frame)) if frame is not None else "недоступен"
+                logging.warning("Цикл событий занят дольше %.0f мс, стек:\n%s", self.block_seconds * 1000, stack)
+                pong.wait()
+                logging.warning("Цикл событий освободился через %.0f мс", (time.monotonic() - sent) * 1000)
+            time.sleep(self.interval)
+
+loop_monitor = LoopLagMonitor()
+
+@sio.event
+async def join_ticket(sid, data):
+    """Подписка клиента на события конкретного тикета"""
+    ticket_id = data.get('ticket_id')
+    if ticket_id is None:
+        return
+    await sio.enter_room(sid, ticket_room(ticket_id))
+    await sio.emit('typing_state', typing_presence.snapshot(ticket_id), to=sid)
+
 @sio.event
 async def typing(sid, data):
     """Обработка события печати сотрудника"""
     ticket_id = data.get('ticket_id')
     login = data.get('login')
-    logging.debug(f"Сотрудник {login} печатает в тикете #{ticket_id}")
-    
-    # Трансляция события всем подключённым клиентам кроме отправителя
-    await sio.emit('user_typing', {
-        "ticket_id": ticket_id,
-        "login": login,
-        "sid": sid
-    }, skip_sid=sid)
+    if ticket_id is None or not login:
+        return
+    typing_presence.touch(ticket_id, login, sid)
 
 @sio.event
 async def stop_typing(sid, data):
     """Обработка события остановки печати"""
     ticket_id = data.get('ticket_id')
     login = data.get('login')
-    logging.debug(f"Сотрудник {login} перестал печатать в тикете #{ticket_id}")
-    
-    # Трансляция события всем подключённым клиентам кроме отправителя
-    await sio.emit('user_stop_typing', {
-        "ticket_id": ticket_id,
-        "login": login,
-        "sid": sid
-    }, skip_sid=sid)
\ No newline at end of file
+    if ticket_id is None or not login:
+        return
+    typing_presence.stop(ticket_id, login)
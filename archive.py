@@ -0,0 +1,220 @@
+"""Архив старых закрытых тикетов.
+
+Вместо удаления тикеты старше ARCHIVE_AFTER_MONTHS переносятся вместе с сообщениями,
+вложениями и оценками тикета в отдельную базу Archive/archive.db, а файлы вложений — в
+Archive/Uploads. Перенос идёт пачками по ARCHIVE_BATCH_SIZE тикетов: каждая пачка — одна
+транзакция над обеими базами (ATTACH), так что блокировка support.db держится недолго, а
+между пачками обработчики бота и веба успевают записать своё.
+
+Копирование идемпотентно (INSERT OR REPLACE), а файлы переносятся отдельным шагом по
+записям архива с путём в Uploads/ — прерванный перенос просто продолжится в следующий раз.
+
+Оценки сотрудников (employee_ratings) остаются в support.db: из них складываются итоги
+сотрудника в employee_stats, и архивация не должна их менять.
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+import pytz
+from dateutil.relativedelta import relativedelta
+
+import db
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "Archive")
+ARCHIVE_DB_PATH = os.path.join(ARCHIVE_DIR, "archive.db")
+ARCHIVE_UPLOADS_DIR = os.path.join(ARCHIVE_DIR, "Uploads")
+ARCHIVE_AFTER_MONTHS = int(os.getenv("ARCHIVE_AFTER_MONTHS", "6"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "50"))
+ARCHIVE_BATCH_PAUSE = 0.2  # с между пачками
+ARCHIVE_FILES_BATCH_SIZE = 200
+
+# Порядок важен: при удалении из support.db сначала дочерние таблицы
+TICKET_TABLES = ("attachments", "messages", "admin_messages", "ticket_ratings", "tickets")
+
+
+def _selection(table: str) -> str:
+    """Условие для строк таблицы, относящихся к тикетам из temp.archive_batch."""
+    if table == "attachments":
+        return "message_id IN (SELECT message_id FROM main.messages WHERE ticket_id IN (SELECT ticket_id FROM temp.archive_batch))"
+    return "ticket_id IN (SELECT ticket_id FROM temp.archive_batch)"
+
+
+def _columns(conn, schema: str, table: str) -> list:
+    return [row[1] for row in conn.execute(f"PRAGMA {schema}.table_info({table})").fetchall()]
+
+
+def attach(conn):
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    conn.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DB_PATH,))
+
+
+def sync_schema(conn):
+    """Таблицы архива повторяют таблицы support.db, включая столбцы, добавленные позже через ALTER."""
+    for table in TICKET_TABLES:
+        main_columns = _columns(conn, "main", table)
+        archive_columns = _columns(conn, "archive", table)
+        if not archive_columns:
+            sql = conn.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()[0]
+            conn.execute(sql.replace(f"CREATE TABLE {table}", f"CREATE TABLE archive.{table}", 1))
+            continue
+        for column in main_columns:
+            if column not in archive_columns:
+                conn.execute(f"ALTER TABLE archive.{table} ADD COLUMN {column}")
+    conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_messages_ticket_id ON messages (ticket_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_attachments_message_id ON attachments (message_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_attachments_file_path ON attachments (file_path)")
+    conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_tickets_telegram_id ON tickets (telegram_id)")
+
+
+def archive_batch(conn, threshold: str, limit: int = ARCHIVE_BATCH_SIZE) -> int:
+    """Перенести в архив до limit закрытых тикетов, созданных раньше threshold; число тикетов."""
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS archive_batch (ticket_id INTEGER PRIMARY KEY)")
+    conn.execute("DELETE FROM temp.archive_batch")
+    conn.execute(
+        "INSERT INTO temp.archive_batch SELECT ticket_id FROM main.tickets "
+        "WHERE status = 'closed' AND created_at < ? ORDER BY ticket_id LIMIT ?",
+        (threshold, limit),
+    )
+    count = conn.execute("SELECT COUNT(*) FROM temp.archive_batch").fetchone()[0]
+    if not count:
+        conn.rollback()
+        return 0
+    for table in reversed(TICKET_TABLES):
+        columns = ", ".join(_columns(conn, "main", table))
+        conn.execute(
+            f"INSERT OR REPLACE INTO archive.{table} ({columns}) SELECT {columns} FROM main.{table} WHERE {_selection(table)}"
+        )
+    for table in TICKET_TABLES:
+        conn.execute(f"DELETE FROM main.{table} WHERE {_selection(table)}")
+    # Триггеры уже обнулили счётчики перенесённых оценок; строку тикета больше никто не прочитает
+    conn.execute(f"DELETE FROM main.ticket_stats WHERE {_selection('ticket_stats')}")
+    conn.commit()
+    return count
+
+
+def move_files(conn, limit: int = ARCHIVE_FILES_BATCH_SIZE) -> int:
+    """Перенести файлы заархивированных вложений из Uploads в Archive/Uploads; число записей."""
+    rows = conn.execute(
+        "SELECT attachment_id, file_path, thumb_path FROM archive.attachments "
+        "WHERE file_path LIKE 'Uploads/%' OR thumb_path LIKE 'Uploads/%' LIMIT ?",
+        (limit,),
+    ).fetchall()
+    if not rows:
+        return 0
+    os.makedirs(ARCHIVE_UPLOADS_DIR, exist_ok=True)
+    updates = []
+    for attachment_id, file_path, thumb_path in rows:
+        moved = []
+        for path in (file_path, thumb_path):
+            if not path or not path.startswith("Uploads/"):
+                moved.append(path)
+                continue
+            target = os.path.join(ARCHIVE_UPLOADS_DIR, os.path.basename(path))
+            try:
+                os.replace(path, target)
+            except FileNotFoundError:
+                if not os.path.exists(target):
+                    logging.warning(f"Архив: файл {path} не найден")
+            moved.append(target.replace(os.sep, "/"))
+        updates.append((moved[0], moved[1], attachment_id))
+    conn.executemany("UPDATE archive.attachments SET file_path = ?, thumb_path = ? WHERE attachment_id = ?", updates)
+    conn.commit()
+    return len(rows)
+
+
+def _threshold() -> str:
+    astana_tz = pytz.timezone('Asia/Almaty')
+    return (datetime.now(astana_tz) - relativedelta(months=ARCHIVE_AFTER_MONTHS)).isoformat()
+
+
+def _step(threshold: str) -> tuple:
+    conn = db.connect()
+    try:
+        attach(conn)
+        sync_schema(conn)
+        conn.commit()
+        tickets = archive_batch(conn, threshold)
+        files = move_files(conn)
+        return tickets, files
+    finally:
+        conn.close()
+
+
+async def archive_old_tickets(threshold: str = None) -> dict:
+    """Перенести в архив все подходящие тикеты, пачка за пачкой в отдельном потоке."""
+    threshold = threshold or _threshold()
+    started = time.monotonic()
+    total_tickets = total_files = 0
+    while True:
+        tickets, files = await asyncio.to_thread(_step, threshold)
+        total_tickets += tickets
+        total_files += files
+        if not tickets and not files:
+            break
+        await asyncio.sleep(ARCHIVE_BATCH_PAUSE)
+    if total_tickets or total_files:
+        logging.info(
+            f"Архив: перенесено тикетов {total_tickets}, вложений {total_files} за {time.monotonic() - started:.1f} с"
+        )
+    return {"tickets": total_tickets, "attachments": total_files}
+
+
+def _connect_archive():
+    if not os.path.exists(ARCHIVE_DB_PATH):
+        return None
+    conn = db.connect(ARCHIVE_DB_PATH, readonly=True)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def search(query: str, limit: int = 50) -> list:
+    """Поиск по архиву: тикеты, в сообщениях которых встречается query."""
+    conn = _connect_archive()
+    if conn is None:
+        return []
+    try:
+        rows = conn.execute(
+            """
+            SELECT t.ticket_id, t.telegram_id, t.created_at, t.issue_type,
+                   m.message_id, m.text, m.timestamp
+            FROM messages m
+            JOIN tickets t ON t.ticket_id = m.ticket_id
+            WHERE LOWER(m.text) LIKE ?
+            GROUP BY t.ticket_id
+            ORDER BY t.ticket_id DESC
+            LIMIT ?
+            """,
+            (f"%{query.lower()}%", limit),
+        ).fetchall()
+        return [dict(row) for row in rows]
+    finally:
+        conn.close()
+
+
+def ticket(ticket_id: int):
+    """Тикет из архива с сообщениями и вложениями; None, если его там нет."""
+    conn = _connect_archive()
+    if conn is None:
+        return None
+    try:
+        row = conn.execute("SELECT * FROM tickets WHERE ticket_id = ?", (ticket_id,)).fetchone()
+        if row is None:
+            return None
+        messages = [dict(message) for message in conn.execute(
+            "SELECT * FROM messages WHERE ticket_id = ? ORDER BY timestamp, message_id", (ticket_id,)
+        ).fetchall()]
+        attachments = {}
+        for attachment in conn.execute(
+            "SELECT * FROM attachments WHERE message_id IN (SELECT message_id FROM messages WHERE ticket_id = ?)",
+            (ticket_id,),
+        ).fetchall():
+            attachments.setdefault(attachment["message_id"], []).append(dict(attachment))
+        for message in messages:
+            message["attachments"] = attachments.get(message["message_id"], [])
+        return {**dict(row), "messages": messages}
+    finally:
+        conn.close()
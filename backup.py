@@ -0,0 +1,209 @@
+"""Горячие резервные копии support.db и архива через SQLite backup API.
+
+Копия файла работающей базы может оказаться «рваной»: запись посреди копирования даёт файл,
+которого никогда не было. sqlite3.Connection.backup копирует страницы порциями по
+BACKUP_STEP_PAGES, блокировка на чтение держится только на время порции, а между порциями
+поток делает паузу и бот с вебом пишут без ожидания. Если другое соединение изменило базу,
+SQLite начинает копирование заново; после BACKUP_MAX_RESTARTS перезапусков база копируется
+одним шагом — запись в это время ждёт (busy timeout), зато копия гарантированно закончится.
+
+Копия проверяется PRAGMA quick_check, сжимается gzip и кладётся в BACKUP_DIR как
+support-ГГГГММДД-ЧЧММСС.db.gz; хранятся последние BACKUP_KEEP копий каждой базы. Журнал
+support.db — rollback, а не WAL, поэтому архивировать между полными копиями нечего: каждая
+копия полная и восстанавливается сама по себе.
+
+Запуск вручную и восстановление (бот и веб должны быть остановлены):
+    python backup.py create
+    python backup.py list
+    python backup.py restore Backups/support-20260101-030000.db.gz
+"""
+import argparse
+import asyncio
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from datetime import datetime
+
+import archive
+import db
+from metrics import BACKUP_LAST_SUCCESS, BACKUP_SIZE_BYTES
+
+BACKUP_DIR = os.getenv("BACKUP_DIR", "Backups")
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+BACKUP_STEP_PAGES = 256  # страниц за шаг (1 МБ при странице 4 КБ)
+BACKUP_STEP_PAUSE = 0.01  # с между шагами
+BACKUP_MAX_RESTARTS = 3
+BACKUP_COMPRESS_LEVEL = 6
+BACKUP_SUFFIX = ".db.gz"
+
+
+class BackupRestarted(Exception):
+    pass
+
+
+def _databases() -> list:
+    return [(name, path) for name, path in (("support", db.DB_PATH), ("archive", archive.ARCHIVE_DB_PATH))
+            if os.path.exists(path)]
+
+
+def _progress(stats: dict):
+    """Колбэк для Connection.backup: пауза между шагами и счёт перезапусков копирования."""
+    def progress(status, remaining, total):
+        if stats["remaining"] is not None and remaining > stats["remaining"]:
+            stats["restarts"] += 1
+            if stats["restarts"] > BACKUP_MAX_RESTARTS:
+                raise BackupRestarted()
+        stats["remaining"] = remaining
+        time.sleep(BACKUP_STEP_PAUSE)
+    return progress
+
+
+def copy_database(source_path: str, target_path: str) -> dict:
+    """Согласованная копия базы в target_path; сколько раз копирование начиналось заново."""
+    stats = {"remaining": None, "restarts": 0, "single_step": False}
+    source = db.connect(source_path, readonly=True)
+    target = sqlite3.connect(target_path)
+    try:
+        try:
+            source.backup(target, pages=BACKUP_STEP_PAGES, progress=_progress(stats))
+        except BackupRestarted:
+            stats["single_step"] = True
+            source.backup(target)
+    finally:
+        target.close()
+        source.close()
+    return stats
+
+
+def quick_check(path: str) -> list:
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        rows = [row[0] for row in conn.execute("PRAGMA quick_check").fetchall()]
+    finally:
+        conn.close()
+    return [] if rows == ["ok"] else rows
+
+
+def compress(path: str, target_path: str):
+    with open(path, "rb") as source, gzip.open(target_path, "wb", compresslevel=BACKUP_COMPRESS_LEVEL) as target:
+        shutil.copyfileobj(source, target, 1024 * 1024)
+
+
+def decompress(path: str, target_path: str):
+    with gzip.open(path, "rb") as source, open(target_path, "wb") as target:
+        shutil.copyfileobj(source, target, 1024 * 1024)
+
+
+def list_backups(name: str = None) -> list:
+    """Копии в BACKUP_DIR от новых к старым."""
+    try:
+        files = [entry for entry in os.listdir(BACKUP_DIR) if entry.endswith(BACKUP_SUFFIX)]
+    except FileNotFoundError:
+        return []
+    if name:
+        files = [entry for entry in files if entry.startswith(f"{name}-")]
+    return [os.path.join(BACKUP_DIR, entry) for entry in sorted(files, reverse=True)]
+
+
+def rotate(name: str, keep: int = BACKUP_KEEP) -> int:
+    removed = 0
+    for path in list_backups(name)[keep:]:
+        os.remove(path)
+        removed += 1
+    return removed
+
+
+def backup_database(name: str, path: str, stamp: str) -> dict:
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    copy_path = os.path.join(BACKUP_DIR, f".{name}-{stamp}.db.tmp")
+    target_path = os.path.join(BACKUP_DIR, f"{name}-{stamp}{BACKUP_SUFFIX}")
+    started = time.perf_counter()
+    try:
+        stats = copy_database(path, copy_path)
+        copied = time.perf_counter()
+        errors = quick_check(copy_path)
+        if errors:
+            raise RuntimeError(f"копия {name} не прошла quick_check: {errors[:5]}")
+        compress(copy_path, target_path + ".tmp")
+        os.replace(target_path + ".tmp", target_path)
+    finally:
+        for leftover in (copy_path, target_path + ".tmp"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    size = os.path.getsize(target_path)
+    BACKUP_SIZE_BYTES.set(size, database=name)
+    return {"path": target_path, "bytes": size, "copy_seconds": round(copied - started, 3),
+            "seconds": round(time.perf_counter() - started, 3), "restarts": stats["restarts"],
+            "single_step": stats["single_step"], "rotated": rotate(name)}
+
+
+def create_backup() -> dict:
+    """Резервные копии всех баз; итог по каждой."""
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    report = {name: backup_database(name, path, stamp) for name, path in _databases()}
+    BACKUP_LAST_SUCCESS.set(time.time())
+    for name, item in report.items():
+        logging.info(
+            f"Резервная копия {name}: {item['path']}, {item['bytes'] / 1024 / 1024:.1f} МБ за {item['seconds']} с "
+            f"(копирование {item['copy_seconds']} с, перезапусков {item['restarts']})"
+        )
+    return report
+
+
+async def run_backup() -> dict:
+    return await asyncio.to_thread(create_backup)
+
+
+def restore(backup_path: str, target_path: str = None) -> str:
+    """Восстановить базу из копии; прежний файл остаётся рядом с суффиксом .before-restore."""
+    if target_path is None:
+        name = os.path.basename(backup_path).split("-", 1)[0]
+        target_path = archive.ARCHIVE_DB_PATH if name == "archive" else db.DB_PATH
+    restored_path = f"{target_path}.restore.tmp"
+    try:
+        decompress(backup_path, restored_path)
+        errors = quick_check(restored_path)
+        if errors:
+            raise RuntimeError(f"копия {backup_path} повреждена: {errors[:5]}")
+        if os.path.exists(target_path):
+            copy_database(target_path, f"{target_path}.before-restore")
+        # Через backup API, а не заменой файла: журнал и блокировки целевой базы учитываются
+        source = sqlite3.connect(restored_path)
+        target = sqlite3.connect(target_path)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+    finally:
+        if os.path.exists(restored_path):
+            os.remove(restored_path)
+    return target_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Резервные копии support.db")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("create", help="сделать копию сейчас")
+    commands.add_parser("list", help="список копий")
+    restore_parser = commands.add_parser("restore", help="восстановить базу из копии (бот должен быть остановлен)")
+    restore_parser.add_argument("path")
+    restore_parser.add_argument("--target", help="куда восстановить (по умолчанию support.db или архив по имени копии)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    if args.command == "create":
+        create_backup()
+    elif args.command == "list":
+        for path in list_backups():
+            print(f"{path}\t{os.path.getsize(path) / 1024 / 1024:.1f} МБ")
+    else:
+        target = restore(args.path, args.target)
+        print(f"Восстановлено в {target}, прежний файл: {target}.before-restore")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,402 @@
+"""Нагрузочный стенд: заглушка Bot API (fake_telegram.py), настоящие dp и app в одном процессе.
+
+Пользователи пишут боту через getUpdates, операторы работают через веб-маршруты и Socket.IO.
+Стенд запускается во временном каталоге со своей support.db и Uploads:
+    python bench.py --duration 30 --rate 20 --mix new=1,reply=4,album=1,operator=2,search=1,view=1
+
+Сценарии (задержка считается до результата, который видит человек):
+    new      — первое сообщение пользователя, до события new_message у оператора;
+    reply    — сообщение в открытый тикет, до new_message;
+    album    — альбом из ALBUM_SIZE фото, до new_message (включая секунду сбора альбома);
+    operator — ответ оператора через /send_message, до sendMessage в Bot API;
+    search   — GET /search;
+    view     — GET /ticket/{id}.
+
+С --backup-every N во время нагрузки каждые N секунд снимается горячая копия (backup.py) —
+так видно, сколько резервное копирование добавляет к задержкам.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+ALBUM_SIZE = 3
+SCENARIOS = ("new", "reply", "album", "operator", "search", "view")
+SEARCH_WORDS = ("ошибка", "логи", "доступ", "оплата", "bench", "скриншот")
+
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"неизвестный сценарий: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def db_stats() -> dict:
+    """Размер файла БД и заполненных страниц, число строк в основных таблицах."""
+    conn = sqlite3.connect("support.db")
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    used_pages = conn.execute("PRAGMA page_count").fetchone()[0] - conn.execute("PRAGMA freelist_count").fetchone()[0]
+    stats = {"file_bytes": sum(os.path.getsize(name) for name in ("support.db", "support.db-wal") if os.path.exists(name)),
+             "used_bytes": used_pages * page_size}
+    for table in ("tickets", "messages", "attachments"):
+        stats[table] = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    conn.close()
+    return stats
+
+
+def prepare_workdir(args) -> str:
+    workdir = args.workdir or tempfile.mkdtemp(prefix="pumbabot-bench-")
+    os.makedirs(os.path.join(workdir, "Uploads"), exist_ok=True)
+    for name in ("static", "templates"):
+        target = os.path.join(workdir, name)
+        if not os.path.exists(target):
+            os.symlink(os.path.join(REPO_DIR, name), target)
+    os.chdir(workdir)
+    os.environ.update({
+        "BOT_TOKEN": "123456:BENCHBENCHBENCHBENCHBENCHBENCHBENCH",
+        "ADMIN_TELEGRAM_ID": "1",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{args.api_port}",
+        "UPDATES_MODE": "polling",
+        "RUN_MODE": "all",
+        "BUS_URL": "",
+        "LOG_LEVEL": args.log_level,
+        "LOG_FILE": os.path.join(workdir, "bench.log"),
+        "NOTIFICATION_CHAT_ID": "",
+    })
+    sys.path.insert(0, REPO_DIR)
+    return workdir
+
+
+class Bench:
+    def __init__(self, args, main_module, fake):
+        self.args = args
+        self.main = main_module
+        self.fake = fake
+        self.rng = random.Random(args.seed)
+        self.latencies = {name: [] for name in SCENARIOS}
+        self.errors = {name: 0 for name in SCENARIOS}
+        self.pending = {}  # токен -> (сценарий, время начала, future)
+        self.next_user = 0
+        self.users = []  # telegram_id пользователей с открытым тикетом
+        self.tickets = {}  # telegram_id -> ticket_id
+        self.sessions = []
+        self.sockets = []
+        self.backups = []  # длительность резервных копий во время нагрузки, с
+
+    # ---------- подготовка ----------
+
+    def seed(self):
+        conn = self.main.db.connect()
+        users = [(100000 + i, f"bench_user_{i}", 0, f"Bench User {i}") for i in range(self.args.users)]
+        operators = [(900000 + i, f"bench_op_{i}", 1, f"Bench Operator {i}") for i in range(self.args.operators)]
+        conn.executemany("INSERT OR IGNORE INTO employees (telegram_id, login, is_admin, full_name) VALUES (?, ?, ?, ?)", users + operators)
+        expires_at = "2999-01-01T00:00:00"
+        for telegram_id, *_ in operators:
+            token = uuid.uuid4().hex
+            conn.execute("INSERT INTO sessions (session_token, telegram_id, expires_at) VALUES (?, ?, ?)", (token, telegram_id, expires_at))
+            self.sessions.append(token)
+        conn.commit()
+        conn.close()
+
+    async def connect_operators(self, aiohttp, socketio):
+        base_url = f"http://127.0.0.1:{self.args.web_port}"
+        self.http = []
+        for token in self.sessions:
+            session = aiohttp.ClientSession(base_url=base_url, cookies={"session_token": token})
+            self.http.append(session)
+            client = socketio.AsyncClient(reconnection=False)
+            client.on("*", self.on_socket_event)
+            await client.connect(base_url, headers={"Cookie": f"session_token={token}"})
+            self.sockets.append(client)
+
+    # ---------- завершение операций ----------
+
+    def start(self, scenario: str, token: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.pending[token] = (scenario, time.monotonic(), future)
+        return future
+
+    def finish(self, token: str, finished: float):
+        entry = self.pending.pop(token, None)
+        if entry is None:
+            return
+        scenario, started, future = entry
+        self.latencies[scenario].append(finished - started)
+        if not future.done():
+            future.set_result(True)
+
+    async def on_socket_event(self, event, data=None):
+        finished = time.monotonic()
+        events = data.get("events", []) if event == "ticket_delta" and isinstance(data, dict) else [(event, data)]
+        for name, payload in events:
+            if name != "new_message" or not isinstance(payload, dict):
+                continue
+            self.tickets[payload.get("telegram_id")] = payload.get("ticket_id")
+            for token in (payload.get("text") or "").split():
+                if token in self.pending:
+                    self.finish(token, finished)
+
+    def on_api_call(self, finished: float, method: str, params: dict):
+        if method.lower() == "sendmessage":
+            for token in str(params.get("text", "")).split():
+                if token in self.pending:
+                    self.finish(token, finished)
+
+    async def wait(self, scenario: str, token: str, future: asyncio.Future):
+        try:
+            await asyncio.wait_for(future, timeout=self.args.timeout)
+        except asyncio.TimeoutError:
+            self.pending.pop(token, None)
+            self.errors[scenario] += 1
+
+    # ---------- сценарии ----------
+
+    def token(self) -> str:
+        return f"bench-{uuid.uuid4().hex[:12]}"
+
+    async def run_new(self):
+        if self.next_user >= self.args.users:
+            return await self.run_reply()
+        telegram_id = 100000 + self.next_user
+        self.next_user += 1
+        token = self.token()
+        future = self.start("new", token)
+        self.fake.push_update(self.fake.text_update(telegram_id, f"Новое обращение {token}"))
+        await self.wait("new", token, future)
+        self.users.append(telegram_id)
+
+    async def run_reply(self):
+        if not self.users:
+            return await self.run_new()
+        token = self.token()
+        future = self.start("reply", token)
+        self.fake.push_update(self.fake.text_update(self.rng.choice(self.users), f"Уточнение {token}"))
+        await self.wait("reply", token, future)
+
+    async def run_album(self):
+        if not self.users:
+            return await self.run_new()
+        telegram_id = self.rng.choice(self.users)
+        token = self.token()
+        group = uuid.uuid4().hex
+        future = self.start("album", token)
+        for i in range(ALBUM_SIZE):
+            caption = f"Скриншоты {token}" if i == 0 else None
+            self.fake.push_update(self.fake.photo_update(telegram_id, caption=caption, media_group_id=group))
+        await self.wait("album", token, future)
+
+    async def run_operator(self):
+        candidates = [user for user in self.users if user in self.tickets]
+        if not candidates:
+            return await self.run_new()
+        telegram_id = self.rng.choice(candidates)
+        token = self.token()
+        future = self.start("operator", token)
+        form = {"ticket_id": str(self.tickets[telegram_id]), "telegram_id": str(telegram_id), "text": f"Ответ {token}"}
+        async with self.rng.choice(self.http).post("/send_message", data=form) as response:
+            await response.read()
+            if response.status != 200:
+                self.pending.pop(token, None)
+                self.errors["operator"] += 1
+                return
+        await self.wait("operator", token, future)
+
+    async def run_http(self, scenario: str, url: str):
+        started = time.monotonic()
+        try:
+            async with self.rng.choice(self.http).get(url, allow_redirects=False) as response:
+                await response.read()
+                ok = response.status == 200
+        except Exception:
+            ok = False
+        if ok:
+            self.latencies[scenario].append(time.monotonic() - started)
+        else:
+            self.errors[scenario] += 1
+
+    async def run_search(self):
+        await self.run_http("search", f"/search?query={self.rng.choice(SEARCH_WORDS)}")
+
+    async def run_view(self):
+        if not self.tickets:
+            return await self.run_search()
+        await self.run_http("view", f"/ticket/{self.rng.choice(list(self.tickets.values()))}")
+
+    # ---------- генератор нагрузки ----------
+
+    async def generate(self):
+        names = list(self.args.mix)
+        weights = [self.args.mix[name] for name in names]
+        tasks = set()
+        deadline = time.monotonic() + self.args.duration
+        next_at = time.monotonic()
+        while next_at < deadline:
+            await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+            scenario = self.rng.choices(names, weights)[0]
+            task = asyncio.create_task(self.guard(scenario))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            next_at += self.rng.expovariate(self.args.rate)  # открытая модель: поток Пуассона
+        if tasks:
+            # Не дождавшиеся результата к этому моменту уже посчитаны ошибками по --timeout
+            await asyncio.wait(tasks, timeout=self.args.timeout + 5)
+
+    async def run_backups(self):
+        import backup
+        while True:
+            await asyncio.sleep(self.args.backup_every)
+            started = time.monotonic()
+            await backup.run_backup()
+            self.backups.append(time.monotonic() - started)
+
+    async def guard(self, scenario: str):
+        try:
+            await getattr(self, f"run_{scenario}")()
+        except Exception as e:
+            self.errors[scenario] += 1
+            print(f"{scenario}: {type(e).__name__}: {e}", file=sys.stderr)
+
+    def report(self, elapsed: float, db_before: dict, uploads_before: int) -> dict:
+        result = {"duration": round(elapsed, 2), "rate": self.args.rate, "scenarios": {}}
+        for name in SCENARIOS:
+            values = self.latencies[name]
+            if not values and not self.errors[name]:
+                continue
+            result["scenarios"][name] = {
+                "ok": len(values),
+                "errors": self.errors[name],
+                "throughput": round(len(values) / elapsed, 2),
+                "p50_ms": round(percentile(values, 50) * 1000, 1),
+                "p99_ms": round(percentile(values, 99) * 1000, 1),
+                "max_ms": round(max(values, default=0) * 1000, 1),
+            }
+        db_after = db_stats()
+        result["db_growth"] = {key: db_after[key] - db_before[key] for key in db_after}
+        result["uploads_growth_bytes"] = dir_size("Uploads") - uploads_before
+        result["api_calls"] = len(self.fake.calls)
+        if self.backups:
+            result["backups"] = {"count": len(self.backups), "max_s": round(max(self.backups), 3)}
+        return result
+
+
+def print_report(result: dict):
+    print(f"\nДлительность {result['duration']} с, целевая нагрузка {result['rate']} оп/с")
+    print(f"{'сценарий':<10}{'ok':>7}{'ошибки':>8}{'оп/с':>9}{'p50, мс':>10}{'p99, мс':>10}{'макс, мс':>10}")
+    for name, row in result["scenarios"].items():
+        print(f"{name:<10}{row['ok']:>7}{row['errors']:>8}{row['throughput']:>9}{row['p50_ms']:>10}{row['p99_ms']:>10}{row['max_ms']:>10}")
+    growth = result["db_growth"]
+    print(f"Рост БД: файл {growth['file_bytes'] / 1024:.1f} КБ, данные {growth['used_bytes'] / 1024:.1f} КБ "
+          f"(тикетов +{growth['tickets']}, сообщений +{growth['messages']}, вложений +{growth['attachments']})")
+    print(f"Uploads: +{result['uploads_growth_bytes'] / 1024:.1f} КБ, вызовов Bot API: {result['api_calls']}")
+    if "backups" in result:
+        print(f"Резервных копий: {result['backups']['count']}, самая долгая {result['backups']['max_s']} с")
+
+
+async def run(args):
+    # Импорты после подготовки каталога и окружения: app и main читают их при импорте
+    import aiohttp
+    import socketio
+    import uvicorn
+    import fake_telegram
+    import main
+
+    bench = None
+    fake = fake_telegram.FakeTelegram(file_size=args.file_size, on_call=lambda *call: bench and bench.on_api_call(*call))
+    runner = await fake.start(port=args.api_port)
+    bench = Bench(args, main, fake)
+
+    main.init_db()
+    bench.seed()
+    server = uvicorn.Server(uvicorn.Config(app=main.app, host="127.0.0.1", port=args.web_port, log_level="warning", loop="asyncio"))
+    server_task = asyncio.create_task(server.serve())
+    bot_task = asyncio.create_task(main.run_bot())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    await bench.connect_operators(aiohttp, socketio)
+
+    db_before, uploads_before = db_stats(), dir_size("Uploads")
+    started = time.monotonic()
+    backups_task = asyncio.create_task(bench.run_backups()) if args.backup_every else None
+    await bench.generate()
+    if backups_task:
+        backups_task.cancel()
+        await asyncio.gather(backups_task, return_exceptions=True)
+    result = bench.report(time.monotonic() - started, db_before, uploads_before)
+
+    for client in bench.sockets:
+        await client.disconnect()
+    for session in bench.http:
+        await session.close()
+    await main.dp.stop_polling()
+    await asyncio.gather(bot_task, return_exceptions=True)
+    server.should_exit = True
+    await server_task
+    await main.bot.session.close()
+    await runner.cleanup()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд PumbaBot")
+    parser.add_argument("--duration", type=float, default=30, help="длительность нагрузки, с")
+    parser.add_argument("--rate", type=float, default=10, help="операций в секунду (в среднем)")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("new=1,reply=4,album=1,operator=2,search=1,view=1"))
+    parser.add_argument("--users", type=int, default=1000, help="пользователей бота в пуле")
+    parser.add_argument("--operators", type=int, default=3, help="операторов в вебе (сессия + Socket.IO)")
+    parser.add_argument("--timeout", type=float, default=15, help="сколько ждать результат операции, с")
+    parser.add_argument("--file-size", type=int, default=64 * 1024, help="размер «скачиваемых» вложений, байт")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--api-port", type=int, default=8082)
+    parser.add_argument("--web-port", type=int, default=8091)
+    parser.add_argument("--workdir", help="каталог стенда (по умолчанию временный, удаляется)")
+    parser.add_argument("--keep", action="store_true", help="не удалять временный каталог")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", help="сохранить результат в JSON-файл")
+    parser.add_argument("--backup-every", type=float, default=0, help="снимать резервную копию каждые N с во время нагрузки")
+    args = parser.parse_args()
+
+    json_path = os.path.abspath(args.json) if args.json else None
+    workdir = prepare_workdir(args)
+    try:
+        result = asyncio.run(run(args))
+    finally:
+        os.chdir(REPO_DIR)
+        if not args.workdir and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print_report(result)
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""Общая шина между процессами: Socket.IO-эмиты, исходящие задания для бота и апдейты вебхука.
+
+BUS_URL не задан     — всё живёт в одном процессе (asyncio.Queue, стандартный менеджер Socket.IO).
+sqlite:///bus.db     — локальная замена брокера на файле SQLite, без внешних сервисов.
+redis://host:6379/0  — Redis (нужен пакет redis: pip install redis).
+"""
+import asyncio
+import json
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+
+import socketio
+from socketio.async_pubsub_manager import AsyncPubSubManager
+
+SQLITE_PREFIX = "sqlite:///"
+BUS_POLL_INTERVAL = 0.05  # как часто слушатели опрашивают SQLite, сек
+BUS_RETENTION_SECONDS = 60  # сколько хранить уже разосланные эмиты
+BUS_PRUNE_EVERY = 200  # чистим старые эмиты раз в N публикаций
+JOB_POLL_MAX_INTERVAL = 0.5  # до какого интервала замедляется опрос пустой очереди заданий, сек
+JOB_QSIZE_CACHE_SECONDS = 5  # сколько метрика глубины очереди в Redis живёт без обновления
+JOB_QUEUES = ("jobs", "updates")  # jobs — исходящие сообщения боту, updates — апдейты вебхука из веб-воркеров
+
+
+def _connect_sqlite(path: str, check_same_thread: bool = True) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=check_same_thread)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sio_bus (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel TEXT NOT NULL,
+            payload BLOB NOT NULL,
+            created_at REAL NOT NULL
+        )
+    """)
+    for name in JOB_QUEUES:
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS bus_{name} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+    return conn
+
+
+class SQLiteBusManager(AsyncPubSubManager):
+    """Менеджер клиентов Socket.IO, рассылающий эмиты между процессами через таблицу SQLite."""
+    name = 'sqlitebus'
+
+    def __init__(self, path: str, channel: str = 'socketio', write_only: bool = False,
+                 logger=None, poll_interval: float = BUS_POLL_INTERVAL):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.conn = _connect_sqlite(path)
+        self.published = 0
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+
+    async def _publish(self, data):
+        now = time.time()
+        self.conn.execute(
+            "INSERT INTO sio_bus (channel, payload, created_at) VALUES (?, ?, ?)",
+            (self.channel, pickle.dumps(data), now)
+        )
+        self.published += 1
+        if self.published % BUS_PRUNE_EVERY == 0:
+            self.conn.execute("DELETE FROM sio_bus WHERE created_at < ?", (now - BUS_RETENTION_SECONDS,))
+
+    async def _listen(self):
+        conn = _connect_sqlite(self.path)
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM sio_bus").fetchone()[0]
+        while True:
+            rows = conn.execute(
+                "SELECT id, payload FROM sio_bus WHERE channel = ? AND id > ? ORDER BY id",
+                (self.channel, last_id)
+            ).fetchall()
+            for row_id, payload in rows:
+                last_id = row_id
+                yield payload
+            if not rows:
+                await asyncio.sleep(self.poll_interval)
+
+
+class SQLiteJobQueue:
+    """Очередь заданий поверх SQLite (таблица bus_<name>). Повторяет интерфейс asyncio.Queue.
+
+    Запросы к файлу идут в потоке (asyncio.to_thread), чтобы ожидание блокировки SQLite не
+    останавливало цикл событий бота и веба. Пустую очередь опрашиваем всё реже, до
+    JOB_POLL_MAX_INTERVAL, и только чтением — запись начинается, когда есть что забрать.
+    """
+
+    def __init__(self, path: str, name: str = "jobs", poll_interval: float = BUS_POLL_INTERVAL * 2,
+                 max_poll_interval: float = JOB_POLL_MAX_INTERVAL):
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.table = f"bus_{name}"
+        self.conn = _connect_sqlite(path, check_same_thread=False)
+        self.lock = threading.Lock()  # одно соединение на все потоки
+
+    def _insert(self, item: dict):
+        with self.lock:
+            self.conn.execute(
+                f"INSERT INTO {self.table} (payload, created_at) VALUES (?, ?)",
+                (json.dumps(item), time.time())
+            )
+
+    async def put(self, item: dict):
+        await asyncio.to_thread(self._insert, item)
+
+    def _pop(self):
+        with self.lock:
+            while True:
+                row = self.conn.execute(f"SELECT id, payload FROM {self.table} ORDER BY id LIMIT 1").fetchone()
+                if row is None:
+                    return None
+                # Задание могло уйти другому процессу между SELECT и DELETE — тогда берём следующее
+                if self.conn.execute(f"DELETE FROM {self.table} WHERE id = ?", (row[0],)).rowcount:
+                    return json.loads(row[1])
+
+    async def get(self) -> dict:
+        interval = self.poll_interval
+        while True:
+            item = await asyncio.to_thread(self._pop)
+            if item is not None:
+                return item
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, self.max_poll_interval)
+
+    def task_done(self):
+        pass
+
+    def qsize(self) -> int:
+        with self.lock:
+            return self.conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+
+class RedisJobQueue:
+    """Очередь заданий в списке Redis (ключ pumbabot:<name>)."""
+
+    def __init__(self, url: str, name: str = "jobs"):
+        try:
+            import redis.asyncio as aioredis
+        except ImportError:
+            raise RuntimeError("Для BUS_URL=redis://... установите пакет redis (pip install redis)")
+        self.redis = aioredis.Redis.from_url(url)
+        self.key = f"pumbabot:{name}"
+        self.size = 0
+        self.size_at = 0.0
+        self.size_task = None
+
+    async def put(self, item: dict):
+        await self.redis.rpush(self.key, json.dumps(item))
+
+    async def get(self) -> dict:
+        _, raw = await self.redis.blpop(self.key)
+        return json.loads(raw)
+
+    def task_done(self):
+        pass
+
+    async def _refresh_size(self):
+        try:
+            self.size = await self.redis.llen(self.key)
+            self.size_at = time.monotonic()
+        except Exception as e:
+            logging.error(f"Не удалось узнать длину очереди {self.key}: {e}")
+
+    def qsize(self) -> int:
+        """Длина списка по LLEN. Метрика читается синхронно, поэтому отдаём последнее известное
+        значение, а устаревшее обновляем в фоне — новое попадёт в следующий опрос /metrics."""
+        if time.monotonic() - self.size_at > JOB_QSIZE_CACHE_SECONDS and (self.size_task is None or self.size_task.done()):
+            try:
+                self.size_task = asyncio.get_running_loop().create_task(self._refresh_size())
+            except RuntimeError:
+                pass  # вне цикла событий — отдаём что есть
+        return self.size
+
+
+def create_client_manager(url: str, write_only: bool = False):
+    """Менеджер клиентов Socket.IO для BUS_URL; None — стандартный внутрипроцессный."""
+    if not url:
+        return None
+    if url.startswith(SQLITE_PREFIX):
+        logging.info(f"Шина Socket.IO: SQLite {url[len(SQLITE_PREFIX):]}")
+        return SQLiteBusManager(url[len(SQLITE_PREFIX):], write_only=write_only)
+    if url.startswith(("redis://", "rediss://")):
+        logging.info("Шина Socket.IO: Redis")
+        return socketio.AsyncRedisManager(url, write_only=write_only)
+    raise ValueError(f"Неподдерживаемый BUS_URL: {url}")
+
+
+def create_job_queue(url: str, name: str = "jobs"):
+    """Очередь заданий name (см. JOB_QUEUES) для BUS_URL; без шины — обычная asyncio.Queue."""
+    if not url:
+        return asyncio.Queue()
+    if url.startswith(SQLITE_PREFIX):
+        return SQLiteJobQueue(url[len(SQLITE_PREFIX):], name)
+    if url.startswith(("redis://", "rediss://")):
+        return RedisJobQueue(url, name)
+    raise ValueError(f"Неподдерживаемый BUS_URL: {url}")
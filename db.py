@@ -0,0 +1,230 @@
+"""Подключение к support.db с учётом количества и времени запросов (см. metrics.py).
+
+При DB_PROFILE=1 (или включении на странице /admin/queries) запросы дополнительно
+группируются по нормализованному тексту и месту вызова, а запросы дольше DB_SLOW_QUERY_MS
+пишутся в лог вместе с EXPLAIN QUERY PLAN.
+"""
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from functools import lru_cache
+
+from dotenv import load_dotenv
+
+import tracing
+from metrics import DB_QUERIES, DB_QUERY_SECONDS
+
+load_dotenv()
+
+DB_PATH = "support.db"
+DB_PROFILE = os.getenv("DB_PROFILE", "0") == "1"
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "100"))
+DB_PROFILE_MAX_ENTRIES = 1000  # различных пар (запрос, место вызова); новые сверх лимита не учитываются
+
+
+def _operation(sql: str) -> str:
+    words = sql.lstrip().split(None, 1)
+    operation = words[0].upper() if words else ""
+    return operation if operation in ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "CREATE", "PRAGMA") else "OTHER"
+
+
+def _observe(sql: str, started: float):
+    operation = _operation(sql)
+    seconds = time.perf_counter() - started
+    DB_QUERIES.inc(operation=operation)
+    DB_QUERY_SECONDS.observe(seconds, operation=operation)
+    if tracing.TRACE_ENABLED:
+        tracing.record_span(f"db {operation}", seconds, sql=normalize_sql(sql))
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _observe(sql, started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _observe(sql, started)
+
+    def executescript(self, sql_script):
+        started = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            _observe(sql_script, started)
+
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=1024)
+def normalize_sql(sql: str) -> str:
+    """Один вид для запросов, отличающихся только литералами, пробелами и длиной IN (?, ?, ...)."""
+    sql = _STRING_LITERAL.sub("?", sql)
+    sql = _NUMBER_LITERAL.sub("?", sql)
+    sql = _WHITESPACE.sub(" ", sql).strip()
+    return _PLACEHOLDER_LIST.sub("(?, ...)", sql)
+
+
+def _call_site() -> str:
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+    if frame is None:
+        return "?"
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} {frame.f_code.co_name}"
+
+
+class QueryProfiler:
+    def __init__(self, enabled: bool = DB_PROFILE, slow_ms: float = DB_SLOW_QUERY_MS):
+        self.enabled = enabled
+        self.slow_ms = slow_ms
+        self.lock = threading.Lock()
+        self.stats = {}  # (sql, место вызова) -> [вызовы, общее время, максимум, строки]
+        self.started_at = time.time()
+
+    def record(self, cursor, sql: str, parameters, seconds: float):
+        key = (normalize_sql(sql), _call_site())
+        rows = cursor.rowcount if cursor.rowcount > 0 else 0
+        with self.lock:
+            entry = self.stats.get(key)
+            if entry is None:
+                if len(self.stats) >= DB_PROFILE_MAX_ENTRIES:
+                    return None
+                entry = self.stats[key] = [0, 0.0, 0.0, 0]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+            entry[3] += rows
+        if seconds * 1000 >= self.slow_ms:
+            self.log_slow(cursor, sql, parameters, seconds, key[1])
+        return entry
+
+    def add_fetch(self, entry, rows: int, seconds: float):
+        if entry is None:
+            return
+        with self.lock:
+            entry[1] += seconds
+            entry[3] += rows
+
+    def log_slow(self, cursor, sql: str, parameters, seconds: float, site: str):
+        plan = ""
+        if parameters is not None and sql.lstrip()[:6].upper() in ("SELECT", "INSERT", "UPDATE", "DELETE"):
+            try:
+                # Обычный курсор, чтобы план не попал в статистику
+                rows = sqlite3.Cursor(cursor.connection).execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+                plan = "; ".join(str(row[-1]) for row in rows)
+            except sqlite3.Error as e:
+                plan = f"недоступен: {e}"
+        logging.warning("Медленный запрос %.1f мс (%s): %s | план: %s", seconds * 1000, site, normalize_sql(sql), plan)
+
+    def top(self, limit: int = 50) -> list:
+        with self.lock:
+            items = [(key, list(entry)) for key, entry in self.stats.items()]
+        items.sort(key=lambda item: item[1][1], reverse=True)
+        return [
+            {
+                "sql": sql,
+                "site": site,
+                "calls": calls,
+                "total_ms": total * 1000,
+                "avg_ms": total * 1000 / calls if calls else 0,
+                "max_ms": longest * 1000,
+                "rows": rows,
+            }
+            for (sql, site), (calls, total, longest, rows) in items[:limit]
+        ]
+
+    def reset(self):
+        with self.lock:
+            self.stats.clear()
+            self.started_at = time.time()
+
+
+PROFILER = QueryProfiler()
+
+
+class ProfiledCursor(InstrumentedCursor):
+    entry = None
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.entry = PROFILER.record(self, sql, parameters, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.entry = PROFILER.record(self, sql, None, time.perf_counter() - started)
+
+    def executescript(self, sql_script):
+        started = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            self.entry = PROFILER.record(self, sql_script, None, time.perf_counter() - started)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        PROFILER.add_fetch(self.entry, row is not None, time.perf_counter() - started)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        PROFILER.add_fetch(self.entry, len(rows), time.perf_counter() - started)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        PROFILER.add_fetch(self.entry, len(rows), time.perf_counter() - started)
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        row = super().__next__()
+        PROFILER.add_fetch(self.entry, 1, time.perf_counter() - started)
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=None):
+        if factory is None:
+            factory = ProfiledCursor if PROFILER.enabled else InstrumentedCursor
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+
+def connect(path: str = DB_PATH, readonly: bool = False, **kwargs) -> sqlite3.Connection:
+    kwargs.setdefault("timeout", 10)
+    if readonly:
+        # Только чтение на уровне SQLite: случайная запись из GET-маршрута упадёт, а не возьмёт блокировку
+        return sqlite3.connect(f"file:{path}?mode=ro", uri=True, factory=InstrumentedConnection, **kwargs)
+    return sqlite3.connect(path, factory=InstrumentedConnection, **kwargs)
@@ -0,0 +1,195 @@
+"""Локальная заглушка Telegram Bot API для проверки бота без настоящего Telegram.
+
+Запуск сервера (бот ходит в него при TELEGRAM_API_URL=http://localhost:8082):
+    python fake_telegram.py serve --port 8082
+
+Отправка апдейта в вебхук бота (UPDATES_MODE=webhook):
+    python fake_telegram.py send --webhook http://localhost:8081/webhook/telegram --secret SECRET --user 1 --text "Привет"
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+
+import aiohttp
+from aiohttp import web
+
+FAKE_FILE_SIZE = 64 * 1024  # размер «скачиваемого» файла по умолчанию
+
+
+class FakeTelegram:
+    """Минимальный Bot API: отвечает на вызовы бота, копит их в calls и раздаёт апдейты через getUpdates."""
+
+    def __init__(self, file_size: int = FAKE_FILE_SIZE, on_call=None):
+        self.file_size = file_size
+        self.calls = []  # (время, метод, параметры)
+        self.on_call = on_call  # on_call(время, метод, параметры) — для стенда (bench.py)
+        self.updates = asyncio.Queue()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.app = web.Application(client_max_size=1024 ** 3)
+        self.app.router.add_post("/bot{token}/{method}", self.handle_method)
+        self.app.router.add_get("/file/bot{token}/{path:.+}", self.handle_file)
+
+    # ---------- построение апдейтов ----------
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+    def _message(self, user_id: int, **fields) -> dict:
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            **fields,
+        }
+
+    def text_update(self, user_id: int, text: str) -> dict:
+        return {"update_id": next(self.update_ids), "message": self._message(user_id, text=text)}
+
+    def photo_update(self, user_id: int, caption: str = None, media_group_id: str = None) -> dict:
+        fields = {"photo": self._photo_sizes(f"photo_{next(self.update_ids)}")}
+        if caption:
+            fields["caption"] = caption
+        if media_group_id:
+            fields["media_group_id"] = media_group_id
+        return {"update_id": next(self.update_ids), "message": self._message(user_id, **fields)}
+
+    def _photo_sizes(self, file_id: str) -> list:
+        # Как у настоящего Bot API: несколько размеров одного фото, от меньшего к большему
+        return [
+            {"file_id": f"{file_id}_{width}", "file_unique_id": f"{file_id}_{width}", "width": width,
+             "height": width * 9 // 16, "file_size": self.file_size * width // 1280}
+            for width in (90, 320, 1280)
+        ]
+
+    def document_update(self, user_id: int, file_name: str = "log.txt", caption: str = None) -> dict:
+        file_id = f"doc_{next(self.update_ids)}"
+        document = {"file_id": file_id, "file_unique_id": file_id, "file_name": file_name, "file_size": self.file_size}
+        fields = {"document": document}
+        if caption:
+            fields["caption"] = caption
+        return {"update_id": next(self.update_ids), "message": self._message(user_id, **fields)}
+
+    def push_update(self, update: dict):
+        """Положить апдейт в очередь для getUpdates (режим polling)."""
+        self.updates.put_nowait(update)
+
+    # ---------- обработка вызовов Bot API ----------
+
+    async def _params(self, request: web.Request) -> dict:
+        if request.content_type == "application/json":
+            return await request.json()
+        form = await request.post()
+        params = {}
+        for key, value in form.items():
+            if isinstance(value, str):
+                try:
+                    params[key] = json.loads(value)
+                except ValueError:
+                    params[key] = value
+            else:
+                params[key] = value.filename  # загруженный файл
+        return params
+
+    def _sent(self, params: dict, **fields) -> dict:
+        chat_id = params.get("chat_id", 0)
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "PumbaBot"},
+            **fields,
+        }
+
+    async def _get_updates(self, params: dict) -> list:
+        timeout = float(params.get("timeout") or 0)
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self.updates.get(), timeout=timeout or 0.01))
+        except asyncio.TimeoutError:
+            return []
+        while not self.updates.empty() and len(updates) < int(params.get("limit") or 100):
+            updates.append(self.updates.get_nowait())
+        return updates
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await self._params(request)
+        self.calls.append((time.monotonic(), method, params))
+        if self.on_call is not None:
+            self.on_call(time.monotonic(), method, params)
+        name = method.lower()
+        if name == "getupdates":
+            result = await self._get_updates(params)
+        elif name == "getme":
+            result = {"id": 1, "is_bot": True, "first_name": "PumbaBot", "username": "pumba_bot"}
+        elif name == "getchat":
+            result = {"id": params.get("chat_id"), "type": "private", "first_name": "User"}
+        elif name == "getfile":
+            file_id = params.get("file_id")
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_size": self.file_size, "file_path": f"files/{file_id}"}
+        elif name == "sendmessage" or name == "editmessagetext":
+            result = self._sent(params, text=params.get("text", ""))
+        elif name == "sendphoto":
+            result = self._sent(params, photo=self._photo_sizes("sent"))
+        elif name == "senddocument":
+            result = self._sent(params, document={"file_id": "sent", "file_unique_id": "sent"})
+        elif name == "sendmediagroup":
+            result = [self._sent(params) for _ in params.get("media") or [None]]
+        else:
+            # setWebhook, deleteWebhook, deleteMessage, answerCallbackQuery и прочее
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_file(self, request: web.Request) -> web.Response:
+        return web.Response(body=b"\0" * self.file_size, content_type="application/octet-stream")
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8082) -> web.AppRunner:
+        runner = web.AppRunner(self.app, shutdown_timeout=1.0)  # не ждать долгих getUpdates при остановке
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+async def post_update(session: aiohttp.ClientSession, webhook_url: str, secret: str, update: dict) -> int:
+    """Доставить апдейт в вебхук бота так же, как это делает Telegram. Возвращает HTTP-статус."""
+    async with session.post(webhook_url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": secret}) as response:
+        return response.status
+
+
+async def _serve(args):
+    fake = FakeTelegram()
+    await fake.start(args.host, args.port)
+    print(f"Заглушка Bot API слушает http://{args.host}:{args.port}")
+    await asyncio.Event().wait()
+
+
+async def _send(args):
+    fake = FakeTelegram()
+    update = fake.text_update(args.user, args.text)
+    update["update_id"] = int(time.time() * 1000)
+    async with aiohttp.ClientSession() as session:
+        status = await post_update(session, args.webhook, args.secret, update)
+    print(f"update_id={update['update_id']}: HTTP {status}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка Telegram Bot API")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="запустить заглушку Bot API")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8082)
+    send = commands.add_parser("send", help="отправить текстовый апдейт в вебхук")
+    send.add_argument("--webhook", required=True)
+    send.add_argument("--secret", required=True)
+    send.add_argument("--user", type=int, required=True)
+    send.add_argument("--text", required=True)
+    args = parser.parse_args()
+    asyncio.run(_serve(args) if args.command == "serve" else _send(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,12 @@
 import asyncio
 import uvicorn
-from aiogram import Bot, Dispatcher, F
+from aiogram import Bot, Dispatcher, F, BaseMiddleware
 from aiogram.filters import Command, BaseFilter
 from aiogram.types import Message, ContentType, FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, InputMediaPhoto, InputMediaDocument
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from app import app, sio, message_queue, set_event_loop, send_notification_to_topic, get_setting
+from app import app, sio, message_queue, set_event_loop, send_notification_to_topic, get_setting, dashboard_batcher, RUN_MODE, BUS_URL, WEBHOOK_PATH, create_bot, auto_close_scheduler, loop_monitor
+from fastapi import Request, HTTPException
 from dotenv import load_dotenv
 import os
 import logging
@@ -15,34 +16,83 @@ from dateutil.relativedelta import relativedelta
 import pytz
 import time
 import re
+import secrets
+import hmac
+import db
+import tracing
+import schedule
+import maintenance
+import thumbnails
+from bus import create_job_queue
+from metrics import REGISTRY, CONTENT_TYPE, HANDLER_SECONDS, HANDLER_ERRORS, MESSAGE_QUEUE_SEND_SECONDS
 
 from collections import defaultdict
 media_group_collector = defaultdict(list)
 media_group_timer = {}
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[logging.FileHandler('bot.log'), logging.StreamHandler()]
-)
-
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_TELEGRAM_ID = os.getenv("ADMIN_TELEGRAM_ID")
 NOTIFICATION_CHAT_ID = os.getenv("NOTIFICATION_CHAT_ID")
 NOTIFICATION_TOPIC_ID = os.getenv("NOTIFICATION_TOPIC_ID")
 BASE_URL = os.getenv("BASE_URL", "http://localhost:8081")
+UPDATES_MODE = os.getenv("UPDATES_MODE", "polling")  # polling или webhook
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "10"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # /metrics процесса бота при RUN_MODE=bot
 
 if not BOT_TOKEN or not ADMIN_TELEGRAM_ID:
     logging.error("BOT_TOKEN или ADMIN_TELEGRAM_ID не указаны в .env")
     raise ValueError("BOT_TOKEN and ADMIN_TELEGRAM_ID must be set in .env file")
 
-bot = Bot(token=BOT_TOKEN)
+if UPDATES_MODE == "webhook" and not WEBHOOK_SECRET:
+    logging.error("UPDATES_MODE=webhook требует WEBHOOK_SECRET в .env")
+    raise ValueError("WEBHOOK_SECRET must be set in .env file for webhook mode")
+
+bot = create_bot(BOT_TOKEN)
 dp = Dispatcher()
 
-conn = sqlite3.connect("support.db", timeout=10)
+# Входящие апдейты из вебхука: ответ Telegram сразу, обработка — воркерами из ограниченных очередей.
+# Апдейты одного чата всегда попадают в одну очередь, чтобы сообщения пользователя шли по порядку.
+update_queues = [asyncio.Queue(maxsize=max(1, WEBHOOK_QUEUE_SIZE // WEBHOOK_WORKERS)) for _ in range(WEBHOOK_WORKERS)]
+update_workers_started = False
+# Обработчики держат состояние в памяти процесса: FSM регистрации (хранилище Dispatcher) и сборку
+# альбомов (media_group_collector). При RUN_MODE=web воркеров несколько, поэтому они только
+# пересылают апдейт через шину, а обрабатывает его один процесс бота (RUN_MODE=bot)
+FORWARD_UPDATES = UPDATES_MODE == "webhook" and RUN_MODE == "web" and bool(BUS_URL)
+update_bus = create_job_queue(BUS_URL, "updates") if UPDATES_MODE == "webhook" and RUN_MODE in ("web", "bot") and BUS_URL else None
+# Запись в шину (SQLite или Redis) не должна задерживать ответ Telegram: апдейт кладётся в
+# ограниченную очередь, а в шину его отправляет фоновая задача
+forward_queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+forward_task = None
+
+conn = db.connect()
 cursor = conn.cursor()
 
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        name = getattr(data["handler"].callback, "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            with tracing.span(f"handler {name}"):
+                return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
+
+class UpdateTracingMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        # Альбом обрабатывается отложенной задачей — она унаследует трассу последнего фото
+        with tracing.trace("telegram.update", update_id=event.update_id, type=event.event_type):
+            return await handler(event, data)
+
+dp.update.outer_middleware(UpdateTracingMiddleware())
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+
 # Define registration states
 class RegistrationStates(StatesGroup):
     waiting_for_login = State()
@@ -50,37 +100,39 @@ class RegistrationStates(StatesGroup):
 class ChatTopicFilter(BaseFilter):
     async def __call__(self, message: Message) -> bool:
         is_private = message.chat.type == "private"
-        logging.debug(f"Проверка сообщения: chat_id={message.chat.id}, chat_type={message.chat.type}, is_private={is_private}")
+        logging.debug("Проверка сообщения: chat_id=%s, chat_type=%s, is_private=%s", message.chat.id, message.chat.type, is_private)
         return is_private
 
 async def send_notification_if_enabled(bot, ticket_id, login):
     try:
-        conn = sqlite3.connect("support.db", timeout=10)
+        conn = db.connect()
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         cursor.execute("SELECT notification_enabled, assigned_to, auto_close_enabled FROM tickets WHERE ticket_id = ?", (ticket_id,))
         row = cursor.fetchone()
-        logging.debug(f"Проверка уведомления: ticket_id={ticket_id}, notification_enabled={row[0] if row else None}, assigned_to={row[1] if row else None}, auto_close_enabled={row[2] if row else None}")
+        logging.debug("Проверка уведомления: ticket_id=%s, notification_enabled=%s, assigned_to=%s, auto_close_enabled=%s", ticket_id, row[0] if row else None, row[1] if row else None, row[2] if row else None)
         if row and row[1]:  # Если есть assigned_to
             message = f"Новый ответ в тикете #{ticket_id} от {login}."
             if row[2]:  # Если автозакрытие включено
                 message += " Автозакрытие выключено."
             if row[0] or row[2]:  # Уведомляем, если включен колокольчик или было автозакрытие
                 await bot.send_message(row[1], message)
-                logging.debug(f"Уведомление отправлено assigned_to={row[1]} для ticket_id={ticket_id}")
+                logging.debug("Уведомление отправлено assigned_to=%s для ticket_id=%s", row[1], ticket_id)
             else:
-                logging.debug(f"Уведомление не отправлено: колокольчик выключен и автозакрытие неактивно для ticket_id={ticket_id}")
+                logging.debug("Уведомление не отправлено: колокольчик выключен и автозакрытие неактивно для ticket_id=%s", ticket_id)
         else:
-            logging.debug(f"Уведомление не отправлено: ticket_id={ticket_id}, данные={row}")
+            logging.debug("Уведомление не отправлено: ticket_id=%s, данные=%s", ticket_id, row)
         conn.close()
     except Exception as e:
         logging.error(f"Ошибка отправки уведомления для ticket_id={ticket_id}: {e}")
 
 def init_db():
     logging.debug("Начало инициализации базы данных")
-    conn = sqlite3.connect("support.db", timeout=10)
+    conn = db.connect()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
+    # Действует только на новую базу; существующую переводит maintenance.py в нерабочее время
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS employees (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -206,6 +258,24 @@ def init_db():
             UNIQUE (ticket_id, employee_id)
         )
     """)
+    # Счётчики оценок ведут триггеры ниже; при первом создании таблиц заполняем их по уже выставленным оценкам.
+    # Строка ticket_stats удаляется при архивации тикета (archive.py), строка employee_stats остаётся,
+    # как и сами оценки сотрудника, даже после его удаления
+    for stats_table, ratings_table, key in (("employee_stats", "employee_ratings", "employee_id"), ("ticket_stats", "ticket_ratings", "ticket_id")):
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (stats_table,))
+        if cursor.fetchone():
+            continue
+        cursor.execute(f"""
+            CREATE TABLE {stats_table} (
+                {key} INTEGER PRIMARY KEY,
+                thumbs_up INTEGER NOT NULL DEFAULT 0,
+                thumbs_down INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        cursor.execute(f"""
+            INSERT INTO {stats_table} ({key}, thumbs_up, thumbs_down)
+            SELECT {key}, SUM(rating IS 'up'), SUM(rating IS 'down') FROM {ratings_table} GROUP BY {key}
+        """)
     cursor.execute("PRAGMA table_info(messages)")
     columns = [col[1] for col in cursor.fetchall()]
     if 'telegram_message_id' not in columns:
@@ -213,36 +283,127 @@ def init_db():
         cursor.execute("ALTER TABLE messages ADD COLUMN telegram_message_id INTEGER")
     try:
         admin_telegram_id = int(ADMIN_TELEGRAM_ID)
-        logging.debug(f"Проверка ADMIN_TELEGRAM_ID: {admin_telegram_id}")
+        logging.debug("Проверка ADMIN_TELEGRAM_ID: %s", admin_telegram_id)
         cursor.execute("SELECT telegram_id, is_admin FROM employees WHERE telegram_id = ?", (admin_telegram_id,))
         employee = cursor.fetchone()
         if not employee:
-            logging.debug(f"Добавление администратора: telegram_id={admin_telegram_id}")
+            logging.debug("Добавление администратора: telegram_id=%s", admin_telegram_id)
             cursor.execute(
                 "INSERT INTO employees (telegram_id, login, is_admin) VALUES (?, ?, ?)",
                 (admin_telegram_id, "admin", True)
             )
         elif not employee["is_admin"]:
-            logging.debug(f"Обновление is_admin для telegram_id={admin_telegram_id}")
+            logging.debug("Обновление is_admin для telegram_id=%s", admin_telegram_id)
             cursor.execute(
                 "UPDATE employees SET is_admin = ? WHERE telegram_id = ?",
                 (True, admin_telegram_id)
             )
         else:
-            logging.debug(f"Администратор уже существует: telegram_id={admin_telegram_id}, is_admin={employee['is_admin']}")
+            logging.debug("Администратор уже существует: telegram_id=%s, is_admin=%s", admin_telegram_id, employee['is_admin'])
     except ValueError as e:
         logging.error(f"Некорректный ADMIN_TELEGRAM_ID в .env: {e}")
         raise
     conn.commit()
     cursor.execute("SELECT telegram_id, login, is_admin FROM employees")
     employees = cursor.fetchall()
-    logging.debug(f"Содержимое таблицы employees после init_db: {employees}")
+    logging.debug("Сотрудников после init_db: %s", len(employees))
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS settings (
             key TEXT PRIMARY KEY,
             value TEXT NOT NULL
         )
     """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS holidays (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            start_date TEXT NOT NULL,
+            end_date TEXT NOT NULL,
+            name TEXT,
+            message TEXT
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_holidays_end_date ON holidays (end_date)")
+    # Страница тикета листает сообщения по (timestamp, message_id), см. fetch_ticket_messages
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_ticket_timestamp ON messages (ticket_id, timestamp, message_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_attachments_message_id ON attachments (message_id)")
+    # Миниатюра и размеры оригинала для изображений (см. thumbnails.py), исходное имя файла —
+    # для Content-Disposition при скачивании из /Uploads
+    cursor.execute("PRAGMA table_info(attachments)")
+    attachment_columns = [col[1] for col in cursor.fetchall()]
+    for column, column_type in (("thumb_path", "TEXT"), ("width", "INTEGER"), ("height", "INTEGER"), ("original_name", "TEXT")):
+        if column not in attachment_columns:
+            logging.debug("Добавление столбца %s в таблицу attachments", column)
+            cursor.execute(f"ALTER TABLE attachments ADD COLUMN {column} {column_type}")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_attachments_file_path ON attachments (file_path)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_attachments_thumb_path ON attachments (thumb_path)")
+
+    # Счётчики изменений: tickets — для инкрементальной синхронизации дашборда (/api/tickets/open?since=)
+    # и ETag страниц тикетов, global — для прочих данных на страницах (сотрудники, быстрые ответы,
+    # муты, баны, настройки). Их ведут триггеры, поэтому любые записи из бота и веба учитываются
+    # без правок в местах записи.
+    cursor.execute("PRAGMA table_info(tickets)")
+    if 'version' not in [col[1] for col in cursor.fetchall()]:
+        logging.debug("Добавление столбца version в таблицу tickets")
+        cursor.execute("ALTER TABLE tickets ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tickets_version ON tickets (version)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sequences (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("PRAGMA table_info(sequences)")
+    if 'updated_at' not in [col[1] for col in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE sequences ADD COLUMN updated_at INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("INSERT OR IGNORE INTO sequences (name, value, updated_at) VALUES ('tickets', 0, CAST(strftime('%s', 'now') AS INTEGER))")
+    cursor.execute("INSERT OR IGNORE INTO sequences (name, value, updated_at) VALUES ('global', 0, CAST(strftime('%s', 'now') AS INTEGER))")
+    bump_sequence = "UPDATE sequences SET value = value + 1, updated_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE name = '{name}';"
+    bump_ticket = bump_sequence.format(name="tickets") + """
+        UPDATE tickets SET version = (SELECT value FROM sequences WHERE name = 'tickets') WHERE ticket_id = {ticket_id};
+    """
+    version_triggers = {
+        "tickets_version_insert": ("AFTER INSERT ON tickets", bump_ticket.format(ticket_id="NEW.ticket_id")),
+        # Условие WHEN отсекает UPDATE самого триггера, который меняет только version
+        "tickets_version_update": ("AFTER UPDATE ON tickets WHEN NEW.version IS OLD.version", bump_ticket.format(ticket_id="NEW.ticket_id")),
+    }
+    for table in ("messages", "admin_messages"):
+        version_triggers[f"{table}_version_insert"] = (f"AFTER INSERT ON {table}", bump_ticket.format(ticket_id="NEW.ticket_id"))
+        version_triggers[f"{table}_version_update"] = (f"AFTER UPDATE ON {table}", bump_ticket.format(ticket_id="NEW.ticket_id"))
+        version_triggers[f"{table}_version_delete"] = (f"AFTER DELETE ON {table}", bump_ticket.format(ticket_id="OLD.ticket_id"))
+    version_triggers["attachments_version_insert"] = (
+        "AFTER INSERT ON attachments",
+        bump_ticket.format(ticket_id="(SELECT ticket_id FROM messages WHERE message_id = NEW.message_id)"),
+    )
+    # Миниатюра фото оператора дописывается после отправки в Telegram
+    version_triggers["attachments_version_update"] = (
+        "AFTER UPDATE ON attachments",
+        bump_ticket.format(ticket_id="(SELECT ticket_id FROM messages WHERE message_id = NEW.message_id)"),
+    )
+    for table in ("employees", "quick_replies", "mutes", "bans", "settings"):
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            version_triggers[f"{table}_version_{event.lower()}"] = (f"AFTER {event} ON {table}", bump_sequence.format(name="global"))
+    # Триггеры срабатывают в той же транзакции, что и изменение оценки, в том числе при удалении
+    # оценок на переоткрытии и закрытии тикета. REPLACE удаляет строку без DELETE-триггеров
+    # (recursive_triggers выключен), поэтому повторная оценка пишется через ON CONFLICT DO UPDATE.
+    # Внутри триггера без OR IGNORE: политика ON CONFLICT внешнего запроса подменила бы её.
+    rating_triggers = {}
+    for stats_table, ratings_table, key in (("employee_stats", "employee_ratings", "employee_id"), ("ticket_stats", "ticket_ratings", "ticket_id")):
+        add = f"""
+            INSERT INTO {stats_table} ({key}) SELECT NEW.{key} WHERE NOT EXISTS (SELECT 1 FROM {stats_table} WHERE {key} = NEW.{key});
+            UPDATE {stats_table} SET thumbs_up = thumbs_up + (NEW.rating IS 'up'), thumbs_down = thumbs_down + (NEW.rating IS 'down')
+            WHERE {key} = NEW.{key};
+        """
+        subtract = f"""
+            UPDATE {stats_table} SET thumbs_up = thumbs_up - (OLD.rating IS 'up'), thumbs_down = thumbs_down - (OLD.rating IS 'down')
+            WHERE {key} = OLD.{key};
+        """
+        rating_triggers[f"{ratings_table}_stats_insert"] = (f"AFTER INSERT ON {ratings_table}", add)
+        rating_triggers[f"{ratings_table}_stats_update"] = (f"AFTER UPDATE ON {ratings_table}", subtract + add)
+        rating_triggers[f"{ratings_table}_stats_delete"] = (f"AFTER DELETE ON {ratings_table}", subtract)
+    # Пересоздаём при каждом старте, чтобы в базе всегда были актуальные определения
+    for name, (event, body) in {**version_triggers, **rating_triggers}.items():
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+        cursor.execute(f"CREATE TRIGGER {name} {event} BEGIN {body} END")
     # Инициализация настроек по умолчанию
     default_settings = [
         ('registration_greeting', 'Вы можете создавать тикеты, отправив сообщение или файл.'),
@@ -251,7 +412,8 @@ def init_db():
         ('holiday_message', 'Сегодня праздничный день, поэтому ответ может занять больше времени.'),
         ('working_hours_start', '12:00'),
         ('working_hours_end', '00:00'),
-        ('weekend_days', '0,6'),  # 0=воскресенье, 6=суббота
+        ('weekend_days', '0,6'),  # 0=понедельник, 6=воскресенье (datetime.weekday())
+        ('weekday_hours', ''),  # часы по дням недели: 4=10:00-17:00,5=11:00-15:00
         ('is_holiday', '0')  # 0=не праздник, 1=праздник
     ]
     for key, value in default_settings:
@@ -263,49 +425,19 @@ def init_db():
     conn.close()
     logging.debug("Инициализация базы данных завершена")
 
-def is_working_hours():
-    from app import get_setting
-    astana_tz = pytz.timezone('Asia/Almaty')
-    now = datetime.now(astana_tz)
-    is_holiday = get_setting("is_holiday", "0") == "1"
-    weekend_days = [int(day) for day in get_setting("weekend_days", "0,6").split(",")]
-    working_hours_start = get_setting("working_hours_start", "12:00")
-    working_hours_end = get_setting("working_hours_end", "00:00")
-    
-    logging.debug(f"Проверка рабочего времени: is_holiday={is_holiday}, now={now}, weekend_days={weekend_days}, "
-                  f"working_hours_start={working_hours_start}, working_hours_end={working_hours_end}")
-    
-    if is_holiday:
-        logging.debug("Сегодня праздничный день, возвращаем False")
-        return False
-    
-    is_weekday = now.weekday() not in weekend_days
-    logging.debug(f"Проверка дня недели: now.weekday()={now.weekday()}, is_weekday={is_weekday}")
-    
-    start_time = datetime.strptime(working_hours_start, "%H:%M").time()
-    end_time = datetime.strptime(working_hours_end, "%H:%M").time()
-    current_time = now.time()
-    
-    is_working_time = start_time <= current_time <= end_time
-    logging.debug(f"Проверка времени: current_time={current_time}, start_time={start_time}, end_time={end_time}, "
-                  f"is_working_time={is_working_time}")
-    
-    return is_weekday and is_working_time
-
 def get_unique_filename(filename: str, directory: str = "Uploads"):
     cleaned_filename = re.sub(r'[^\w\-\.]', '_', filename)
     cleaned_filename = re.sub(r'_+', '_', cleaned_filename).strip('_')
     base, ext = os.path.splitext(cleaned_filename)
-    counter = 0
-    new_filename = cleaned_filename
+    # Случайный токен: URL вложения никогда не переиспользуется, поэтому /Uploads кэшируется как immutable
+    new_filename = f"{base}_{secrets.token_hex(4)}{ext}"
     while os.path.exists(os.path.join(directory, new_filename)):
-        counter += 1
-        new_filename = f"{base}_{counter}{ext}"
-    logging.debug(f"Сгенерировано уникальное имя файла: {filename} -> {new_filename}")
+        new_filename = f"{base}_{secrets.token_hex(4)}{ext}"
+    logging.debug("Сгенерировано уникальное имя файла: %s -> %s", filename, new_filename)
     return new_filename
 
 def is_muted(user_id: int) -> bool:
-    conn = sqlite3.connect("support.db", timeout=10)
+    conn = db.connect()
     cursor = conn.cursor()
     cursor.execute("SELECT end_time FROM mutes WHERE user_id = ?", (user_id,))
     row = cursor.fetchone()
@@ -319,7 +451,7 @@ def is_muted(user_id: int) -> bool:
     return False
 
 def is_banned(user_id: int) -> bool:
-    conn = sqlite3.connect("support.db", timeout=10)
+    conn = db.connect()
     cursor = conn.cursor()
     cursor.execute("SELECT end_time FROM bans WHERE user_id = ?", (user_id,))
     row = cursor.fetchone()
@@ -335,14 +467,14 @@ def is_banned(user_id: int) -> bool:
     return False
 
 def remove_mute(user_id: int):
-    conn = sqlite3.connect("support.db", timeout=10)
+    conn = db.connect()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM mutes WHERE user_id = ?", (user_id,))
     conn.commit()
     conn.close()
 
 def remove_ban(user_id: int):
-    conn = sqlite3.connect("support.db", timeout=10)
+    conn = db.connect()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM bans WHERE user_id = ?", (user_id,))
     conn.commit()
@@ -351,7 +483,7 @@ def remove_ban(user_id: int):
 @dp.message(Command(commands=["start"]))
 async def start_command(message: Message, state: FSMContext):
     telegram_id = message.from_user.id
-    conn = sqlite3.connect("support.db", timeout=10)
+    conn = db.connect()
     cursor = conn.cursor()
     cursor.execute("SELECT login, is_admin FROM employees WHERE telegram_id = ?", (telegram_id,))
     employee = cursor.fetchone()
@@ -385,7 +517,7 @@ async def process_registration_login(message: Message, state: FSMContext):
         await message.reply("Некорректный логин. Используйте формат электронной почты (например, user@domain.com).")
         return
 
-    conn = sqlite3.connect("support.db", timeout=10)
+    conn = db.connect()
     cursor = conn.cursor()
     try:
         cursor.execute(
@@ -395,7 +527,7 @@ async def process_registration_login(message: Message, state: FSMContext):
         conn.commit()
         greeting = get_setting("registration_greeting", "Вы можете создавать тикеты, отправив сообщение или файл.")
         await message.reply(f"Регистрация завершена! Добро пожаловать, {login}! {greeting}")
-        logging.debug(f"Зарегистрирован новый пользователь: telegram_id={telegram_id}, login={login}")
+        logging.debug("Зарегистрирован новый пользователь: telegram_id=%s, login=%s", telegram_id, login)
     except sqlite3.IntegrityError:
         await message.reply("Этот логин уже занят. Пожалуйста, выберите другой логин.")
         return
@@ -420,7 +552,7 @@ async def handle_photo(message: Message):
         await message.reply("Вам временно запрещено писать в бота!")
         return
 
-    conn = sqlite3.connect("support.db", timeout=10)
+    conn = db.connect()
     cursor = conn.cursor()
     cursor.execute("SELECT login FROM employees WHERE telegram_id = ?", (telegram_id,))
     employee = cursor.fetchone()
@@ -435,7 +567,8 @@ async def handle_photo(message: Message):
 
     if not media_group_id:
         # Одиночное фото
-        await handle_file(message, 'image')
+        with HANDLER_SECONDS.time(handler="handle_file"), tracing.span("handler handle_file"):
+            await handle_file(message, 'image')
         return
 
     # Собираем группу
@@ -448,7 +581,8 @@ async def handle_photo(message: Message):
     # Вспомогательная функция для задержки
     async def delayed_process(mg_id):
         await asyncio.sleep(1)  # Ждём 1 сек на сбор всех фото
-        await process_media_group(mg_id)
+        with HANDLER_SECONDS.time(handler="process_media_group"), tracing.span("handler process_media_group"):
+            await process_media_group(mg_id)
 
     # Запускаем таймер
     media_group_timer[media_group_id] = asyncio.create_task(delayed_process(media_group_id))
@@ -462,11 +596,19 @@ async def process_media_group(mg_id):
     timestamp = messages[0].date.astimezone(astana_tz).isoformat()
     caption = messages[0].caption if messages[0].caption else None
     telegram_id = messages[0].from_user.id
-    conn = sqlite3.connect("support.db", timeout=10)
+    conn = db.connect()
     cursor = conn.cursor()
     cursor.execute("SELECT login FROM employees WHERE telegram_id = ?", (telegram_id,))
     login = cursor.fetchone()[0]
 
+    # Файлы качаем до первой записи: транзакция не должна держать блокировку базы, пока идёт сеть
+    attachments_list = list(await asyncio.gather(*(
+        thumbnails.save_photo(
+            bot, msg.photo, get_unique_filename(f"image_{int(time.time())}_{i}.jpg", directory="Uploads"), get_unique_filename
+        )
+        for i, msg in enumerate(messages)
+    )))
+
     cursor.execute(
         "SELECT ticket_id FROM tickets WHERE telegram_id = ? AND status = 'open'",
         (telegram_id,)
@@ -502,7 +644,7 @@ async def process_media_group(mg_id):
             (ticket_id,)
         )
         conn.commit()
-        logging.debug(f"Reopened ticket #{ticket_id} for telegram_id={telegram_id}")
+        logging.debug("Reopened ticket #%s for telegram_id=%s", ticket_id, telegram_id)
         is_new_ticket = False
     elif is_new_ticket:
         cursor.execute(
@@ -520,7 +662,8 @@ async def process_media_group(mg_id):
             "UPDATE tickets SET auto_close_enabled = 0, auto_close_time = NULL WHERE ticket_id = ?",
             (ticket_id,)
         )
-        await sio.emit('auto_close_updated', {
+        auto_close_scheduler.cancel(ticket_id)
+        await dashboard_batcher.emit('auto_close_updated', {
             "ticket_id": ticket_id,
             "enabled": False,
             "auto_close_time": None
@@ -534,29 +677,24 @@ async def process_media_group(mg_id):
     )
     message_id = cursor.lastrowid
 
-    attachments_list = []
-    for i, msg in enumerate(messages):
-        file_id = msg.photo[-1].file_id
-        file_name_original = f"image_{int(time.time())}_{i}.jpg"
-        file_name = get_unique_filename(file_name_original, directory="Uploads")
-        file_path = f"Uploads/{file_name}"
-
-        os.makedirs("Uploads", exist_ok=True)
-        file = await bot.get_file(file_id)
-        await bot.download_file(file.file_path, file_path)
-
-        cursor.execute(
-            "INSERT INTO attachments (message_id, file_path, file_name, file_type) VALUES (?, ?, ?, ?)",
-            (message_id, file_path, file_name, 'image')
-        )
-        attachments_list.append({"file_path": file_path, "file_name": file_name, "file_type": "image"})
+    cursor.executemany(
+        "INSERT INTO attachments (message_id, file_path, file_name, file_type, thumb_path, width, height) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [(message_id, a["file_path"], a["file_name"], a["file_type"], a["thumb_path"], a["width"], a["height"]) for a in attachments_list]
+    )
+    # Флаги читаем до закрытия соединения — ниже они нужны для update_tickets
+    if is_new_ticket:
+        auto_close_enabled, notification_enabled = 0, 0
+    else:
+        auto_close_enabled, notification_enabled = cursor.execute(
+            "SELECT auto_close_enabled, notification_enabled FROM tickets WHERE ticket_id = ?", (ticket_id,)
+        ).fetchone()
 
     conn.commit()
     conn.close()
 
     await send_notification_if_enabled(bot, ticket_id, login)
 
-    await sio.emit("new_message", {
+    await dashboard_batcher.emit("new_message", {
         "ticket_id": ticket_id,
         "telegram_id": telegram_id,
         "text": text,
@@ -568,7 +706,7 @@ async def process_media_group(mg_id):
     })
 
     skip_standard_reply = recent_ticket and not ticket
-    await sio.emit("update_tickets", {
+    await dashboard_batcher.emit("update_tickets", {
         "ticket_id": ticket_id,
         "telegram_id": telegram_id,
         "login": login,
@@ -576,18 +714,14 @@ async def process_media_group(mg_id):
         "last_message_timestamp": timestamp,
         "issue_type": None,
         "attachments": attachments_list,
-        "auto_close_enabled": 0 if is_new_ticket else cursor.execute("SELECT auto_close_enabled FROM tickets WHERE ticket_id=?", (ticket_id,)).fetchone()[0],
-        "notification_enabled": 0 if is_new_ticket else cursor.execute("SELECT notification_enabled FROM tickets WHERE ticket_id=?", (ticket_id,)).fetchone()[0]
+        "auto_close_enabled": auto_close_enabled,
+        "notification_enabled": notification_enabled
     })
     if is_new_ticket or skip_standard_reply:
         await send_notification_to_topic(ticket_id, login, "Новый тикет создан", is_reopened=(recent_ticket and not ticket))
         if not skip_standard_reply:
-            reply_text = get_setting("new_ticket_response", "Обращение принято. При необходимости прикрепите скриншот или файл с логами.")
-            if not is_working_hours():
-                if get_setting("is_holiday", "0") == "1":
-                    reply_text += "\n\n" + get_setting("holiday_message", "Сегодня праздничный день, поэтому ответ может занять больше времени.")
-                else:
-                    reply_text += "\n\n" + get_setting("non_working_hours_message", "Обратите внимание: сейчас выходные или нерабочее время. Мы стараемся оперативно отвечать с 12:00 до 00:00 по будням, но в это время ответ может занять больше времени.")
+            # Тексты и график уже в памяти, см. schedule.py
+            reply_text = schedule.current().auto_reply()
             await messages[0].reply(reply_text)
             if skip_standard_reply:
                 cursor.execute(
@@ -595,17 +729,19 @@ async def process_media_group(mg_id):
                     (ticket_id,)
                 )
                 conn.commit()
-                logging.debug(f"Флаг is_reopened_recently сброшен для ticket_id={ticket_id}")
+                logging.debug("Флаг is_reopened_recently сброшен для ticket_id=%s", ticket_id)
         else:
             await messages[0].reply("Обращение открыто повторно.")
-            logging.debug(f"Стандартный ответ пропущен для переоткрытого ticket_id={ticket_id}")
+            logging.debug("Стандартный ответ пропущен для переоткрытого ticket_id=%s", ticket_id)
 
     if mg_id in media_group_timer:
         del media_group_timer[mg_id]
 
 @dp.message(ChatTopicFilter(), F.document)
 async def handle_document(message: Message):
-    await handle_file(message, 'document')
+    # handle_file меряем отдельно: middleware видит только обёртки handle_photo и handle_document
+    with HANDLER_SECONDS.time(handler="handle_file"), tracing.span("handler handle_file"):
+        await handle_file(message, 'document')
 
 async def handle_file(message: Message, file_type: str):
     telegram_id = message.from_user.id
@@ -615,7 +751,7 @@ async def handle_file(message: Message, file_type: str):
         await message.reply("Вам временно запрещено писать в бота!")
         return
 
-    conn = sqlite3.connect("support.db", timeout=10)
+    conn = db.connect()
     cursor = conn.cursor()
     cursor.execute("SELECT login FROM employees WHERE telegram_id = ?", (telegram_id,))
     employee = cursor.fetchone()
@@ -629,7 +765,15 @@ async def handle_file(message: Message, file_type: str):
     astana_tz = pytz.timezone('Asia/Almaty')
     timestamp = message.date.astimezone(astana_tz).isoformat()
 
-    conn = sqlite3.connect("support.db", timeout=10)
+    # Файл качаем до открытия транзакции: запись в базу не должна ждать сеть
+    if file_type == 'image':
+        file_name = get_unique_filename(f"image_{int(time.time())}.jpg", directory="Uploads")
+        attachment = await thumbnails.save_photo(bot, message.photo, file_name, get_unique_filename)
+    else:
+        file_name = get_unique_filename(message.document.file_name or 'document', directory="Uploads")
+        attachment = await thumbnails.save_document(bot, message.document, file_name, get_unique_filename)
+
+    conn = db.connect()
     cursor = conn.cursor()
     cursor.execute(
         "SELECT ticket_id FROM tickets WHERE telegram_id = ? AND status = 'open'",
@@ -666,7 +810,7 @@ async def handle_file(message: Message, file_type: str):
             (ticket_id,)
         )
         conn.commit()
-        logging.debug(f"Reopened ticket #{ticket_id} for telegram_id={telegram_id}")
+        logging.debug("Reopened ticket #%s for telegram_id=%s", ticket_id, telegram_id)
         is_new_ticket = False
     elif is_new_ticket:
         cursor.execute(
@@ -684,25 +828,13 @@ async def handle_file(message: Message, file_type: str):
             "UPDATE tickets SET auto_close_enabled = 0, auto_close_time = NULL WHERE ticket_id = ?",
             (ticket_id,)
         )
-        await sio.emit('auto_close_updated', {
+        auto_close_scheduler.cancel(ticket_id)
+        await dashboard_batcher.emit('auto_close_updated', {
             "ticket_id": ticket_id,
             "enabled": False,
             "auto_close_time": None
         })
 
-    if file_type == 'image':
-        file_id = message.photo[-1].file_id
-        file_name_original = f"image_{int(time.time())}.jpg"
-    else:
-        file_id = message.document.file_id
-        file_name_original = message.document.file_name if message.document.file_name else 'document'
-    file_name = get_unique_filename(file_name_original, directory="Uploads")
-    file_path = f"Uploads/{file_name}"
-
-    os.makedirs("Uploads", exist_ok=True)
-    file = await bot.get_file(file_id)
-    await bot.download_file(file.file_path, file_path)
-
     text = message.caption or ""
     cursor.execute(
         "INSERT INTO messages (ticket_id, telegram_id, employee_telegram_id, text, is_from_bot, timestamp, telegram_message_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
@@ -711,17 +843,25 @@ async def handle_file(message: Message, file_type: str):
     message_id = cursor.lastrowid
 
     cursor.execute(
-        "INSERT INTO attachments (message_id, file_path, file_name, file_type) VALUES (?, ?, ?, ?)",
-        (message_id, file_path, file_name, file_type)
+        "INSERT INTO attachments (message_id, file_path, file_name, file_type, thumb_path, width, height, original_name) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (message_id, attachment["file_path"], attachment["file_name"], attachment["file_type"],
+         attachment["thumb_path"], attachment["width"], attachment["height"], message.document.file_name if file_type != 'image' else None)
     )
+    # Флаги читаем до закрытия соединения — ниже они нужны для update_tickets
+    if is_new_ticket:
+        auto_close_enabled, notification_enabled = 0, 0
+    else:
+        auto_close_enabled, notification_enabled = cursor.execute(
+            "SELECT auto_close_enabled, notification_enabled FROM tickets WHERE ticket_id = ?", (ticket_id,)
+        ).fetchone()
     conn.commit()
     conn.close()
 
     await send_notification_if_enabled(bot, ticket_id, login)
 
-    attachments_list = [{"file_path": file_path, "file_name": file_name, "file_type": file_type}]
+    attachments_list = [attachment]
 
-    await sio.emit("new_message", {
+    await dashboard_batcher.emit("new_message", {
         "ticket_id": ticket_id,
         "telegram_id": telegram_id,
         "text": text,
@@ -733,7 +873,7 @@ async def handle_file(message: Message, file_type: str):
     })
 
     skip_standard_reply = recent_ticket and not ticket
-    await sio.emit("update_tickets", {
+    await dashboard_batcher.emit("update_tickets", {
         "ticket_id": ticket_id,
         "telegram_id": telegram_id,
         "login": login,
@@ -741,18 +881,14 @@ async def handle_file(message: Message, file_type: str):
         "last_message_timestamp": timestamp,
         "issue_type": None,
         "attachments": attachments_list,
-        "auto_close_enabled": 0 if is_new_ticket else cursor.execute("SELECT auto_close_enabled FROM tickets WHERE ticket_id=?", (ticket_id,)).fetchone()[0],
-        "notification_enabled": 0 if is_new_ticket else cursor.execute("SELECT notification_enabled FROM tickets WHERE ticket_id=?", (ticket_id,)).fetchone()[0]
+        "auto_close_enabled": auto_close_enabled,
+        "notification_enabled": notification_enabled
     })
     if is_new_ticket or skip_standard_reply:
         await send_notification_to_topic(ticket_id, login, "Новый тикет создан", is_reopened=(recent_ticket and not ticket))
         if not skip_standard_reply:
-            reply_text = get_setting("new_ticket_response", "Обращение принято. При необходимости прикрепите скриншот или файл с логами.")
-            if not is_working_hours():
-                if get_setting("is_holiday", "0") == "1":
-                    reply_text += "\n\n" + get_setting("holiday_message", "Сегодня праздничный день, поэтому ответ может занять больше времени.")
-                else:
-                    reply_text += "\n\n" + get_setting("non_working_hours_message", "Обратите внимание: сейчас выходные или нерабочее время. Мы стараемся оперативно отвечать с 12:00 до 00:00 по будням, но в это время ответ может занять больше времени.")
+            # Тексты и график уже в памяти, см. schedule.py
+            reply_text = schedule.current().auto_reply()
             await message.reply(reply_text)
             if skip_standard_reply:
                 cursor.execute(
@@ -760,26 +896,26 @@ async def handle_file(message: Message, file_type: str):
                     (ticket_id,)
                 )
                 conn.commit()
-                logging.debug(f"Флаг is_reopened_recently сброшен для ticket_id={ticket_id}")
+                logging.debug("Флаг is_reopened_recently сброшен для ticket_id=%s", ticket_id)
         else:
             await message.reply("Обращение открыто повторно.")
-            logging.debug(f"Стандартный ответ пропущен для переоткрытого ticket_id={ticket_id}")
+            logging.debug("Стандартный ответ пропущен для переоткрытого ticket_id=%s", ticket_id)
 
 @dp.message(ChatTopicFilter(), F.voice)
 async def handle_voice(message: Message):
     telegram_id = message.from_user.id
-    logging.debug(f"Получено голосовое сообщение от telegram_id={telegram_id}")
+    logging.debug("Получено голосовое сообщение от telegram_id=%s", telegram_id)
 
     if is_banned(telegram_id):
-        logging.debug(f"Пользователь {telegram_id} забанен, игнорируем голосовое сообщение")
+        logging.debug("Пользователь %s забанен, игнорируем голосовое сообщение", telegram_id)
         return
     if is_muted(telegram_id):
-        logging.debug(f"Пользователь {telegram_id} замучен, отправляем уведомление")
+        logging.debug("Пользователь %s замучен, отправляем уведомление", telegram_id)
         await message.reply("Вам временно запрещено писать в бота!")
         return
 
     await message.reply("Извините, мы не обрабатываем голосовые сообщения. Пожалуйста, отправьте ваш запрос в текстовом виде.")
-    logging.debug(f"Отправлен ответ на голосовое сообщение для telegram_id={telegram_id}")
+    logging.debug("Отправлен ответ на голосовое сообщение для telegram_id=%s", telegram_id)
 
 @dp.message(ChatTopicFilter(), F.text)
 async def handle_text_message(message: Message, state: FSMContext):
@@ -794,7 +930,7 @@ async def handle_text_message(message: Message, state: FSMContext):
         await message.reply("Вам временно запрещено писать в бота!")
         return
 
-    conn = sqlite3.connect("support.db", timeout=10)
+    conn = db.connect()
     cursor = conn.cursor()
     cursor.execute("SELECT login FROM employees WHERE telegram_id = ?", (telegram_id,))
     employee = cursor.fetchone()
@@ -857,9 +993,9 @@ async def handle_text_message(message: Message, state: FSMContext):
                     (ticket_id,)
                 )
                 conn.commit()
-                logging.debug(f"Reopened ticket #{ticket_id} for telegram_id={telegram_id}")
+                logging.debug("Reopened ticket #%s for telegram_id=%s", ticket_id, telegram_id)
                 # Полный emit update_tickets для фронта (как для нового)
-                await sio.emit("update_tickets", {
+                await dashboard_batcher.emit("update_tickets", {
                     "ticket_id": ticket_id,
                     "telegram_id": telegram_id,
                     "login": login,
@@ -892,7 +1028,8 @@ async def handle_text_message(message: Message, state: FSMContext):
                 "UPDATE tickets SET auto_close_enabled = 0, auto_close_time = NULL WHERE ticket_id = ?",
                 (ticket_id,)
             )
-            await sio.emit('auto_close_updated', {
+            auto_close_scheduler.cancel(ticket_id)
+            await dashboard_batcher.emit('auto_close_updated', {
                 "ticket_id": ticket_id,
                 "enabled": False,
                 "auto_close_time": None
@@ -905,8 +1042,8 @@ async def handle_text_message(message: Message, state: FSMContext):
         message_id = cursor.lastrowid
         conn.commit()
 
-        logging.debug(f"Отправка события {'new_message' if not is_edited else 'message_edited'} для ticket_id={ticket_id}, text={text}")
-        await sio.emit("new_message" if not is_edited else "message_edited", {
+        logging.debug("Отправка события %s для ticket_id=%s, text=%s", 'new_message' if not is_edited else 'message_edited', ticket_id, text)
+        await dashboard_batcher.emit("new_message" if not is_edited else "message_edited", {
             "ticket_id": ticket_id,
             "telegram_id": telegram_id,
             "text": text,
@@ -924,8 +1061,8 @@ async def handle_text_message(message: Message, state: FSMContext):
             reopen_flag = cursor.fetchone()
             skip_standard_reply = reopen_flag and reopen_flag[0] == 1
 
-            logging.debug(f"Отправка события update_tickets для нового ticket_id={ticket_id}, skip_standard_reply={skip_standard_reply}")
-            await sio.emit("update_tickets", {
+            logging.debug("Отправка события update_tickets для нового ticket_id=%s, skip_standard_reply=%s", ticket_id, skip_standard_reply)
+            await dashboard_batcher.emit("update_tickets", {
                 "ticket_id": ticket_id,
                 "telegram_id": telegram_id,
                 "login": login,
@@ -937,12 +1074,8 @@ async def handle_text_message(message: Message, state: FSMContext):
             })
             await send_notification_to_topic(ticket_id, login, "Новый тикет создан")
             if not skip_standard_reply:
-                reply_text = get_setting("new_ticket_response", "Обращение принято. При необходимости прикрепите скриншот или файл с логами.")
-                if not is_working_hours():
-                    if get_setting("is_holiday", "0") == "1":
-                        reply_text += "\n\n" + get_setting("holiday_message", "Сегодня праздничный день, поэтому ответ может занять больше времени.")
-                    else:
-                        reply_text += "\n\n" + get_setting("non_working_hours_message", "Обратите внимание: сейчас выходные или нерабочее время. Мы стараемся оперативно отвечать с 12:00 до 00:00 по будням, но в это время ответ может занять больше времени.")
+                # Тексты и график уже в памяти, см. schedule.py
+                reply_text = schedule.current().auto_reply()
                 await message.reply(reply_text)
                 # Сбрасываем флаг после отправки (если был)
                 if skip_standard_reply:
@@ -951,9 +1084,9 @@ async def handle_text_message(message: Message, state: FSMContext):
                         (ticket_id,)
                     )
                     conn.commit()
-                    logging.debug(f"Флаг is_reopened_recently сброшен для ticket_id={ticket_id}")
+                    logging.debug("Флаг is_reopened_recently сброшен для ticket_id=%s", ticket_id)
             else:
-                logging.debug(f"Стандартный ответ пропущен для переоткрытого ticket_id={ticket_id}")
+                logging.debug("Стандартный ответ пропущен для переоткрытого ticket_id=%s", ticket_id)
     else:
         ticket_id, message_id = message_data
         cursor.execute(
@@ -961,7 +1094,7 @@ async def handle_text_message(message: Message, state: FSMContext):
             (text, timestamp, message_id)
         )
         conn.commit()
-        logging.debug(f"Обновлено отредактированное сообщение message_id={message_id} для ticket_id={ticket_id}")
+        logging.debug("Обновлено отредактированное сообщение message_id=%s для ticket_id=%s", message_id, ticket_id)
         await sio.emit("message_edited", {
             "ticket_id": ticket_id,
             "message_id": message_id,
@@ -979,7 +1112,7 @@ async def handle_minichat(callback: CallbackQuery):
     ticket_id = int(callback.data.split("_")[1])
     telegram_id = callback.from_user.id
     
-    conn = sqlite3.connect("support.db", timeout=10)
+    conn = db.connect()
     cursor = conn.cursor()
     
     cursor.execute("SELECT login FROM employees WHERE telegram_id = ?", (telegram_id,))
@@ -1046,9 +1179,9 @@ async def handle_rating(callback: CallbackQuery):
     rating = data[2]  # 'up' or 'down'
     telegram_id = callback.from_user.id
 
-    logging.debug(f"Processing rating for ticket_id={ticket_id}, rating={rating}, telegram_id={telegram_id}")
+    logging.debug("Processing rating for ticket_id=%s, rating=%s, telegram_id=%s", ticket_id, rating, telegram_id)
 
-    conn = sqlite3.connect("support.db", timeout=10)
+    conn = db.connect()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     
@@ -1073,35 +1206,32 @@ async def handle_rating(callback: CallbackQuery):
     timestamp = datetime.now(astana_tz).isoformat()
     
     try:
-        cursor.execute(
-            "INSERT OR REPLACE INTO employee_ratings (ticket_id, employee_id, rating, timestamp) VALUES (?, ?, ?, ?)",
-            (ticket_id, assigned_to, rating, timestamp)
-        )
-        conn.commit()
-        logging.debug(f"Rating {rating} saved for ticket #{ticket_id}, employee_id={assigned_to}")
-
+        # Не INSERT OR REPLACE: замена строки не вызывает DELETE-триггер и счётчики в employee_stats разъедутся
         cursor.execute(
             """
-            SELECT 
-                (SELECT COUNT(*) FROM employee_ratings WHERE employee_id = ? AND rating = 'up') AS thumbs_up,
-                (SELECT COUNT(*) FROM employee_ratings WHERE employee_id = ? AND rating = 'down') AS thumbs_down
+            INSERT INTO employee_ratings (ticket_id, employee_id, rating, timestamp) VALUES (?, ?, ?, ?)
+            ON CONFLICT (ticket_id, employee_id) DO UPDATE SET rating = excluded.rating, timestamp = excluded.timestamp
             """,
-            (assigned_to, assigned_to)
+            (ticket_id, assigned_to, rating, timestamp)
         )
+        cursor.execute("SELECT thumbs_up, thumbs_down FROM employee_stats WHERE employee_id = ?", (assigned_to,))
         ratings = cursor.fetchone()
+        conn.commit()
+        logging.debug("Rating %s saved for ticket #%s, employee_id=%s", rating, ticket_id, assigned_to)
+
         await sio.emit("employee_rated", {
             "employee_id": assigned_to,
             "thumbs_up": ratings["thumbs_up"],
             "thumbs_down": ratings["thumbs_down"]
         })
-        logging.debug(f"Emitted employee_rated event for employee_id={assigned_to}, thumbs_up={ratings['thumbs_up']}, thumbs_down={ratings['thumbs_down']}")
+        logging.debug("Emitted employee_rated event for employee_id=%s, thumbs_up=%s, thumbs_down=%s", assigned_to, ratings['thumbs_up'], ratings['thumbs_down'])
         
         try:
             await callback.message.edit_text(
                 "Обращение закрыто! Спасибо за вашу обратную связь!",
                 reply_markup=None
             )
-            logging.debug(f"Message for ticket_id={ticket_id} edited, keyboard removed")
+            logging.debug("Message for ticket_id=%s edited, keyboard removed", ticket_id)
         except Exception as e:
             logging.error(f"Error editing message for ticket_id={ticket_id}: {e}")
             await callback.message.answer("Rating saved, but failed to update message.")
@@ -1116,97 +1246,196 @@ async def handle_rating(callback: CallbackQuery):
 
 async def process_message_queue():
     while True:
-        try:
-            data = await message_queue.get()
-            telegram_id = data["telegram_id"]
-            text = data["text"]
-            files = data.get("files", [])  # список: [{"path": ..., "type": "image" или "document"}]
-            message_id = data.get("message_id")
-            ticket_id = data.get("ticket_id")
-
-            telegram_message = None
-
-            if files:
-                # Разделяем по типу
-                images = [f for f in files if f["type"] == "image"]
-                documents = [f for f in files if f["type"] == "document"]
-
-                # --- 1. Отправляем изображения (если есть) ---
-                if images:
-                    if len(images) == 1:
-                        file = FSInputFile(path=images[0]["path"])
-                        telegram_message = await bot.send_photo(
-                            chat_id=telegram_id,
-                            photo=file,
-                            caption=text  # caption только на первом
-                        )
-                    else:
-                        media = []
-                        for idx, f in enumerate(images):
-                            file = FSInputFile(path=f["path"])
-                            caption = text if idx == 0 else None
-                            media.append(InputMediaPhoto(media=file, caption=caption))
-                        msgs = await bot.send_media_group(chat_id=telegram_id, media=media)
-                        telegram_message = msgs[0]
-
-                # --- 2. Отправляем документы (если есть) ---
-                if documents:
-                    if len(documents) == 1:
-                        file = FSInputFile(path=documents[0]["path"])
-                        caption = text if not images else ""  # caption только если нет фото
-                        msg = await bot.send_document(
-                            chat_id=telegram_id,
-                            document=file,
-                            caption=caption
-                        )
-                        telegram_message = msg  # обновляем, если это последнее
-                    else:
-                        media = []
-                        for idx, f in enumerate(documents):
-                            file = FSInputFile(path=f["path"])
-                            caption = text if idx == 0 and not images else None
-                            media.append(InputMediaDocument(media=file, caption=caption))
-                        msgs = await bot.send_media_group(chat_id=telegram_id, media=media)
-                        telegram_message = msgs[0]
+        # task_done() только для реально полученного задания, иначе отмена задачи ломает счётчик очереди
+        data = await message_queue.get()
+        started = time.perf_counter()
+        parent = tracing.extract(data)
+        queue_wait_ms = round((time.time() - parent["queued_at"]) * 1000, 1) if parent else None
+        with tracing.trace("outbox.send", parent=parent, ticket_id=data.get("ticket_id"), queue_wait_ms=queue_wait_ms):
+            status = await send_queued_message(data)
+        MESSAGE_QUEUE_SEND_SECONDS.observe(time.perf_counter() - started, status=status)
+        message_queue.task_done()
+        await asyncio.sleep(0.1)
 
-            else:
-                # Нет файлов — обычная отправка
-                if ticket_id and "ваше обращение закрыто" in text.lower():
-                    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text="👍", callback_data=f"rate_{ticket_id}_up"),
-                         InlineKeyboardButton(text="👎", callback_data=f"rate_{ticket_id}_down")]
-                    ])
-                    telegram_message = await bot.send_message(
+async def send_queued_message(data: dict) -> str:
+    status = "error"
+    try:
+        telegram_id = data["telegram_id"]
+        text = data["text"]
+        files = data.get("files", [])  # список: [{"path": ..., "type": "image" или "document"}]
+        message_id = data.get("message_id")
+        ticket_id = data.get("ticket_id")
+
+        telegram_message = None
+
+        if files:
+            # Разделяем по типу
+            images = [f for f in files if f["type"] == "image"]
+            documents = [f for f in files if f["type"] == "document"]
+
+            # --- 1. Отправляем изображения (если есть) ---
+            if images:
+                if len(images) == 1:
+                    file = FSInputFile(path=images[0]["path"])
+                    telegram_message = await bot.send_photo(
                         chat_id=telegram_id,
-                        text=text,
-                        reply_markup=keyboard
+                        photo=file,
+                        caption=text  # caption только на первом
                     )
+                    sent_images = [telegram_message]
                 else:
-                    telegram_message = await bot.send_message(chat_id=telegram_id, text=text)
+                    media = []
+                    for idx, f in enumerate(images):
+                        file = FSInputFile(path=f["path"])
+                        caption = text if idx == 0 else None
+                        media.append(InputMediaPhoto(media=file, caption=caption))
+                    msgs = await bot.send_media_group(chat_id=telegram_id, media=media)
+                    telegram_message = msgs[0]
+                    sent_images = msgs
+                # Миниатюры — из размеров, которые вернул Telegram; очередь их не ждёт
+                thumbnails.store_sent_later(bot, images, sent_images, get_unique_filename)
+
+            # --- 2. Отправляем документы (если есть) ---
+            if documents:
+                if len(documents) == 1:
+                    file = FSInputFile(path=documents[0]["path"])
+                    caption = text if not images else ""  # caption только если нет фото
+                    msg = await bot.send_document(
+                        chat_id=telegram_id,
+                        document=file,
+                        caption=caption
+                    )
+                    telegram_message = msg  # обновляем, если это последнее
+                else:
+                    media = []
+                    for idx, f in enumerate(documents):
+                        file = FSInputFile(path=f["path"])
+                        caption = text if idx == 0 and not images else None
+                        media.append(InputMediaDocument(media=file, caption=caption))
+                    msgs = await bot.send_media_group(chat_id=telegram_id, media=media)
+                    telegram_message = msgs[0]
 
-            # Сохраняем telegram_message_id (только для последнего сообщения)
-            if telegram_message and message_id:
-                conn = sqlite3.connect("support.db", timeout=10)
-                cursor = conn.cursor()
-                cursor.execute(
-                    "UPDATE messages SET telegram_message_id = ? WHERE message_id = ?",
-                    (telegram_message.message_id, message_id)
+        else:
+            # Нет файлов — обычная отправка
+            if ticket_id and "ваше обращение закрыто" in text.lower():
+                keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="👍", callback_data=f"rate_{ticket_id}_up"),
+                     InlineKeyboardButton(text="👎", callback_data=f"rate_{ticket_id}_down")]
+                ])
+                telegram_message = await bot.send_message(
+                    chat_id=telegram_id,
+                    text=text,
+                    reply_markup=keyboard
                 )
-                conn.commit()
-                conn.close()
+            else:
+                telegram_message = await bot.send_message(chat_id=telegram_id, text=text)
+
+        # Сохраняем telegram_message_id (только для последнего сообщения)
+        if telegram_message and message_id:
+            conn = db.connect()
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE messages SET telegram_message_id = ? WHERE message_id = ?",
+                (telegram_message.message_id, message_id)
+            )
+            conn.commit()
+            conn.close()
+        status = "ok"
 
+    except Exception as e:
+        logging.error(f"Ошибка в process_message_queue: {e}")
+        span = tracing.current_span()
+        if span is not None:
+            span.error = f"{type(e).__name__}: {e}"
+        with open("error_log.txt", "a") as f:
+            f.write(f"[{datetime.now()}] Ошибка: {e}\n")
+    return status
+
+def update_chat_id(update: dict) -> int:
+    for key, value in update.items():
+        if key != "update_id" and isinstance(value, dict):
+            chat = value.get("chat") or value.get("message", {}).get("chat") or value.get("from") or {}
+            return chat.get("id", 0)
+    return 0
+
+@app.post(WEBHOOK_PATH)
+async def telegram_webhook(request: Request):
+    if UPDATES_MODE != "webhook":
+        raise HTTPException(status_code=404, detail="Not Found")
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        logging.warning("Вебхук: неверный secret token")
+        raise HTTPException(status_code=403, detail="Forbidden")
+    try:
+        update = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    if not isinstance(update, dict) or "update_id" not in update:
+        raise HTTPException(status_code=400, detail="Invalid update")
+    try:
+        if FORWARD_UPDATES:
+            forward_queue.put_nowait(update)
+        else:
+            update_queues[update_chat_id(update) % WEBHOOK_WORKERS].put_nowait(update)
+    except asyncio.QueueFull:
+        # Telegram повторит доставку позже
+        logging.warning(f"Очередь вебхука переполнена, update_id={update['update_id']} отклонён")
+        raise HTTPException(status_code=503, detail="Busy")
+    return {"ok": True}
+
+async def process_update_queue(update_queue: asyncio.Queue):
+    while True:
+        update = await update_queue.get()
+        try:
+            await dp.feed_raw_update(bot, update)
         except Exception as e:
-            logging.error(f"Ошибка в process_message_queue: {e}")
-            with open("error_log.txt", "a") as f:
-                f.write(f"[{datetime.now()}] Ошибка: {e}\n")
+            logging.error(f"Ошибка обработки апдейта {update.get('update_id')}: {e}")
         finally:
-            message_queue.task_done()
-        await asyncio.sleep(0.1)
+            update_queue.task_done()
+
+def start_update_workers():
+    global update_workers_started
+    if update_workers_started:
+        return
+    update_workers_started = True
+    for update_queue in update_queues:
+        asyncio.create_task(process_update_queue(update_queue))
+    logging.debug("Запущено %s обработчиков вебхука", WEBHOOK_WORKERS)
+
+async def forward_updates():
+    """Веб-воркер (RUN_MODE=web): принятые апдейты — в шину для процесса бота."""
+    while True:
+        update = await forward_queue.get()
+        while True:
+            try:
+                await update_bus.put(update)
+                break
+            except Exception as e:
+                # Апдейт уже подтверждён Telegram, повторной доставки не будет — пробуем ещё
+                logging.error(f"Не удалось переслать апдейт {update.get('update_id')} в шину: {e}")
+                await asyncio.sleep(1)
+        forward_queue.task_done()
+
+async def consume_forwarded_updates():
+    """Процесс бота (RUN_MODE=bot): апдейты, которые веб-воркеры переслали через шину."""
+    start_update_workers()
+    while True:
+        update = await update_bus.get()
+        # Ждём место в очереди чата: апдейт уже принят веб-воркером, отказать Telegram нельзя
+        await update_queues[update_chat_id(update) % WEBHOOK_WORKERS].put(update)
+
+@app.on_event("startup")
+async def start_webhook_workers():
+    global forward_task
+    if FORWARD_UPDATES:
+        forward_task = asyncio.create_task(forward_updates())
+    elif UPDATES_MODE == "webhook":
+        start_update_workers()
 
 async def cleanup_expired():
     while True:
         await asyncio.sleep(3600)
-        conn = sqlite3.connect("support.db", timeout=10)
+        conn = db.connect()
         cursor = conn.cursor()
         now = datetime.now().isoformat()
         cursor.execute("DELETE FROM mutes WHERE end_time < ?", (now,))
@@ -1217,16 +1446,50 @@ async def cleanup_expired():
         conn.commit()
         conn.close()
 
+async def serve_bot_metrics():
+    # При RUN_MODE=bot веб-сервера в процессе нет — отдаём /metrics отдельным маленьким сервером
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=REGISTRY.render(), headers={"Content-Type": CONTENT_TYPE})
+
+    metrics_app = web.Application()
+    metrics_app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(metrics_app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", METRICS_PORT).start()
+    logging.info(f"Метрики бота: http://127.0.0.1:{METRICS_PORT}/metrics")
+
 async def on_startup():
     init_db()
     loop = asyncio.get_event_loop()
     set_event_loop(loop)
     asyncio.create_task(process_message_queue())
     asyncio.create_task(cleanup_expired())
+    asyncio.create_task(auto_close_scheduler.run())
+    loop_monitor.start()
+    schedule.holiday_scheduler.start()
+    maintenance.maintenance_scheduler.start()
+    tracing.start_exporter()
+    if RUN_MODE == "bot" and METRICS_PORT:
+        await serve_bot_metrics()
     logging.debug("Бот запущен")
 
 async def run_bot():
     await on_startup()
+    if UPDATES_MODE == "webhook":
+        await bot.set_webhook(
+            url=f"{BASE_URL}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logging.info(f"Вебхук установлен: {BASE_URL}{WEBHOOK_PATH}")
+        if update_bus is not None:
+            # RUN_MODE=bot: апдейты принимают веб-воркеры и пересылают сюда
+            await consume_forwarded_updates()
+        # Апдейты принимает веб-сервер этого же процесса, здесь остаются только фоновые задачи
+        await asyncio.Event().wait()
+    await bot.delete_webhook()
     await dp.start_polling(bot, polling_timeout=30, tasks_concurrency_limit=10)
 
 async def main():
@@ -1234,9 +1497,28 @@ async def main():
     loop = asyncio.get_event_loop()
     set_event_loop(loop)
     bot_task = asyncio.create_task(run_bot())
+    if RUN_MODE == "bot":
+        if not BUS_URL:
+            logging.warning("RUN_MODE=bot без BUS_URL: веб-процессы не получат события и сообщения бота")
+        await bot_task
+        return
     config = uvicorn.Config(app=app, host="0.0.0.0", port=8081, loop="asyncio")
     server = uvicorn.Server(config)
     await asyncio.gather(bot_task, server.serve())
 
+def run_web():
+    # Только веб: N воркеров uvicorn, бот запускается отдельно с RUN_MODE=bot
+    init_db()
+    workers = int(os.getenv("WEB_WORKERS", "1"))
+    if workers > 1 and not BUS_URL:
+        logging.warning("WEB_WORKERS > 1 без BUS_URL: события Socket.IO и очередь сообщений не дойдут до других процессов")
+        if UPDATES_MODE == "webhook":
+            logging.warning("WEB_WORKERS > 1 без BUS_URL: апдейты вебхука разойдутся по воркерам, регистрация и альбомы сломаются")
+    # main:app — то же приложение, но с маршрутом вебхука и диспетчером бота
+    uvicorn.run("main:app", host="0.0.0.0", port=8081, loop="asyncio", workers=workers)
+
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if RUN_MODE == "web":
+        run_web()
+    else:
+        asyncio.run(main())
\ No newline at end of file
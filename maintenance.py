@@ -0,0 +1,186 @@
+"""Обслуживание support.db в нерабочее время.
+
+Раз в сутки, когда поддержка не работает по графику (schedule.py), планировщик по очереди
+выполняет: резервную копию (backup.py), перенос старых тикетов в архив (archive.py), сборку мусора (orphans.py), возврат
+свободных страниц файлу через PRAGMA incremental_vacuum, обновление статистики планировщика
+запросов (ANALYZE после крупных изменений, иначе PRAGMA optimize) и PRAGMA quick_check.
+Время каждой задачи уходит в метрики pumbabot_maintenance_*.
+
+incremental_vacuum работает только при auto_vacuum=INCREMENTAL. Новая база создаётся сразу
+так (см. init_db), а существующую планировщик один раз переводит полным VACUUM — тоже в
+нерабочее время.
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+import archive
+import backup
+import db
+import orphans
+import schedule
+from metrics import DB_FREELIST_PAGES, DB_INTEGRITY_OK, MAINTENANCE_LAST_RUN, MAINTENANCE_SECONDS
+
+MAINTENANCE_ENABLED = os.getenv("MAINTENANCE_ENABLED", "1") == "1"
+MAINTENANCE_CHECK_INTERVAL = 600  # с между проверками «нерабочее ли время»
+MAINTENANCE_MAX_SKIP_DAYS = 2  # без нерабочих часов (24/7) обслуживание всё равно идёт раз в столько суток
+VACUUM_STEP_PAGES = 1000  # страниц за один шаг incremental_vacuum (4 МБ при странице 4 КБ)
+VACUUM_STEP_PAUSE = 0.1
+VACUUM_MAX_SECONDS = 300  # остальное вернём в следующую ночь
+ANALYZE_AFTER_CHANGES = 10000  # изменений тикетов и сообщений (счётчик sequences.tickets) до полного ANALYZE
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def _pragma(name: str):
+    conn = db.connect()
+    try:
+        return conn.execute(f"PRAGMA {name}").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _get_setting(conn, key: str):
+    row = conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def enable_incremental_vacuum():
+    """Перевести существующую базу на auto_vacuum=INCREMENTAL; полный VACUUM — база блокируется целиком."""
+    conn = db.connect()
+    try:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+    logging.info("Обслуживание: support.db переведена на auto_vacuum=INCREMENTAL")
+
+
+def incremental_vacuum_step() -> int:
+    """Вернуть файлу до VACUUM_STEP_PAGES свободных страниц; сколько свободных осталось."""
+    conn = db.connect()
+    try:
+        # executescript шагает оператор до конца; execute() из модуля sqlite3 освободил бы одну страницу
+        conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES});")
+        return conn.execute("PRAGMA freelist_count").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def refresh_statistics() -> str:
+    """ANALYZE, если с прошлого раза было много изменений, иначе дешёвый PRAGMA optimize."""
+    conn = db.connect()
+    try:
+        changes = conn.execute("SELECT value FROM sequences WHERE name = 'tickets'").fetchone()[0]
+        last = int(_get_setting(conn, "maintenance_analyze_changes") or 0)
+        if changes - last >= ANALYZE_AFTER_CHANGES or changes < last:
+            conn.execute("ANALYZE")
+            conn.execute(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES ('maintenance_analyze_changes', ?)", (str(changes),)
+            )
+            conn.commit()
+            return "analyze"
+        conn.execute("PRAGMA optimize")
+        return "optimize"
+    finally:
+        conn.close()
+
+
+def quick_check() -> list:
+    """PRAGMA quick_check: пустой список — всё в порядке, иначе описания ошибок."""
+    conn = db.connect(readonly=True)
+    try:
+        rows = [row[0] for row in conn.execute("PRAGMA quick_check").fetchall()]
+    finally:
+        conn.close()
+    return [] if rows == ["ok"] else rows
+
+
+class MaintenanceScheduler:
+    def __init__(self, check_interval: float = MAINTENANCE_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self.last_run = None  # дата (по TIMEZONE) последнего обслуживания
+        self.task = None
+        self.lock = asyncio.Lock()
+
+    async def timed(self, task: str, function, *args):
+        started = time.perf_counter()
+        try:
+            if asyncio.iscoroutinefunction(function):
+                return await function(*args)
+            return await asyncio.to_thread(function, *args)
+        finally:
+            seconds = time.perf_counter() - started
+            MAINTENANCE_SECONDS.observe(seconds, task=task)
+            MAINTENANCE_LAST_RUN.set(time.time(), task=task)
+            logging.info(f"Обслуживание: {task} за {seconds:.2f} с")
+
+    async def vacuum(self) -> int:
+        """Вернуть файлу свободные страницы короткими шагами; сколько свободных осталось."""
+        if await asyncio.to_thread(_pragma, "auto_vacuum") != AUTO_VACUUM_INCREMENTAL:
+            await self.timed("enable_incremental_vacuum", enable_incremental_vacuum)
+        deadline = time.monotonic() + VACUUM_MAX_SECONDS
+        free = await asyncio.to_thread(_pragma, "freelist_count")
+        # Между шагами запись из бота и веба не ждёт всю очистку
+        while free and time.monotonic() < deadline:
+            left = await asyncio.to_thread(incremental_vacuum_step)
+            if left >= free:
+                break
+            free = left
+            await asyncio.sleep(VACUUM_STEP_PAUSE)
+        DB_FREELIST_PAGES.set(free)
+        return free
+
+    async def run_once(self) -> dict:
+        """Все задачи обслуживания подряд; ошибка одной не отменяет остальные. Итог по задачам."""
+        report = {}
+        async with self.lock:
+            for task, function in (
+                ("backup", backup.run_backup),
+                ("archive", archive.archive_old_tickets),
+                ("orphans", orphans.collect),
+                ("incremental_vacuum", self.vacuum),
+                ("statistics", refresh_statistics),
+                ("quick_check", quick_check),
+            ):
+                try:
+                    result = await self.timed(task, function)
+                except Exception as e:
+                    logging.error(f"Обслуживание: ошибка задачи {task}: {e}", exc_info=True)
+                    report[task] = {"error": str(e)}
+                    continue
+                report[task] = result
+                if task == "quick_check":
+                    DB_INTEGRITY_OK.set(0 if result else 1)
+                    if result:
+                        logging.error(f"Обслуживание: PRAGMA quick_check нашёл ошибки: {result[:20]}")
+        return report
+
+    def due(self, now: datetime) -> bool:
+        if self.last_run == now.date():
+            return False
+        if not schedule.current().is_open(now):
+            return True
+        # Круглосуточный график: нерабочего времени не будет, не откладываем бесконечно
+        return self.last_run is not None and now.date() - self.last_run >= timedelta(days=MAINTENANCE_MAX_SKIP_DAYS)
+
+    async def run(self):
+        # Первую ночь после старта не пропускаем, но и не запускаем сразу в рабочее время
+        self.last_run = self.last_run or (datetime.now(schedule.TIMEZONE).date() - timedelta(days=1))
+        while True:
+            await asyncio.sleep(self.check_interval)
+            now = datetime.now(schedule.TIMEZONE)
+            if not self.due(now):
+                continue
+            self.last_run = now.date()
+            await self.run_once()
+
+    def start(self):
+        # В RUN_MODE=all вызывается и при старте веба, и при старте бота — запускаем один раз
+        if MAINTENANCE_ENABLED and self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+
+maintenance_scheduler = MaintenanceScheduler()
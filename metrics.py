@@ -0,0 +1,230 @@
+"""Метрики процесса в формате Prometheus (text exposition 0.0.4) без внешних зависимостей.
+
+Каждый процесс хранит свои значения в памяти: при RUN_MODE=web и нескольких WEB_WORKERS
+каждый воркер отдаёт собственный /metrics, а бот при RUN_MODE=bot — на METRICS_PORT.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def samples(self):
+        """Список (суффикс имени, значения меток, доп. метка, значение)."""
+        return []
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, values, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_labels(self.labelnames, values, extra)} {_number(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self.lock:
+            return [("", key, "", value) for key, value in sorted(self.values.items())]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.values = {}
+        self.function = function  # значение без меток, вычисляемое при чтении /metrics
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                return [("", (), "", self.function())]
+            except Exception:
+                return []
+        with self.lock:
+            return [("", key, "", value) for key, value in sorted(self.values.items())]
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}  # метки -> [счётчики по корзинам..., сумма, количество]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            data = self.values.get(key)
+            if data is None:
+                data = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                data[index] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def time(self, **labels) -> _Timer:
+        return _Timer(self, labels)
+
+    def samples(self):
+        result = []
+        with self.lock:
+            items = sorted((key, list(data)) for key, data in self.values.items())
+        for key, data in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, data):
+                cumulative += count
+                result.append(("_bucket", key, f'le="{_number(bound)}"', cumulative))
+            result.append(("_bucket", key, 'le="+Inf"', data[-1]))
+            result.append(("_sum", key, "", data[-2]))
+            result.append(("_count", key, "", data[-1]))
+        return result
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: Metric):
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# ---------- метрики приложения ----------
+
+HANDLER_SECONDS = Histogram(
+    "pumbabot_handler_duration_seconds", "Время обработки апдейта хендлером aiogram.", ["handler"])
+HANDLER_ERRORS = Counter(
+    "pumbabot_handler_errors_total", "Исключения в хендлерах aiogram.", ["handler"])
+HTTP_SECONDS = Histogram(
+    "pumbabot_http_request_duration_seconds", "Время ответа веб-маршрутов.", ["method", "route", "status"])
+MESSAGE_QUEUE_DEPTH = Gauge(
+    "pumbabot_message_queue_depth", "Сообщений в очереди на отправку в Telegram.")
+MESSAGE_QUEUE_SEND_SECONDS = Histogram(
+    "pumbabot_message_queue_send_duration_seconds", "Время отправки задания из message_queue в Telegram.", ["status"])
+TELEGRAM_REQUEST_SECONDS = Histogram(
+    "pumbabot_telegram_request_duration_seconds", "Время вызовов Bot API.", ["method"])
+TELEGRAM_ERRORS = Counter(
+    "pumbabot_telegram_errors_total", "Ошибки вызовов Bot API.", ["method", "error"])
+TELEGRAM_RETRIES = Counter(
+    "pumbabot_telegram_retries_total", "Повторы вызовов Bot API после RetryAfter.", ["method"])
+SOCKETIO_CLIENTS = Gauge(
+    "pumbabot_socketio_clients", "Подключённые клиенты Socket.IO в этом процессе.")
+SOCKETIO_EMITS = Counter(
+    "pumbabot_socketio_emits_total", "Отправленные события Socket.IO.", ["event"])
+DASHBOARD_EVENTS = Counter(
+    "pumbabot_dashboard_events_total", "События тикетов, поступившие в склейку для дашборда.")
+DASHBOARD_EVENTS_MERGED = Counter(
+    "pumbabot_dashboard_events_merged_total", "События, попавшие в уже открытое окно склейки своего тикета.")
+DASHBOARD_EVENTS_COLLAPSED = Counter(
+    "pumbabot_dashboard_events_collapsed_total", "События, поглощённые более поздним событием того же типа.")
+DASHBOARD_FRAMES = Counter(
+    "pumbabot_dashboard_frames_total", "Кадры, отправленные клиентам после склейки.")
+DB_QUERIES = Counter(
+    "pumbabot_db_queries_total", "Запросы к SQLite.", ["operation"])
+DB_QUERY_SECONDS = Histogram(
+    "pumbabot_db_query_duration_seconds", "Время выполнения запросов к SQLite.", ["operation"], buckets=DB_BUCKETS)
+LOOP_LAG_SECONDS = Histogram(
+    "pumbabot_event_loop_lag_seconds", "Задержка планирования цикла событий.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+LOOP_LAG_LAST = Gauge(
+    "pumbabot_event_loop_lag_last_seconds", "Последняя измеренная задержка цикла событий.")
+LOOP_BLOCKED = Counter(
+    "pumbabot_event_loop_blocked_total", "Случаи, когда цикл событий был занят дольше LOOP_BLOCK_MS.")
+ORPHANS_REMOVED = Counter(
+    "pumbabot_orphans_removed_total", "Висячие строки и файлы-сироты, удалённые сборщиком мусора.", ["kind"])
+ORPHAN_BYTES_RECLAIMED = Counter(
+    "pumbabot_orphan_bytes_reclaimed_total", "Байты, освобождённые сборщиком мусора в Uploads.")
+MAINTENANCE_SECONDS = Histogram(
+    "pumbabot_maintenance_duration_seconds", "Время задач ночного обслуживания базы.", ["task"],
+    buckets=(0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0))
+MAINTENANCE_LAST_RUN = Gauge(
+    "pumbabot_maintenance_last_run_timestamp_seconds", "Время последнего запуска задачи обслуживания.", ["task"])
+DB_FREELIST_PAGES = Gauge(
+    "pumbabot_db_freelist_pages", "Свободные страницы support.db после incremental_vacuum.")
+DB_INTEGRITY_OK = Gauge(
+    "pumbabot_db_integrity_ok", "1, если последний PRAGMA quick_check прошёл без ошибок.")
+BACKUP_SIZE_BYTES = Gauge(
+    "pumbabot_backup_size_bytes", "Размер последней сжатой резервной копии.", ["database"])
+BACKUP_LAST_SUCCESS = Gauge(
+    "pumbabot_backup_last_success_timestamp_seconds", "Время последнего успешного резервного копирования.")
@@ -0,0 +1,177 @@
+"""Сборщик мусора: висячие строки и файлы-сироты в Uploads.
+
+PRAGMA foreign_keys в базе не включён, поэтому удаление тикетов, сообщений и сотрудников
+оставляет дочерние строки, а файлы вложений — на диске. Сборщик проходит таблицы по
+диапазонам первичного ключа и каталог Uploads постранично: каждая порция — отдельная
+короткая транзакция, между порциями цикл событий и другие соединения получают своё время.
+
+Файлы моложе ORPHAN_GRACE_SECONDS не трогаем: вложение оператора сначала пишется на диск,
+а запись в attachments появляется позже, миниатюра дописывается после отправки в Telegram.
+"""
+import asyncio
+import logging
+import os
+import time
+
+import archive
+import db
+from metrics import ORPHAN_BYTES_RECLAIMED, ORPHANS_REMOVED
+
+UPLOADS_DIR = "Uploads"
+ORPHAN_CHUNK_SIZE = 1000  # строк или файлов за одну транзакцию
+ORPHAN_CHUNK_PAUSE = 0.05  # с между порциями
+ORPHAN_GRACE_SECONDS = 24 * 3600
+
+# (таблица, первичный ключ, условие «висячая строка»); порядок — от родителей к детям, чтобы
+# за один проход убрать и строки, осиротевшие на предыдущем шаге.
+# Оценки (ticket_ratings, employee_ratings) и их счётчики не трогаем: прежний /cleanup удалял
+# тикеты, оставляя оценки, и из них до сих пор складываются итоги сотрудников
+ROW_RULES = (
+    ("messages", "message_id", "NOT EXISTS (SELECT 1 FROM tickets t WHERE t.ticket_id = x.ticket_id)"),
+    ("admin_messages", "message_id", "NOT EXISTS (SELECT 1 FROM tickets t WHERE t.ticket_id = x.ticket_id)"),
+    ("sessions", "rowid", "NOT EXISTS (SELECT 1 FROM employees e WHERE e.telegram_id = x.telegram_id)"),
+    ("attachments", "attachment_id", "NOT EXISTS (SELECT 1 FROM messages m WHERE m.message_id = x.message_id)"),
+)
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _remove(path: str) -> int:
+    """Удалить файл; освобождённые байты (0, если файла уже нет)."""
+    size = _file_size(path)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+    except OSError as e:
+        logging.warning(f"Сборщик мусора: не удалось удалить {path}: {e}")
+        return 0
+    return size
+
+
+def collect_rows_chunk(conn, table: str, key: str, condition: str, after: int, limit: int = ORPHAN_CHUNK_SIZE):
+    """Одна порция таблицы: (последний просмотренный ключ или None в конце, удалено строк, освобождено байт)."""
+    last = conn.execute(
+        f"SELECT MAX({key}) FROM (SELECT {key} FROM {table} WHERE {key} > ? ORDER BY {key} LIMIT ?)", (after, limit)
+    ).fetchone()[0]
+    if last is None:
+        return None, 0, 0
+    where = f"x.{key} > ? AND x.{key} <= ? AND {condition}"
+    files = []
+    if table == "attachments":
+        files = conn.execute(f"SELECT file_path, thumb_path FROM attachments x WHERE {where}", (after, last)).fetchall()
+    removed = conn.execute(f"DELETE FROM {table} WHERE {key} IN (SELECT {key} FROM {table} x WHERE {where})", (after, last)).rowcount
+    conn.commit()
+    reclaimed = 0
+    for paths in files:
+        for path in paths:
+            # При старой схеме имён (счётчик вместо токена) файл мог достаться новому вложению
+            if path and not conn.execute(
+                "SELECT 1 FROM attachments WHERE file_path = ? OR thumb_path = ? LIMIT 1", (path, path)
+            ).fetchone():
+                reclaimed += _remove(path)
+    return last, removed, reclaimed
+
+
+def _referenced(conn, paths: list, has_archive: bool) -> set:
+    placeholders = ",".join("?" * len(paths))
+    queries = [
+        f"SELECT file_path FROM attachments WHERE file_path IN ({placeholders})",
+        f"SELECT thumb_path FROM attachments WHERE thumb_path IN ({placeholders})",
+    ]
+    if has_archive:
+        # Файлы заархивированных тикетов, которые archive.move_files ещё не перенёс
+        queries += [query.replace("FROM attachments", "FROM archive.attachments") for query in queries]
+    found = set()
+    for query in queries:
+        found.update(row[0] for row in conn.execute(query, paths).fetchall())
+    return found
+
+
+def list_uploads() -> list:
+    try:
+        return sorted(entry.name for entry in os.scandir(UPLOADS_DIR) if entry.is_file())
+    except FileNotFoundError:
+        return []
+
+
+def collect_files_chunk(conn, names: list, has_archive: bool):
+    """Порция файлов Uploads: (удалено файлов, освобождено байт)."""
+    paths = [f"{UPLOADS_DIR}/{name}" for name in names]
+    referenced = _referenced(conn, paths, has_archive)
+    cutoff = time.time() - ORPHAN_GRACE_SECONDS
+    removed = reclaimed = 0
+    for path in paths:
+        if path in referenced:
+            continue
+        try:
+            if os.path.getmtime(path) > cutoff:
+                continue
+        except OSError:
+            continue
+        size = _remove(path)
+        if size or not os.path.exists(path):
+            removed += 1
+            reclaimed += size
+    return removed, reclaimed
+
+
+def _open():
+    conn = db.connect()
+    has_archive = os.path.exists(archive.ARCHIVE_DB_PATH)
+    if has_archive:
+        conn.execute("ATTACH DATABASE ? AS archive", (archive.ARCHIVE_DB_PATH,))
+    return conn, has_archive
+
+
+def _rows_step(table: str, key: str, condition: str, after: int):
+    conn, _ = _open()
+    try:
+        return collect_rows_chunk(conn, table, key, condition, after)
+    finally:
+        conn.close()
+
+
+def _files_step(names: list):
+    conn, has_archive = _open()
+    try:
+        return collect_files_chunk(conn, names, has_archive)
+    finally:
+        conn.close()
+
+
+async def collect() -> dict:
+    """Полный проход сборщика; сводка: удалено строк по таблицам, файлов и освобождено байт."""
+    started = time.monotonic()
+    report = {"rows": {}, "files": 0, "bytes": 0}
+    for table, key, condition in ROW_RULES:
+        after, total = 0, 0
+        while after is not None:
+            after, removed, reclaimed = await asyncio.to_thread(_rows_step, table, key, condition, after)
+            total += removed
+            report["bytes"] += reclaimed
+            await asyncio.sleep(ORPHAN_CHUNK_PAUSE)
+        report["rows"][table] = total
+        if total:
+            ORPHANS_REMOVED.inc(total, kind=table)
+    names = await asyncio.to_thread(list_uploads)
+    for start in range(0, len(names), ORPHAN_CHUNK_SIZE):
+        removed, reclaimed = await asyncio.to_thread(_files_step, names[start:start + ORPHAN_CHUNK_SIZE])
+        report["files"] += removed
+        report["bytes"] += reclaimed
+        await asyncio.sleep(ORPHAN_CHUNK_PAUSE)
+    if report["files"]:
+        ORPHANS_REMOVED.inc(report["files"], kind="files")
+    ORPHAN_BYTES_RECLAIMED.inc(report["bytes"])
+    report["seconds"] = round(time.monotonic() - started, 3)
+    if report["files"] or any(report["rows"].values()):
+        logging.info(
+            f"Сборщик мусора: строк {sum(report['rows'].values())} {report['rows']}, файлов {report['files']}, "
+            f"освобождено {report['bytes'] / 1024 / 1024:.1f} МБ за {report['seconds']} с"
+        )
+    return report
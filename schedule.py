@@ -0,0 +1,309 @@
+"""Скомпилированный график работы поддержки.
+
+Настройки (часы, выходные, часы по дням недели, праздники) разбираются один раз при
+изменении, после чего «открыто ли сейчас» и «когда откроемся» — обращение к таблице по
+минуте недели. Окно с концом не позже начала (12:00–00:00, 20:00–02:00) переходит
+через полночь и относится к дню, в который началось.
+
+Праздничный режим — флаг is_holiday: админ переключает его вручную, а HolidayScheduler
+сам включает и выключает на границах диапазонов из таблицы holidays. Тексты автоответа
+тоже лежат в скомпилированном графике, так что решение по новому тикету не читает БД.
+"""
+import asyncio
+import logging
+import threading
+import time
+from array import array
+from datetime import date, datetime, timedelta
+
+import pytz
+
+import db
+
+TIMEZONE = pytz.timezone('Asia/Almaty')
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+CLOSED = 0xFFFF  # в таблице «до открытия»: окон на неделе нет вовсе
+SCHEDULE_RELOAD_SECONDS = 60  # настройки могли поменять в другом процессе (RUN_MODE=web/bot)
+HOLIDAYS_LOOKBEHIND_DAYS = 1  # прошедшие диапазоны в кэш не грузим
+
+DEFAULTS = {
+    "working_hours_start": "12:00",
+    "working_hours_end": "00:00",
+    "weekend_days": "0,6",
+    "weekday_hours": "",
+    "is_holiday": "0",
+    "new_ticket_response": "Обращение принято. При необходимости прикрепите скриншот или файл с логами.",
+    "holiday_message": "Сегодня праздничный день, поэтому ответ может занять больше времени.",
+    "non_working_hours_message": "Обратите внимание: сейчас выходные или нерабочее время. Мы стараемся оперативно отвечать с 12:00 до 00:00 по будням, но в это время ответ может занять больше времени.",
+}
+
+
+def parse_minutes(value: str) -> int:
+    hours, minutes = value.strip().split(":")
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError(f"Некорректное время: {value}")
+    return hours * 60 + minutes
+
+
+def parse_weekday_hours(value: str) -> dict:
+    """"4=10:00-17:00,5=11:00-15:00" -> {4: (600, 1020), 5: (660, 900)}; 0 — понедельник."""
+    result = {}
+    for item in (value or "").split(","):
+        if not item.strip():
+            continue
+        day, hours = item.split("=", 1)
+        start, end = hours.split("-", 1)
+        day = int(day)
+        if not 0 <= day <= 6:
+            raise ValueError(f"Некорректный день недели: {day}")
+        result[day] = (parse_minutes(start), parse_minutes(end))
+    return result
+
+
+def format_weekday_hours(hours: dict) -> str:
+    return ",".join(
+        f"{day}={start // 60:02d}:{start % 60:02d}-{end // 60:02d}:{end % 60:02d}"
+        for day, (start, end) in sorted(hours.items())
+    )
+
+
+class Schedule:
+    def __init__(self, settings: dict, holidays=(), today: date = None):
+        settings = {**DEFAULTS, **{key: value for key, value in settings.items() if value is not None}}
+        # Флаг is_holiday действует на день компиляции; HolidayScheduler перекомпилирует в полночь
+        self.today = today or datetime.now(TIMEZONE).date()
+        self.holiday_flag = settings["is_holiday"] == "1"
+        self.new_ticket_response = settings["new_ticket_response"]
+        self.holiday_message = settings["holiday_message"]
+        self.non_working_hours_message = settings["non_working_hours_message"]
+        self.weekend_days = {int(day) for day in settings["weekend_days"].split(",") if day.strip()}
+        default_window = (parse_minutes(settings["working_hours_start"]), parse_minutes(settings["working_hours_end"]))
+        self.windows = {}
+        for day in range(7):
+            if day in self.weekend_days:
+                continue
+            self.windows[day] = default_window
+        # Часы конкретного дня недели заменяют общие, в том числе для выходного
+        self.windows.update(parse_weekday_hours(settings["weekday_hours"]))
+
+        # Минута недели (0 — понедельник 00:00) -> открыто ли
+        self.open_minutes = bytearray(MINUTES_PER_WEEK)
+        for day, (start, end) in self.windows.items():
+            length = (end - start) % MINUTES_PER_DAY or MINUTES_PER_DAY
+            base = day * MINUTES_PER_DAY + start
+            for offset in range(length):
+                self.open_minutes[(base + offset) % MINUTES_PER_WEEK] = 1
+
+        # Минута недели -> сколько минут до ближайшей открытой минуты (0 — открыто сейчас)
+        self.until_open = array("H", [CLOSED]) * MINUTES_PER_WEEK
+        if any(self.open_minutes):
+            distance = CLOSED
+            for index in range(2 * MINUTES_PER_WEEK - 1, -1, -1):
+                minute = index % MINUTES_PER_WEEK
+                distance = 0 if self.open_minutes[minute] else min(distance + 1, CLOSED)
+                if index < MINUTES_PER_WEEK:
+                    self.until_open[minute] = distance
+
+        # Праздничные даты из календаря (см. holidays): date.toordinal() -> запись
+        self.holiday_list = list(holidays)
+        self.holidays = {}
+        for holiday in holidays:
+            day = holiday["start"]
+            while day <= holiday["end"]:
+                self.holidays.setdefault(day.toordinal(), holiday)
+                day += timedelta(days=1)
+
+    @staticmethod
+    def _week_minute(now: datetime) -> int:
+        return now.weekday() * MINUTES_PER_DAY + now.hour * 60 + now.minute
+
+    def now(self) -> datetime:
+        return datetime.now(TIMEZONE)
+
+    def holiday(self, now: datetime = None):
+        """Запись календаря, действующая в этот день, или None."""
+        now = now or self.now()
+        return self.holidays.get(now.date().toordinal())
+
+    def _is_holiday_date(self, day: date) -> bool:
+        if day == self.today:
+            return self.holiday_flag
+        return day.toordinal() in self.holidays
+
+    def is_holiday(self, now: datetime = None) -> bool:
+        return self._is_holiday_date((now or self.now()).date())
+
+    def is_open(self, now: datetime = None) -> bool:
+        now = now or self.now()
+        if self.is_holiday(now):
+            return False
+        return bool(self.open_minutes[self._week_minute(now)])
+
+    def next_opening(self, now: datetime = None):
+        """Ближайшая минута, когда поддержка работает (now, если уже открыто); None — рабочих окон нет."""
+        now = (now or self.now()).replace(second=0, microsecond=0)
+        # Каждый шаг либо находит открытую минуту, либо перескакивает праздничный день целиком
+        for _ in range(len(self.holidays) + 3):
+            distance = self.until_open[self._week_minute(now)]
+            if distance == CLOSED:
+                return None
+            candidate = TIMEZONE.normalize(now + timedelta(minutes=distance))
+            if not self._is_holiday_date(candidate.date()):
+                return candidate
+            now = TIMEZONE.localize(datetime.combine(candidate.date() + timedelta(days=1), datetime.min.time()))
+        return None
+
+    def auto_reply(self, now: datetime = None) -> str:
+        """Ответ на новый тикет с припиской о нерабочем времени или празднике."""
+        now = now or self.now()
+        if self.is_open(now):
+            return self.new_ticket_response
+        if self.is_holiday(now):
+            holiday = self.holiday(now)
+            message = holiday["message"] if holiday and holiday["message"] else self.holiday_message
+        else:
+            message = self.non_working_hours_message
+        return self.new_ticket_response + "\n\n" + message
+
+
+def load_holidays(conn, since: date) -> list:
+    rows = conn.execute(
+        "SELECT id, start_date, end_date, name, message FROM holidays WHERE end_date >= ? ORDER BY start_date",
+        (since.isoformat(),),
+    ).fetchall()
+    return [
+        {
+            "id": row[0],
+            "start": date.fromisoformat(row[1]),
+            "end": date.fromisoformat(row[2]),
+            "name": row[3],
+            "message": row[4],
+        }
+        for row in rows
+    ]
+
+
+class ScheduleCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.schedule = None
+        self.loaded_at = 0.0
+
+    def load(self) -> Schedule:
+        today = datetime.now(TIMEZONE).date()
+        conn = db.connect()
+        try:
+            rows = conn.execute(
+                "SELECT key, value FROM settings WHERE key IN (%s)" % ",".join("?" * len(DEFAULTS)),
+                tuple(DEFAULTS),
+            ).fetchall()
+            holidays = load_holidays(conn, today - timedelta(days=HOLIDAYS_LOOKBEHIND_DAYS))
+        finally:
+            conn.close()
+        try:
+            return Schedule(dict(rows), holidays, today)
+        except ValueError as e:
+            logging.error(f"Ошибка в настройках графика работы, используются значения по умолчанию: {e}")
+            return Schedule({}, holidays, today)
+
+    def get(self) -> Schedule:
+        # БД читается только при первом обращении; дальше кэш обновляют reload() и HolidayScheduler
+        schedule = self.schedule
+        if schedule is None:
+            with self.lock:
+                if self.schedule is None:
+                    self.schedule = self.load()
+                    self.loaded_at = time.monotonic()
+                schedule = self.schedule
+        return schedule
+
+    def reload(self) -> Schedule:
+        schedule = self.load()
+        with self.lock:
+            self.schedule = schedule
+            self.loaded_at = time.monotonic()
+        return schedule
+
+
+SCHEDULE = ScheduleCache()
+
+
+class HolidayScheduler:
+    """Переключает is_holiday на границах диапазонов из holidays и держит кэш графика свежим.
+
+    Граница обрабатывается один раз за день: дата последней обработки хранится в настройке
+    holiday_auto_date, поэтому ручное переключение в течение дня не перетирается, а процесс,
+    поднятый после простоя, догоняет пропущенные границы.
+    """
+
+    def __init__(self, cache: ScheduleCache = SCHEDULE, reload_interval: float = SCHEDULE_RELOAD_SECONDS):
+        self.cache = cache
+        self.reload_interval = reload_interval
+        self.task = None
+
+    def sync(self, today: date = None) -> bool:
+        """Применить границы праздников на сегодня; True, если флаг is_holiday изменился."""
+        today = today or datetime.now(TIMEZONE).date()
+        conn = db.connect()
+        try:
+            settings = dict(conn.execute(
+                "SELECT key, value FROM settings WHERE key IN ('is_holiday', 'holiday_auto_date')"
+            ).fetchall())
+            last = settings.get("holiday_auto_date")
+            if last == today.isoformat():
+                return False
+            last_day = date.fromisoformat(last) if last else None
+            holidays = load_holidays(conn, min(last_day or today, today))
+
+            def in_calendar(day):
+                return day is not None and any(item["start"] <= day <= item["end"] for item in holidays)
+
+            changed = False
+            wanted = in_calendar(today)
+            # Первый запуск (last_day is None) только включает режим, ручной флаг не сбрасываем
+            if in_calendar(last_day) != wanted:
+                flag = "1" if wanted else "0"
+                if settings.get("is_holiday", "0") != flag:
+                    conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('is_holiday', ?)", (flag,))
+                    changed = True
+                    logging.info(f"Праздничный режим {'включён' if wanted else 'выключен'} по календарю")
+            conn.execute(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES ('holiday_auto_date', ?)", (today.isoformat(),)
+            )
+            conn.commit()
+            return changed
+        finally:
+            conn.close()
+
+    def seconds_until_midnight(self) -> float:
+        now = datetime.now(TIMEZONE)
+        midnight = TIMEZONE.localize(datetime.combine(now.date() + timedelta(days=1), datetime.min.time()))
+        return (midnight - now).total_seconds()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.sync)
+                await asyncio.to_thread(self.cache.reload)
+            except Exception as e:
+                logging.error(f"Ошибка планировщика праздников: {e}", exc_info=True)
+            # Просыпаемся на ближайшую полночь (+1 с на расхождение часов) или для регулярной перезагрузки
+            await asyncio.sleep(min(self.reload_interval, self.seconds_until_midnight() + 1))
+
+    def start(self):
+        # В RUN_MODE=all вызывается и при старте веба, и при старте бота — запускаем один раз
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+
+holiday_scheduler = HolidayScheduler()
+
+
+def current() -> Schedule:
+    return SCHEDULE.get()
+
+
+def reload() -> Schedule:
+    return SCHEDULE.reload()
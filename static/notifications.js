@@ -3,7 +3,7 @@ let titleInterval = null;
 let notificationAudio = null;
 
 // Инициализация звука (чтобы избежать задержки при первом воспроизведении)
-function initializeAudio(src = '/static/notification.mp3') {
+function initializeAudio(src = window.NOTIFICATION_SOUND_URL || '/static/notification.mp3') {
     if (!notificationAudio) {
         notificationAudio = new Audio(src);
         notificationAudio.load(); // Загрузить звук заранее
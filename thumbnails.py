@@ -0,0 +1,111 @@
+"""Миниатюры изображений-вложений.
+
+Страницы показывают миниатюру, а оригинал из Uploads грузится только по клику. Pillow в
+зависимостях нет, поэтому миниатюры не пережимаются локально: Telegram сам хранит каждое фото
+в нескольких размерах (message.photo) и превью у документов-картинок (document.thumbnail),
+их и скачиваем. Для фото пользователя миниатюра качается вместе с оригиналом, до записи в
+базу; для фото оператора — в фоне после отправки, из ответа Bot API (см. store_sent).
+"""
+import asyncio
+import logging
+import os
+
+import db
+import tracing
+
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "320"))  # px по большей стороне
+
+# Цикл событий держит только слабые ссылки на задачи: без этого набора задачу может собрать GC
+_background_tasks = set()
+
+
+def pick_thumbnail(sizes):
+    """Наименьший размер не меньше THUMBNAIL_SIZE; None, если оригинал и так маленький."""
+    if not sizes or len(sizes) < 2:
+        return None
+    sizes = sorted(sizes, key=lambda size: size.width * size.height)
+    for size in sizes[:-1]:
+        if max(size.width, size.height) >= THUMBNAIL_SIZE:
+            return size
+    return None
+
+
+def thumbnail_name(file_name: str, unique_filename) -> str:
+    base = os.path.splitext(file_name)[0]
+    return unique_filename(f"thumb_{base}.jpg", directory="Uploads")
+
+
+async def download(bot, file_id: str, file_path: str):
+    os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+    file = await bot.get_file(file_id)
+    with tracing.span("download", file_path=file_path):
+        await bot.download_file(file.file_path, file_path)
+
+
+async def save_photo(bot, sizes, file_name: str, unique_filename) -> dict:
+    """Скачать оригинал фото и миниатюру параллельно; поля для строки attachments."""
+    original = max(sizes, key=lambda size: size.width * size.height)
+    result = {"file_path": f"Uploads/{file_name}", "file_name": file_name, "file_type": "image",
+              "thumb_path": None, "width": original.width, "height": original.height}
+    downloads = [download(bot, original.file_id, result["file_path"])]
+    thumb = pick_thumbnail(sizes)
+    if thumb is not None:
+        result["thumb_path"] = f"Uploads/{thumbnail_name(file_name, unique_filename)}"
+        downloads.append(download(bot, thumb.file_id, result["thumb_path"]))
+    await asyncio.gather(*downloads)
+    return result
+
+
+async def save_document(bot, document, file_name: str, unique_filename) -> dict:
+    """Скачать документ; у документов-картинок — ещё и превью, которое Telegram уже сделал."""
+    result = {"file_path": f"Uploads/{file_name}", "file_name": file_name, "file_type": "document",
+              "thumb_path": None, "width": None, "height": None}
+    downloads = [download(bot, document.file_id, result["file_path"])]
+    thumb = document.thumbnail
+    if thumb is not None and (document.mime_type or "").startswith("image/"):
+        result["thumb_path"] = f"Uploads/{thumbnail_name(file_name, unique_filename)}"
+        downloads.append(download(bot, thumb.file_id, result["thumb_path"]))
+    await asyncio.gather(*downloads)
+    return result
+
+
+async def store_sent(bot, files: list, sent_messages: list, unique_filename):
+    """Миниатюры для фото, отправленных оператором: files и sent_messages идут в одном порядке."""
+    updates = []
+    for file, sent in zip(files, sent_messages):
+        if not sent.photo:
+            continue
+        original = max(sent.photo, key=lambda size: size.width * size.height)
+        thumb = pick_thumbnail(sent.photo)
+        thumb_path = None
+        try:
+            if thumb is not None:
+                thumb_path = f"Uploads/{thumbnail_name(os.path.basename(file['path']), unique_filename)}"
+                await download(bot, thumb.file_id, thumb_path)
+        except Exception as e:
+            logging.warning(f"Не удалось скачать миниатюру для {file['path']}: {e}")
+            thumb_path = None
+        updates.append((thumb_path, original.width, original.height, file["path"]))
+    if not updates:
+        return
+    conn = db.connect()
+    try:
+        conn.executemany(
+            "UPDATE attachments SET thumb_path = ?, width = ?, height = ? WHERE file_path = ?", updates
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _store_sent_done(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Не удалось сохранить миниатюры отправленных фото: {task.exception()}", exc_info=task.exception())
+
+
+def store_sent_later(bot, files: list, sent_messages: list, unique_filename):
+    """store_sent в фоне, чтобы очередь сообщений его не ждала."""
+    task = asyncio.create_task(store_sent(bot, files, sent_messages, unique_filename))
+    _background_tasks.add(task)
+    task.add_done_callback(_store_sent_done)
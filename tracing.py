@@ -0,0 +1,219 @@
+"""Трассировка: трасса на каждый апдейт Telegram и HTTP-запрос, спаны в кольцевом буфере.
+
+Текущий спан хранится в contextvars, поэтому доходит до всех await и asyncio.create_task
+внутри обработчика. В задания message_queue контекст кладётся явно (inject/extract).
+При заданном OTEL_EXPORTER_OTLP_ENDPOINT спаны дополнительно отправляются по OTLP/HTTP (JSON).
+"""
+import asyncio
+import contextvars
+import logging
+import os
+import secrets
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+# db.py импортирует tracing раньше, чем сам вызывает load_dotenv — без этого настройки из .env не видны
+load_dotenv()
+
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "0") == "1"  # спан на каждый SQL-запрос — только по запросу
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "5000"))  # спанов в памяти процесса
+OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "")
+OTLP_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "pumbabot")
+OTLP_EXPORT_INTERVAL = 5
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start", "end", "attributes", "error")
+
+    def __init__(self, name: str, trace_id: str, parent_id: str = None, attributes: dict = None, start: float = None):
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time() if start is None else start
+        self.end = None
+        self.attributes = attributes or {}
+        self.error = None
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end or time.time()) - self.start) * 1000
+
+    def finish(self, end: float = None):
+        self.end = time.time() if end is None else end
+        spans.append(self)
+        if export_queue is not None:
+            export_queue.append(self)
+
+
+_current = contextvars.ContextVar("current_span", default=None)
+spans = deque(maxlen=TRACE_BUFFER_SIZE)
+export_queue = deque(maxlen=TRACE_BUFFER_SIZE) if OTLP_ENDPOINT else None
+
+
+def current_span():
+    return _current.get()
+
+
+@contextmanager
+def _activate(span: Span):
+    token = _current.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        span.finish()
+
+
+@contextmanager
+def trace(name: str, parent: dict = None, **attributes):
+    """Новая трасса (или продолжение чужой по parent из extract())."""
+    if not TRACE_ENABLED:
+        yield None
+        return
+    if parent:
+        span = Span(name, parent["trace_id"], parent["span_id"], attributes)
+    else:
+        span = Span(name, secrets.token_hex(16), None, attributes)
+    with _activate(span):
+        yield span
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Дочерний спан текущей трассы; вне трассы ничего не записывает."""
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    with _activate(Span(name, parent.trace_id, parent.span_id, attributes)):
+        yield _current.get()
+
+
+def record_span(name: str, duration: float, **attributes):
+    """Задним числом записать уже измеренный участок (например, запрос к БД) в текущую трассу."""
+    parent = _current.get()
+    if parent is None:
+        return
+    end = time.time()
+    Span(name, parent.trace_id, parent.span_id, attributes, start=end - duration).finish(end)
+
+
+def inject(data: dict) -> dict:
+    """Положить контекст текущей трассы в задание очереди."""
+    current = _current.get()
+    if current is not None:
+        data["trace"] = {"trace_id": current.trace_id, "span_id": current.span_id, "queued_at": time.time()}
+    return data
+
+
+def extract(data: dict):
+    return data.get("trace")
+
+
+def recent_traces(limit: int = 100, min_ms: float = 0) -> list:
+    """Последние трассы из буфера: корневой спан, общая длительность и дерево спанов."""
+    by_trace = {}
+    for item in list(spans):
+        by_trace.setdefault(item.trace_id, []).append(item)
+    result = []
+    for trace_id, items in by_trace.items():
+        items.sort(key=lambda item: item.start)
+        ids = {item.span_id for item in items}
+        roots = [item for item in items if item.parent_id not in ids]
+        start = items[0].start
+        duration_ms = (max(item.end for item in items) - start) * 1000
+        if duration_ms < min_ms:
+            continue
+        depth = {}
+        for item in items:
+            depth[item.span_id] = depth.get(item.parent_id, -1) + 1 if item.parent_id in ids else 0
+        result.append({
+            "trace_id": trace_id,
+            "name": roots[0].name,
+            "start": start,
+            "duration_ms": duration_ms,
+            "errors": sum(1 for item in items if item.error),
+            "spans": [
+                {
+                    "name": item.name,
+                    "depth": depth[item.span_id],
+                    "offset_ms": (item.start - start) * 1000,
+                    "duration_ms": item.duration_ms,
+                    "attributes": item.attributes,
+                    "error": item.error,
+                }
+                for item in items
+            ],
+        })
+    result.sort(key=lambda item: item["start"], reverse=True)
+    return result[:limit]
+
+
+# ---------- экспорт OTLP ----------
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(item: Span) -> dict:
+    data = {
+        "traceId": item.trace_id,
+        "spanId": item.span_id,
+        "name": item.name,
+        "kind": 1,
+        "startTimeUnixNano": str(int(item.start * 1e9)),
+        "endTimeUnixNano": str(int(item.end * 1e9)),
+        "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in item.attributes.items()],
+        "status": {"code": 2, "message": item.error} if item.error else {"code": 1},
+    }
+    if item.parent_id:
+        data["parentSpanId"] = item.parent_id
+    return data
+
+
+async def export_otlp():
+    import aiohttp
+
+    url = OTLP_ENDPOINT.rstrip("/") + "/v1/traces"
+    async with aiohttp.ClientSession() as session:
+        while True:
+            await asyncio.sleep(OTLP_EXPORT_INTERVAL)
+            batch = []
+            while export_queue:
+                batch.append(_otlp_span(export_queue.popleft()))
+            if not batch:
+                continue
+            payload = {"resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": OTLP_SERVICE_NAME}}]},
+                "scopeSpans": [{"scope": {"name": "pumbabot"}, "spans": batch}],
+            }]}
+            try:
+                async with session.post(url, json=payload, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                    if response.status >= 300:
+                        logging.warning("OTLP: экспорт %s спанов отклонён, HTTP %s", len(batch), response.status)
+            except Exception as e:
+                logging.warning("OTLP: не удалось отправить %s спанов: %s", len(batch), e)
+
+
+_exporter = None
+
+
+def start_exporter():
+    # Запускается и при старте веба, и при старте бота — задача нужна одна
+    global _exporter
+    if export_queue is not None and _exporter is None:
+        _exporter = asyncio.create_task(export_otlp())
+        logging.info(f"Экспорт трасс по OTLP: {OTLP_ENDPOINT}")